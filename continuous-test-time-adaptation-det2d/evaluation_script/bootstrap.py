@@ -0,0 +1,191 @@
+"""Sequence-level bootstrap confidence intervals of the detection scores.
+
+The matched detections of a submission, see det2d_eval.py, are sufficient
+statistics of the AP: a resample of the sequences weights the detections and
+the ground truth of every sequence by its number of draws. The accumulation
+of COCOeval is carried out for all resamples at once on the weighted
+cumulative sums, so the boxes are matched only once. The sums are only taken
+at the true positives, from per-sequence counts, so a thousand resamples cost
+a few array passes per category over the true positives. With all weights
+equal to one it gives the AP of evaluate_det, up to rounding.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+from det2d_eval import REC_THRS, BoxMatches, unit_detections
+
+NUM_RESAMPLES = 1000
+CONFIDENCE_LEVEL = 0.95
+SEED = 0
+# Elements of the (resamples, true positives) arrays per chunk
+CHUNK_SIZE = 1 << 22
+
+
+def resample_weights(
+    num_seqs: int, num_resamples: int = NUM_RESAMPLES, seed: int = SEED
+) -> np.ndarray:
+    """
+    Number of draws of each sequence in each resample
+
+    Args:
+        num_seqs: number of sequences
+        num_resamples: number of bootstrap resamples
+        seed: seed of the resamples, fixed for reproducible intervals
+    """
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(num_seqs, np.full(num_seqs, 1.0 / num_seqs), num_resamples)
+
+
+def percentile_interval(
+    samples: np.ndarray, level: float = CONFIDENCE_LEVEL
+) -> tuple[float, float]:
+    """Percentile interval of bootstrap samples, ignoring nan samples"""
+    alpha = (1.0 - level) / 2.0
+    low, high = np.nanpercentile(samples, [alpha * 100, (1.0 - alpha) * 100])
+    return float(low), float(high)
+
+
+def weighted_precision(
+    weights: np.ndarray,
+    det_seqs: np.ndarray,
+    tps: np.ndarray,
+    fps: np.ndarray,
+    gt_counts: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Interpolated precision of a category in each resample
+
+    Only the true positives are visited: the first detection reaching a recall
+    threshold is a true positive, and any other detection has the true
+    positives and at most the precision of the last true positive before it.
+    The weighted counts at the true positives are products of the weights with
+    per-sequence counts, so a resample costs the number of true positives
+    instead of the number of detections.
+
+    Args:
+        weights: draws of each sequence, in shape (B, S)
+        det_seqs: sequence index of each sorted detection, in shape (D,)
+        tps: true positive masks, in shape (T, D)
+        fps: false positive masks, in shape (T, D)
+        gt_counts: non-ignored ground truth boxes of each sequence, in shape (S,)
+
+    Returns the precision at the recall thresholds in shape (B, T, R), and
+    whether the category is evaluated in each resample, i.e. has ground truth.
+    """
+    npig = weights @ gt_counts
+    valid = npig > 0
+    num_resamples, num_seqs = weights.shape
+    precision = np.zeros((num_resamples, len(tps), len(REC_THRS)))
+    for t in range(len(tps)):
+        tp_dets = np.flatnonzero(tps[t])
+        if len(tp_dets) == 0:
+            continue
+        # Detections of each sequence up to each true positive, the false
+        # positives by the number of true positives before them
+        tp_counts = np.zeros((len(tp_dets), num_seqs))
+        tp_counts[np.arange(len(tp_dets)), det_seqs[tp_dets]] = 1
+        fp_dets = np.flatnonzero(fps[t])
+        fp_counts = np.zeros((len(tp_dets) + 1, num_seqs))
+        np.add.at(fp_counts, (np.searchsorted(tp_dets, fp_dets), det_seqs[fp_dets]), 1)
+        tp_counts = np.cumsum(tp_counts, axis=0).T
+        fp_counts = np.cumsum(fp_counts[:-1], axis=0).T
+        chunk = max(1, CHUNK_SIZE // len(tp_dets))
+        for start in range(0, num_resamples, chunk):
+            batch = slice(start, start + chunk)
+            precision[batch, t] = _interpolated_precision(
+                weights[batch] @ tp_counts, weights[batch] @ fp_counts, npig[batch]
+            )
+    return precision, valid
+
+
+def _interpolated_precision(
+    tp_sum: np.ndarray, fp_sum: np.ndarray, npig: np.ndarray
+) -> np.ndarray:
+    # Precision at the recall thresholds of each row of weighted cumulative
+    # counts. Integral weights keep the sums exact, as the counts of COCOeval
+    num_rows, num_tps = tp_sum.shape
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+    # searchsorted(rc, REC_THRS) of each row in one call: the first detection
+    # with tp / npig >= thr is the first with tp >= the least such integer,
+    # so the rows can be offset exactly in integers
+    denom = np.where(npig > 0, npig, 1).astype(np.float64)[:, None]
+    needed = np.ceil(REC_THRS * denom)
+    needed += needed / denom < REC_THRS
+    needed -= (needed > 0) & ((needed - 1) / denom >= REC_THRS)
+    rows = np.arange(num_rows)
+    stride = int(npig.max()) + 2
+    keys = tp_sum.astype(np.int64) + (rows * stride)[:, None]
+    queries = needed.astype(np.int64) + (rows * stride)[:, None]
+    inds = np.searchsorted(keys.ravel(), queries.ravel(), side="left")
+    inds = inds.reshape(num_rows, len(REC_THRS)) - (rows * num_tps)[:, None]
+    found = inds < num_tps
+    q = np.take_along_axis(pr, np.minimum(inds, num_tps - 1), axis=1)
+    return np.where(found, q, 0.0)
+
+
+def average_precision(
+    matches: BoxMatches, pairs: np.ndarray, pair_seqs: np.ndarray, weights: np.ndarray
+) -> np.ndarray:
+    """
+    AP in percent of a unit in each resample, like det2d_eval.average_precision
+
+    Args:
+        matches: matched detections
+        pairs: pairs of the unit, in image order
+        pair_seqs: sequence index of each pair
+        weights: draws of each sequence, in shape (B, S)
+    """
+    num_cats = matches.gt_counts.shape[1]
+    # Non-ignored ground truth boxes of each sequence and category
+    gt_counts = np.zeros((weights.shape[1], num_cats), dtype=np.int64)
+    np.add.at(gt_counts, pair_seqs[pairs], matches.gt_counts[pairs])
+    totals = np.zeros(len(weights))
+    counts = np.zeros(len(weights))
+    for k, dets in enumerate(unit_detections(matches, pairs)):
+        det_seqs = pair_seqs[matches.pair[dets]]
+        tps, fps = matches.tps[:, dets], matches.fps[:, dets]
+        precision, valid = weighted_precision(
+            weights, det_seqs, tps, fps, gt_counts[:, k]
+        )
+        totals += np.where(valid, precision.sum(axis=(1, 2)), 0.0)
+        counts += np.where(valid, precision[0].size, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return totals / counts * 100
+
+
+def bootstrap_det(
+    state: dict,
+    num_resamples: int = NUM_RESAMPLES,
+    level: float = CONFIDENCE_LEVEL,
+    seed: int = SEED,
+) -> dict[str, tuple[float, float]]:
+    """
+    Bootstrap confidence intervals of the detection scores over the sequences
+
+    Args:
+        state: matched detections of all frames and windows, from match_frames
+        num_resamples: number of bootstrap resamples
+        level: confidence level of the intervals
+        seed: seed of the resamples
+    """
+    seq_names = sorted(set(state["videos"]))
+    if not seq_names:
+        return {}
+    seq_index = {seq_name: i for i, seq_name in enumerate(seq_names)}
+    pair_seqs = np.array(
+        [seq_index[video] for video in state["videos"]], dtype=np.int64
+    )
+    weights = resample_weights(len(seq_names), num_resamples, seed).astype(np.float64)
+    scores = {
+        metric: average_precision(state["matches"], pairs, pair_seqs, weights)
+        for metric, pairs in state["units"].items()
+    }
+    scores["mAP_drop"] = scores["mAP_source"] - scores["mAP_target"]
+    scores["overall"] = scores["mAP"] - 2 * scores["mAP_drop"]
+    return {
+        metric: percentile_interval(samples, level)
+        for metric, samples in scores.items()
+    }
@@ -0,0 +1,495 @@
+"""Native COCO-style 2D box evaluation on columnar tables.
+
+scalabel's evaluate_det converts the frames to COCO dicts and pycocotools
+matches the detections of every (image, category) in Python. This module
+reads the boxes of the frames once into NumPy tables and reproduces the "AP"
+score of evaluate_det with array operations:
+
+ - the IoUs of all (image, category) groups are computed in padded batches,
+   with the floating point operations of the bbIou of pycocotools,
+ - the greedy matching of COCOeval.evaluateImg runs for all groups of a batch
+   and all ten IoU thresholds at once, one detection rank at a time,
+ - the accumulation sorts the detections of each category once and reads the
+   interpolated precision at the recall thresholds with searchsorted.
+
+Only the area range "all" with 100 detections per image is evaluated, which
+is what the "AP" score uses. Run the module on a ground truth and a
+prediction file to compare it with evaluate_det:
+
+    python -m evaluation_script.det2d_eval gt/det_2d.json submission/det_2d.json
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import sys
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+# COCOeval parameters of the "AP" score
+IOU_THRS = np.linspace(0.5, 0.95, 10, endpoint=True)
+REC_THRS = np.linspace(0.0, 1.00, 101, endpoint=True)
+MAX_DETS = 100
+AREA_RANGE = (0**2, 1e5**2)
+# Elements of the padded (groups, IoU thresholds, boxes) arrays per batch
+BATCH_SIZE = 1 << 22
+
+
+class BoxTable(NamedTuple):
+    """Boxes of a list of frames, in frame and label order."""
+
+    offsets: np.ndarray  # first box of each frame, in shape (F + 1,)
+    category: np.ndarray  # category index of each box, in shape (N,)
+    boxes: np.ndarray  # COCO x, y, width and height, in shape (N, 4)
+    scores: np.ndarray  # detection scores, 0 for ground truth, in shape (N,)
+    crowd: np.ndarray  # crowd or ignored ground truth, in shape (N,)
+
+
+class BoxMatches(NamedTuple):
+    """Matched detections of (ground truth, prediction) frame pairs.
+
+    The detections are the first MAX_DETS of each pair and category by score,
+    as kept by COCOeval.
+    """
+
+    pair: np.ndarray  # pair of each detection, in shape (D,)
+    category: np.ndarray  # category index of each detection, in shape (D,)
+    scores: np.ndarray  # score of each detection, in shape (D,)
+    rank: np.ndarray  # rank by score in its pair and category, in shape (D,)
+    tps: np.ndarray  # true positives per IoU threshold, in shape (T, D)
+    fps: np.ndarray  # false positives per IoU threshold, in shape (T, D)
+    gt_counts: np.ndarray  # non-ignored ground truth, in shape (P, K)
+    num_gts: np.ndarray  # ground truth boxes of each pair, in shape (P,)
+    num_preds: np.ndarray  # predicted boxes of each pair, in shape (P,)
+
+
+def box_table(frames: Sequence, config, predictions: bool = False) -> BoxTable:
+    """Read the boxes of frames like scalabel2coco_detection.
+
+    Args:
+        frames (list[Frame]): Scalabel frames.
+        config (Config): Dataset config, with the categories.
+        predictions (bool): Read scores and no crowd flags, as loadRes does.
+    Returns:
+        BoxTable: Boxes of the known categories, in frame and label order.
+    """
+    from scalabel.label.utils import check_crowd, check_ignored, get_leaf_categories
+
+    cat_index = {
+        cat.name: i for i, cat in enumerate(get_leaf_categories(config.categories))
+    }
+    counts, categories, coords, scores, crowd = [], [], [], [], []
+    for frame in frames:
+        num_boxes = 0
+        for label in frame.labels or []:
+            if label.box2d is None or label.category not in cat_index:
+                continue
+            box2d = label.box2d
+            categories.append(cat_index[label.category])
+            coords.append((box2d.x1, box2d.y1, box2d.x2, box2d.y2))
+            if predictions:
+                if label.score is None:
+                    raise ValueError(f"Box {label.id} of {frame.name} has no score")
+                scores.append(label.score)
+            else:
+                crowd.append(check_crowd(label) or check_ignored(label))
+            num_boxes += 1
+        counts.append(num_boxes)
+    coords = np.array(coords, dtype=np.float64).reshape(-1, 4)
+    # box2d_to_bbox: x2 and y2 are inside the box
+    width = coords[:, 2] - coords[:, 0] + 1
+    height = coords[:, 3] - coords[:, 1] + 1
+    return BoxTable(
+        offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        category=np.array(categories, dtype=np.int64),
+        boxes=np.stack([coords[:, 0], coords[:, 1], width, height], axis=1),
+        scores=np.array(scores if predictions else [0.0] * len(coords)),
+        crowd=np.array(crowd if not predictions else [False] * len(coords), bool),
+    )
+
+
+def _expand(table: BoxTable, frame_indices: np.ndarray) -> Tuple[np.ndarray, ...]:
+    # Pair and table row of the boxes of each pair's frame, -1 for no frame
+    present = frame_indices >= 0
+    starts = np.zeros(len(frame_indices), dtype=np.int64)
+    counts = np.zeros(len(frame_indices), dtype=np.int64)
+    starts[present] = table.offsets[frame_indices[present]]
+    counts[present] = table.offsets[frame_indices[present] + 1] - starts[present]
+    pairs = np.repeat(np.arange(len(frame_indices)), counts)
+    rows = np.arange(counts.sum()) + np.repeat(
+        starts - np.cumsum(counts) + counts, counts
+    )
+    return pairs, rows, counts
+
+
+def box_iou(
+    dt_boxes: np.ndarray, gt_boxes: np.ndarray, crowd: np.ndarray
+) -> np.ndarray:
+    """IoU of batched boxes, with the operations of bbIou in pycocotools.
+
+    Args:
+        dt_boxes (np.ndarray): Detections in shape (..., D, 4), as x, y, w, h.
+        gt_boxes (np.ndarray): Ground truth in shape (..., G, 4).
+        crowd (np.ndarray): Crowd ground truth in shape (..., G), for which the
+            union is the detection area.
+    Returns:
+        np.ndarray: IoUs in shape (..., D, G).
+    """
+    dt = dt_boxes[..., :, None, :]
+    gt = gt_boxes[..., None, :, :]
+    width = np.minimum(dt[..., 2] + dt[..., 0], gt[..., 2] + gt[..., 0]) - np.maximum(
+        dt[..., 0], gt[..., 0]
+    )
+    height = np.minimum(dt[..., 3] + dt[..., 1], gt[..., 3] + gt[..., 1]) - np.maximum(
+        dt[..., 1], gt[..., 1]
+    )
+    inter = width * height
+    dt_area = dt[..., 2] * dt[..., 3]
+    union = np.where(
+        crowd[..., None, :], dt_area, dt_area + gt[..., 2] * gt[..., 3] - inter
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where((width > 0) & (height > 0), inter / union, 0.0)
+
+
+def _last_best(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Index of the last maximum along the last axis, and whether it is >= 0
+    reverse = values.shape[-1] - 1 - np.argmax(values[..., ::-1], axis=-1)
+    found = np.take_along_axis(values, reverse[..., None], axis=-1)[..., 0] >= 0
+    return reverse, found
+
+
+def _match_batch(
+    ious: np.ndarray,
+    gt_valid: np.ndarray,
+    gt_ignore: np.ndarray,
+    gt_crowd: np.ndarray,
+    num_dets: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Greedy matching of COCOeval.evaluateImg for a batch of groups, with the
+    # detections sorted by score and the ground truth by ignore flag. Returns
+    # whether each detection is matched and whether its match is ignored, in
+    # shape (n, T, D).
+    num_groups, max_dets, _ = ious.shape
+    num_thrs = len(IOU_THRS)
+    gt_used = np.zeros((num_groups, num_thrs, ious.shape[2]), dtype=bool)
+    dt_matched = np.zeros((num_groups, num_thrs, max_dets), dtype=bool)
+    dt_ignore = np.zeros((num_groups, num_thrs, max_dets), dtype=bool)
+    group_index = np.arange(num_groups)[:, None]
+    thr_index = np.arange(num_thrs)[None, :]
+    for rank in range(max_dets):
+        iou = ious[:, None, rank, :]
+        eligible = (
+            gt_valid[:, None, :]
+            & (~gt_used | gt_crowd[:, None, :])
+            & (iou >= IOU_THRS[None, :, None])
+            & (rank < num_dets)[:, None, None]
+        )
+        # The last best match among the non-ignored ground truth, or else among
+        # the ignored ground truth, which evaluateImg scans after them
+        best, found = _last_best(np.where(eligible & ~gt_ignore[:, None, :], iou, -1.0))
+        best_ignored, found_ignored = _last_best(
+            np.where(eligible & gt_ignore[:, None, :], iou, -1.0)
+        )
+        best = np.where(found, best, best_ignored)
+        matched = found | found_ignored
+        gt_used[group_index, thr_index, best] |= matched
+        dt_matched[:, :, rank] = matched
+        dt_ignore[:, :, rank] = matched & gt_ignore[group_index, best]
+    return dt_matched, dt_ignore
+
+
+def match_boxes(
+    gt: BoxTable,
+    pred: BoxTable,
+    gt_indices: np.ndarray,
+    pred_indices: np.ndarray,
+    num_cats: int,
+) -> BoxMatches:
+    """Match the detections of frame pairs at all IoU thresholds.
+
+    Args:
+        gt (BoxTable): Ground truth boxes.
+        pred (BoxTable): Predicted boxes.
+        gt_indices (np.ndarray): Ground truth frame of each pair.
+        pred_indices (np.ndarray): Predicted frame of each pair, -1 if missing.
+        num_cats (int): Number of categories.
+    Returns:
+        BoxMatches: Matched detections of the pairs.
+    """
+    num_pairs = len(gt_indices)
+    gt_pairs, gt_rows, num_gts = _expand(gt, np.asarray(gt_indices, dtype=np.int64))
+    dt_pairs, dt_rows, num_preds = _expand(
+        pred, np.asarray(pred_indices, dtype=np.int64)
+    )
+
+    # Ground truth by group, non-ignored first as in evaluateImg
+    gt_area = gt.boxes[gt_rows, 2] * gt.boxes[gt_rows, 3]
+    gt_ignore = (
+        gt.crowd[gt_rows] | (gt_area < AREA_RANGE[0]) | (gt_area > AREA_RANGE[1])
+    )
+    gt_keys = gt_pairs * num_cats + gt.category[gt_rows]
+    order = np.lexsort((gt_rows, gt_ignore, gt_keys))
+    gt_rows, gt_ignore, gt_keys = gt_rows[order], gt_ignore[order], gt_keys[order]
+    gt_counts = np.bincount(
+        gt_keys, weights=~gt_ignore, minlength=num_pairs * num_cats
+    ).reshape(num_pairs, num_cats)
+
+    # Detections by group and score, the first MAX_DETS of each group
+    dt_keys = dt_pairs * num_cats + pred.category[dt_rows]
+    order = np.lexsort((dt_rows, -pred.scores[dt_rows], dt_keys))
+    dt_rows, dt_keys = dt_rows[order], dt_keys[order]
+    groups, group_starts, group_sizes = np.unique(
+        dt_keys, return_index=True, return_counts=True
+    )
+    rank = np.arange(len(dt_keys)) - np.repeat(group_starts, group_sizes)
+    keep = rank < MAX_DETS
+    dt_rows, dt_keys, rank = dt_rows[keep], dt_keys[keep], rank[keep]
+    group_sizes = np.minimum(group_sizes, MAX_DETS)
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]]).astype(np.int64)
+
+    tps = np.zeros((len(IOU_THRS), len(dt_rows)), dtype=bool)
+    fps = np.zeros((len(IOU_THRS), len(dt_rows)), dtype=bool)
+    dt_area = pred.boxes[dt_rows, 2] * pred.boxes[dt_rows, 3]
+    dt_out = (dt_area < AREA_RANGE[0]) | (dt_area > AREA_RANGE[1])
+    gt_starts = np.searchsorted(gt_keys, groups, side="left")
+    gt_sizes = np.searchsorted(gt_keys, groups, side="right") - gt_starts
+
+    # Groups by decreasing number of ground truth boxes, in padded batches
+    by_size = np.argsort(-gt_sizes, kind="stable")
+    start = 0
+    while start < len(by_size):
+        max_gts = gt_sizes[by_size[start]]
+        size = max(1, BATCH_SIZE // (len(IOU_THRS) * MAX_DETS * max(1, max_gts)))
+        batch = by_size[start : start + size]
+        start += size
+        max_dets = group_sizes[batch].max()
+        dt_valid = np.arange(max_dets)[None, :] < group_sizes[batch][:, None]
+        dt_index = np.where(
+            dt_valid, group_starts[batch][:, None] + np.arange(max_dets), 0
+        )
+        if max_gts > 0:
+            gt_valid = np.arange(max_gts)[None, :] < gt_sizes[batch][:, None]
+            gt_index = np.where(
+                gt_valid, gt_starts[batch][:, None] + np.arange(max_gts), 0
+            )
+            gt_crowd = gt.crowd[gt_rows[gt_index]]
+            ious = box_iou(
+                pred.boxes[dt_rows[dt_index]], gt.boxes[gt_rows[gt_index]], gt_crowd
+            )
+            matched, ignored = _match_batch(
+                ious, gt_valid, gt_ignore[gt_index], gt_crowd, group_sizes[batch]
+            )
+        else:
+            matched = np.zeros((len(batch), len(IOU_THRS), max_dets), dtype=bool)
+            ignored = matched
+        # Unmatched detections out of the area range are ignored
+        ignored = ignored | (~matched & dt_out[dt_index][:, None, :])
+        index = dt_index[dt_valid]
+        tps[:, index] = (matched & ~ignored).transpose(1, 0, 2)[:, dt_valid]
+        fps[:, index] = (~matched & ~ignored).transpose(1, 0, 2)[:, dt_valid]
+
+    return BoxMatches(
+        pair=dt_keys // num_cats,
+        category=dt_keys % num_cats,
+        scores=pred.scores[dt_rows],
+        rank=rank,
+        tps=tps,
+        fps=fps,
+        gt_counts=gt_counts.astype(np.int64),
+        num_gts=num_gts,
+        num_preds=num_preds,
+    )
+
+
+def unit_detections(matches: BoxMatches, pairs: np.ndarray) -> List[np.ndarray]:
+    """Detections of a unit per category, in the order of COCOeval.accumulate.
+
+    Args:
+        matches (BoxMatches): Matched detections.
+        pairs (np.ndarray): Pairs of the unit, in image order.
+    Returns:
+        list[np.ndarray]: Indices of the detections of each category, by
+            decreasing score, then image and rank.
+    """
+    position = np.full(len(matches.num_gts), -1, dtype=np.int64)
+    position[pairs] = np.arange(len(pairs))
+    positions = position[matches.pair]
+    selected = np.nonzero(positions >= 0)[0]
+    order = np.lexsort(
+        (
+            matches.rank[selected],
+            positions[selected],
+            -matches.scores[selected],
+            matches.category[selected],
+        )
+    )
+    selected = selected[order]
+    bounds = np.searchsorted(
+        matches.category[selected], np.arange(matches.gt_counts.shape[1] + 1)
+    )
+    return [selected[bounds[k] : bounds[k + 1]] for k in range(len(bounds) - 1)]
+
+
+def average_precision(matches: BoxMatches, pairs: np.ndarray) -> float:
+    """AP in percent of a unit, as the "AP" of evaluate_det.
+
+    Args:
+        matches (BoxMatches): Matched detections.
+        pairs (np.ndarray): Pairs of the unit, in image order.
+    Returns:
+        float: Mean precision over the IoU thresholds, recall thresholds and
+            categories with ground truth.
+    """
+    if matches.num_preds[pairs].sum() == 0:
+        # DetResult.empty
+        return 0.0 if matches.num_gts[pairs].sum() > 0 else float("nan")
+    npigs = matches.gt_counts[pairs].sum(axis=0)
+    precision = -np.ones((len(IOU_THRS), len(REC_THRS), len(npigs)))
+    for k, dets in enumerate(unit_detections(matches, pairs)):
+        if npigs[k] == 0:
+            continue
+        tp_sum = np.cumsum(matches.tps[:, dets], axis=1).astype(dtype=float)
+        fp_sum = np.cumsum(matches.fps[:, dets], axis=1).astype(dtype=float)
+        recall = tp_sum / npigs[k]
+        pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+        pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+        precision[:, :, k] = 0.0
+        for t in range(len(IOU_THRS)):
+            inds = np.searchsorted(recall[t], REC_THRS, side="left")
+            found = inds < len(dets)
+            precision[t, found, k] = pr[t, inds[found]]
+    if not np.any(precision > -1):
+        return float("nan")
+    return float(np.mean(precision[precision > -1]) * 100)
+
+
+def match_frames(
+    gt_frames: Sequence,
+    pred_frames: Sequence,
+    units: Dict[str, Tuple[List[int], List[int]]],
+    config,
+) -> Dict:
+    """Match the boxes of several evaluations of the same frames.
+
+    Each unit is one evaluate_det, e.g. of a frame window, given by the
+    indices of its ground truth and predicted frames. The predictions are
+    assigned on each unit like reorder_preds, and pairs shared by several
+    units are matched once. Only the boxes within the top MAX_DETS of their
+    frame and category are read, see top_predictions.
+
+    Args:
+        gt_frames (list[Frame]): All ground truth frames.
+        pred_frames (list[Frame]): All predicted frames.
+        units (dict[str, tuple[list[int], list[int]]]): Ground truth and
+            prediction indices of each unit, in file order.
+        config (Config): Dataset config.
+    Returns:
+        dict: "matches" of the pairs, the pairs of each unit in image order
+            under "units", and the "videos" and ground truth "frames" of the
+            pairs.
+    """
+    from scalabel.label.utils import get_leaf_categories
+
+    from match_records import assign_preds, image_positions, top_predictions
+
+    pairs: Dict[Tuple[int, int], int] = {}
+    unit_pairs = {}
+    for name, (gt_indices, pred_indices) in units.items():
+        unit_gt_frames = [gt_frames[i] for i in gt_indices]
+        assigned = assign_preds(unit_gt_frames, [pred_frames[j] for j in pred_indices])
+        images = np.empty(len(gt_indices), dtype=np.int64)
+        for i, position, pred_index in zip(
+            gt_indices, image_positions(unit_gt_frames), assigned
+        ):
+            pair = (i, pred_indices[pred_index] if pred_index is not None else -1)
+            images[position] = pairs.setdefault(pair, len(pairs))
+        unit_pairs[name] = images
+    gt_indices = np.array([i for i, _ in pairs], dtype=np.int64)
+    pred_indices = np.array([j for _, j in pairs], dtype=np.int64)
+    gt_used = np.unique(gt_indices)
+    pred_used = np.unique(pred_indices[pred_indices >= 0])
+    matches = match_boxes(
+        box_table([gt_frames[i] for i in gt_used], config),
+        box_table(
+            top_predictions([pred_frames[j] for j in pred_used], max_dets=MAX_DETS),
+            config,
+            predictions=True,
+        ),
+        np.searchsorted(gt_used, gt_indices),
+        np.where(pred_indices >= 0, np.searchsorted(pred_used, pred_indices), -1),
+        len(get_leaf_categories(config.categories)),
+    )
+    return {
+        "matches": matches,
+        "units": unit_pairs,
+        "videos": [gt_frames[i].videoName for i in gt_indices],
+        "frames": gt_indices,
+    }
+
+
+def unit_scores(state: Dict) -> Dict[str, float]:
+    """AP of each unit of match_frames."""
+    return {
+        name: average_precision(state["matches"], pairs)
+        for name, pairs in state["units"].items()
+    }
+
+
+def frame_match_counts(state: Dict, unit: str) -> Dict[str, np.ndarray]:
+    """Detection match counts of each ground truth frame of a unit.
+
+    Args:
+        state (dict): Output of match_frames.
+        unit (str): Name of the unit, e.g. the one of all frames.
+    Returns:
+        dict[str, np.ndarray]: Index of the ground truth frames of the unit,
+            in file order, under "frame", and for each frame the number of
+            non-ignored ground truth boxes, predicted boxes, and matched and
+            unmatched detections among the evaluated ones at IoU 0.5 and 0.75.
+    """
+    matches = state["matches"]
+    pairs = state["units"][unit]
+    pairs = pairs[np.argsort(state["frames"][pairs], kind="stable")]
+    num_pairs = len(matches.num_preds)
+    counts = {
+        "frame": state["frames"][pairs],
+        "num_gts": matches.gt_counts[pairs].sum(axis=1),
+        "num_preds": matches.num_preds[pairs],
+    }
+    for iou in (0.5, 0.75):
+        t = int(np.argmin(np.abs(IOU_THRS - iou)))
+        for name, hits in (("tp", matches.tps[t]), ("fp", matches.fps[t])):
+            per_pair = np.bincount(matches.pair[hits], minlength=num_pairs)
+            counts[f"{name}_{round(iou * 100)}"] = per_pair[pairs]
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the native box evaluation with evaluate_det."
+    )
+    parser.add_argument("gt", help="ground truth json file")
+    parser.add_argument("pred", help="prediction json file")
+    args = parser.parse_args()
+
+    from scalabel.eval.detect import evaluate_det
+    from scalabel.label.io import load
+
+    gt_data = load(args.gt, validate_frames=False)
+    pred_frames = load(args.pred, validate_frames=False).frames
+    units = {"AP": (list(range(len(gt_data.frames))), list(range(len(pred_frames))))}
+    native = unit_scores(
+        match_frames(gt_data.frames, pred_frames, units, gt_data.config)
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference = evaluate_det(gt_data.frames, pred_frames, gt_data.config, nproc=1)
+    reference = reference.summary()["AP"]
+    print(f"native AP: {native['AP']}, evaluate_det AP: {reference}")
+    same = native["AP"] == reference or (np.isnan(native["AP"]) and np.isnan(reference))
+    sys.exit(0 if same else 1)
@@ -0,0 +1,307 @@
+"""Differential check of the fast 2D detection paths against evaluate_det.
+
+Every faster path to the leaderboard numbers must give the same "AP" of all
+frames and of each frame window as scalabel's evaluate_det on the frames of
+the unit: the native evaluation of det2d_eval.py and the sharded per-image
+match records of match_records.py.
+
+The check runs the reference and all engines on generated cases, random ones
+and adversarial ones: empty frames, missing predictions, no predictions at
+all, tied scores and more detections than COCOeval keeps per image. The
+results must agree within TOLERANCE, and the time of each engine is reported
+relative to the reference:
+
+    python evaluation_script/equivalence.py --cases 20
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import copy
+import io
+import logging
+import math
+import sys
+import time
+import warnings
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+from det2d_eval import MAX_DETS, match_frames, unit_scores
+from main import FRAME_WINDOWS, window_units
+
+# Relative and absolute tolerance. The engines reproduce the floating point
+# operations of pycocotools, so the scores must agree exactly.
+TOLERANCE = (0.0, 0.0)
+# Adversarial kinds of the generated cases, one after the other
+KINDS = ["random", "empty", "missing", "ties", "none", "crowded"]
+CATEGORIES = ["car", "pedestrian", "truck"]
+
+
+class Case(NamedTuple):
+    """Generated input of the check."""
+
+    name: str  # kind and number of the case
+    data: Any  # ground truth frames, predicted frames and config
+
+
+def compare(
+    expected: Dict[str, float], actual: Dict[str, float], rtol: float, atol: float
+) -> List[str]:
+    """Differences of two results beyond a tolerance, NaN only agreeing with NaN.
+
+    Args:
+        expected: reference result
+        actual: result of an engine
+        rtol: tolerance relative to the reference value
+        atol: absolute tolerance
+    """
+    diffs = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual or key not in expected:
+            where = "reference" if key in expected else "engine"
+            diffs.append(f"{key} only in {where}")
+            continue
+        a, b = float(actual[key]), float(expected[key])
+        if a == b or (math.isnan(a) and math.isnan(b)):
+            continue
+        if not (abs(a - b) <= atol + rtol * abs(b)):
+            diffs.append(f"{key}: {a!r} != {b!r}")
+    return diffs
+
+
+def run_check(
+    cases: Iterator[Case],
+    reference: Callable[[Any], Any],
+    engines: Dict[str, Callable[[Any], Any]],
+) -> Dict[str, Dict[str, float]]:
+    """Run the reference and the engines on cases and compare their results.
+
+    Args:
+        cases: generated cases
+        reference: reference evaluation of the data of a case
+        engines: fast evaluations of the data of a case, by name
+    Returns:
+        For each engine, the number of "cases" it ran on, the number of
+        "mismatches" and the "speedup", the time of the reference divided by
+        the time of the engine on these cases.
+    """
+    rtol, atol = TOLERANCE
+    stats = {
+        name: {"cases": 0, "mismatches": 0, "ref": 0.0, "time": 0.0} for name in engines
+    }
+    for case in cases:
+        expected, ref_time = _timed(reference, case.data)
+        for name, engine in engines.items():
+            actual, elapsed = _timed(engine, case.data)
+            diffs = compare(expected, actual, rtol, atol)
+            stat = stats[name]
+            stat["cases"] += 1
+            stat["ref"] += ref_time
+            stat["time"] += elapsed
+            if diffs:
+                stat["mismatches"] += 1
+                print(f"det_2d/{name} differs on {case.name}: {'; '.join(diffs[:5])}")
+    return {
+        name: {
+            "cases": stat["cases"],
+            "mismatches": stat["mismatches"],
+            "speedup": stat["ref"] / stat["time"] if stat["time"] > 0 else math.nan,
+        }
+        for name, stat in stats.items()
+    }
+
+
+def _timed(function: Callable[[Any], Any], data: Any) -> Tuple[Any, float]:
+    # Result and time of a quiet call, without the logs of scalabel and the
+    # warnings of empty means
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ), warnings.catch_warnings(), np.errstate(all="ignore"):
+        warnings.simplefilter("ignore")
+        logging.disable(logging.CRITICAL)
+        try:
+            # Copies, since the evaluations may change the frames
+            data = copy.deepcopy(data)
+            start = time.perf_counter()
+            result = function(data)
+            elapsed = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+    return result, elapsed
+
+
+def det_cases(num_cases: int, rng: np.random.Generator) -> Iterator[Case]:
+    """
+    2D detection cases of a few sequences, with frames in and around the
+    frame windows, and predictions mostly close to a ground truth box
+
+    Args:
+        num_cases: number of cases
+        rng: random generator
+    """
+    from scalabel.label.typing import Box2D, Category, Config, Frame, Label
+
+    config = Config(
+        categories=[Category(name=name) for name in CATEGORIES],
+        imageSize={"width": 1280, "height": 800},
+    )
+    frame_ids = sorted(
+        {i for start, end in FRAME_WINDOWS.values() for i in (start, end, end + 1)}
+    )
+
+    def make_box(grid: bool) -> Box2D:
+        # Boxes on a grid give tied IoUs, others some empty boxes
+        if grid:
+            x1, y1 = rng.integers(0, 40, 2) * 8.0
+            width, height = rng.integers(1, 6, 2) * 8.0
+        else:
+            x1, y1 = rng.uniform(0, 300, 2)
+            width, height = rng.uniform(-2, 80, 2)
+        return Box2D(x1=x1, y1=y1, x2=x1 + width, y2=y1 + height)
+
+    for k in range(num_cases):
+        kind = KINDS[k % len(KINDS)]
+        grid = bool(rng.random() < 0.5)
+        gt_frames, pred_frames = [], []
+        for s in range(int(rng.integers(1, 4))):
+            video_name = f"seq{s}"
+            for frame_id in sorted(rng.choice(frame_ids, 4, replace=False).tolist()):
+                name = f"{frame_id:08d}_img_front.jpg"
+                empty = kind == "empty" and rng.random() < 0.5
+                labels = []
+                for _ in range(0 if empty else int(rng.integers(0, 10))):
+                    attributes = {}
+                    if rng.random() < 0.1:
+                        attributes["crowd"] = True
+                    if rng.random() < 0.05:
+                        attributes["ignored"] = True
+                    labels.append(
+                        Label(
+                            id=str(rng.integers(1 << 30)),
+                            category=str(rng.choice(CATEGORIES + ["bicycle"])),
+                            box2d=make_box(grid),
+                            attributes=attributes,
+                        )
+                    )
+                gt_frames.append(
+                    Frame(
+                        name=name,
+                        videoName=video_name,
+                        frameIndex=frame_id,
+                        labels=labels,
+                    )
+                )
+                if kind == "none" or (kind == "missing" and rng.random() < 0.5):
+                    continue
+                num_preds = 0 if empty else int(rng.integers(0, 15))
+                if kind == "crowded":
+                    num_preds = int(rng.integers(MAX_DETS // 2, 2 * MAX_DETS))
+                pred_labels = []
+                for _ in range(num_preds):
+                    if labels and rng.random() < 0.5:
+                        source = labels[rng.integers(len(labels))]
+                        jitter = rng.uniform(-4, 4, 4)
+                        box = source.box2d
+                        box = Box2D(
+                            x1=box.x1 + jitter[0],
+                            y1=box.y1 + jitter[1],
+                            x2=box.x2 + jitter[2],
+                            y2=box.y2 + jitter[3],
+                        )
+                        category = source.category
+                    else:
+                        box = make_box(grid)
+                        category = str(rng.choice(CATEGORIES))
+                    if kind == "ties" or rng.random() < 0.3:
+                        score = float(rng.integers(1, 4) / 4)
+                    else:
+                        score = float(rng.random())
+                    pred_labels.append(
+                        Label(
+                            id=str(rng.integers(1 << 30)),
+                            category=category,
+                            box2d=box,
+                            score=score,
+                        )
+                    )
+                pred_frames.append(
+                    Frame(
+                        name=name,
+                        videoName=video_name,
+                        frameIndex=frame_id,
+                        labels=pred_labels,
+                    )
+                )
+        yield Case(f"{kind} #{k}", (gt_frames, pred_frames, config))
+
+
+def check_det(num_cases: int, rng: np.random.Generator) -> Dict[str, Dict[str, float]]:
+    """
+    Compare the fast 2D detection paths with evaluate_det, see run_check
+
+    Args:
+        num_cases: number of generated cases
+        rng: random generator
+    """
+    from scalabel.eval.detect import evaluate_det
+
+    from match_records import match_units, reduce_units
+
+    def reference(data: Tuple) -> Dict[str, float]:
+        gt_frames, pred_frames, config = data
+        return {
+            name: evaluate_det(
+                [gt_frames[i] for i in gt_indices],
+                [pred_frames[j] for j in pred_indices],
+                config,
+                nproc=1,
+            ).summary()["AP"]
+            for name, (gt_indices, pred_indices) in window_units(
+                gt_frames, pred_frames
+            ).items()
+        }
+
+    def native(data: Tuple) -> Dict[str, float]:
+        gt_frames, pred_frames, config = data
+        units = window_units(gt_frames, pred_frames)
+        return unit_scores(match_frames(gt_frames, pred_frames, units, config))
+
+    def shards(data: Tuple) -> Dict[str, float]:
+        gt_frames, pred_frames, config = data
+        units = window_units(gt_frames, pred_frames)
+        seqs = list(dict.fromkeys(frame.videoName for frame in gt_frames))
+        states = [
+            match_units(gt_frames, pred_frames, units, set(seqs[i::2]), config)
+            for i in range(2)
+        ]
+        return {
+            name: result.summary()["AP"]
+            for name, result in reduce_units(states).items()
+        }
+
+    engines = {"native": native, "shards": shards}
+    return run_check(det_cases(num_cases, rng), reference, engines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the fast 2D detection paths with evaluate_det."
+    )
+    parser.add_argument("--cases", type=int, default=12, help="number of cases")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    results = check_det(args.cases, np.random.default_rng(args.seed))
+    rtol, atol = TOLERANCE
+    for name, result in results.items():
+        print(
+            f"det_2d/{name}: {result['mismatches']} of {result['cases']} cases "
+            f"differ (rtol {rtol}, atol {atol}), "
+            f"{result['speedup']:.2f}x the speed of the reference"
+        )
+    sys.exit(0 if all(r["mismatches"] == 0 for r in results.values()) else 1)
@@ -0,0 +1,99 @@
+"""Interned integer keys of the frames of a dataset.
+
+A frame is identified by its video name and name, as in filter_scalabel. A
+FrameIndex interns these keys once per dataset into compact integer ids, in
+order of first appearance, and the predictions are aligned with the ground
+truth by one hash join on the keys, which also finds the missing and the
+duplicated frames. The tasks then work on the integer ids, e.g. as sample
+tokens, instead of building their own strings from the names.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+FrameKey = Tuple[Optional[str], str]
+
+
+def frame_keys(frames: Iterable) -> List[FrameKey]:
+    """Video name and name of frames.
+
+    Args:
+        frames (list[Frame]): Scalabel frames.
+    Returns:
+        list[tuple[str | None, str]]: Key of each frame.
+    """
+    return [(frame.videoName, frame.name) for frame in frames]
+
+
+class FrameIndex:
+    """Integer ids of frame keys, in order of first appearance."""
+
+    def __init__(self, keys: Iterable[FrameKey] = ()):
+        self.ids: Dict[FrameKey, int] = {}
+        # Id of each frame the index was built on
+        self.frame_ids = self.intern(keys)
+
+    @classmethod
+    def from_frames(cls, frames: Iterable) -> FrameIndex:
+        """Index of the keys of scalabel frames."""
+        return cls(frame_keys(frames))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def intern(self, keys: Iterable[FrameKey]) -> np.ndarray:
+        """Ids of keys, new keys get the next ids.
+
+        Args:
+            keys (list[tuple[str | None, str]]): Frame keys.
+        Returns:
+            np.ndarray: Id of each key.
+        """
+        ids = self.ids
+        return np.array([ids.setdefault(key, len(ids)) for key in keys], dtype=np.int64)
+
+    def lookup(self, keys: Iterable[FrameKey]) -> np.ndarray:
+        """Ids of keys, -1 for keys not in the index.
+
+        Args:
+            keys (list[tuple[str | None, str]]): Frame keys.
+        Returns:
+            np.ndarray: Id of each key.
+        """
+        ids = self.ids
+        return np.array([ids.get(key, -1) for key in keys], dtype=np.int64)
+
+
+class FrameJoin(NamedTuple):
+    """Alignment of predicted frames with the frames of an index."""
+
+    kept: np.ndarray  # predicted frames with a key of the index, in order
+    pred_ids: np.ndarray  # id of each kept predicted frame
+    missing: np.ndarray  # ids without a predicted frame
+    duplicates: np.ndarray  # ids with several predicted frames
+
+
+def join_frames(index: FrameIndex, pred_keys: Sequence[FrameKey]) -> FrameJoin:
+    """Join predicted frames with the frames of an index.
+
+    All predicted frames with a key of the index are kept, as filter_scalabel
+    does, duplicates included, so that the caller decides how to use them.
+
+    Args:
+        index (FrameIndex): Index of the ground truth frames.
+        pred_keys (list[tuple[str | None, str]]): Key of each predicted frame.
+    Returns:
+        FrameJoin: Kept predicted frames and their ids, and the missing and
+            duplicated ids.
+    """
+    ids = index.lookup(pred_keys)
+    kept = np.flatnonzero(ids >= 0)
+    counts = np.bincount(ids[kept], minlength=len(index))
+    return FrameJoin(
+        kept=kept,
+        pred_ids=ids[kept],
+        missing=np.flatnonzero(counts == 0),
+        duplicates=np.flatnonzero(counts > 1),
+    )
@@ -0,0 +1,352 @@
+"""Compiled ground truth annotation cache.
+
+Parsing the ground truth json files through scalabel validates every frame and
+label, which dominates the start of a cold worker. The parsed annotations are
+compiled once into a columnar npz file:
+
+ - frames: names, video names, frame indices and label offsets,
+ - labels: ids, category indices, box2d and box3d arrays, the RLE counts as one
+   byte buffer with offsets, and scores,
+ - remaining frame and label fields, as json with offsets.
+
+The files are keyed by a hash of the ground truth zip contents and the cache
+version, so a changed ground truth or evaluator compiles a new file. Loading
+only unpacks the columns; the scalabel frames of the requested sequences are
+restored on demand, without parsing or deep copies.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from preflight import CACHE_DIR, installed_version
+
+# Bump when the compiled format or the restored annotations change
+ANNOTATION_CACHE_VERSION = 1
+ANNOTATION_CACHE_DIR = os.path.join(CACHE_DIR, "gt-annotations")
+
+_FRAME_COLUMNS = {"name", "videoName", "frameIndex", "labels"}
+_LABEL_COLUMNS = {"id", "category", "score", "box2d", "box3d", "rle"}
+
+
+def annotation_key(test_annotation_file: str) -> str:
+    """Cache key of the annotations of a ground truth zip file.
+
+    The key hashes the names, CRCs and sizes in the central directory, which
+    identify the contents without reading the whole archive.
+
+    Args:
+        test_annotation_file (str): Path to the ground truth zip file.
+    Returns:
+        str: Hex digest of the contents, cache version and scalabel version.
+    """
+    digest = hashlib.sha1()
+    digest.update(
+        json.dumps([ANNOTATION_CACHE_VERSION, installed_version("scalabel")]).encode()
+    )
+    with zipfile.ZipFile(test_annotation_file, "r") as zip_ref:
+        for info in sorted(zip_ref.infolist(), key=lambda info: info.filename):
+            digest.update(f"{info.filename}:{info.CRC}:{info.file_size};".encode())
+    return digest.hexdigest()
+
+
+def _pack_strings(values: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # Concatenate strings into one utf-8 buffer with offsets
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(buffer: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = buffer.tobytes()
+    offsets = offsets.tolist()
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+
+
+def _extra(model, columns: set) -> str:
+    # Fields without a column, as json, or "" if all are unset
+    extra = {
+        key: value
+        for key, value in model.dict(exclude_none=True).items()
+        if key not in columns
+    }
+    return json.dumps(extra) if extra else ""
+
+
+def compile_annotations(dataset) -> Dict[str, np.ndarray]:
+    """Compile a parsed scalabel dataset into columns.
+
+    Args:
+        dataset (Dataset): Parsed ground truth annotations.
+    Returns:
+        dict[str, np.ndarray]: Columns, to be saved with np.savez.
+    """
+    frames = dataset.frames
+    labels = [label for frame in frames for label in (frame.labels or [])]
+    label_offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    np.cumsum([len(frame.labels or []) for frame in frames], out=label_offsets[1:])
+    categories = sorted(
+        {label.category for label in labels if label.category is not None}
+    )
+    category_index = {category: i for i, category in enumerate(categories)}
+
+    columns = {
+        "frame_name": np.array([frame.name for frame in frames], dtype=str),
+        "frame_video": np.array([frame.videoName or "" for frame in frames], dtype=str),
+        "frame_has_video": np.array([frame.videoName is not None for frame in frames]),
+        "frame_index": np.array(
+            [-1 if frame.frameIndex is None else frame.frameIndex for frame in frames],
+            dtype=np.int64,
+        ),
+        "frame_has_index": np.array([frame.frameIndex is not None for frame in frames]),
+        "frame_has_labels": np.array([frame.labels is not None for frame in frames]),
+        "label_offsets": label_offsets,
+        "categories": np.array(categories, dtype=str),
+        "label_id": np.array([label.id for label in labels], dtype=str),
+        "label_category": np.array(
+            [category_index.get(label.category, -1) for label in labels],
+            dtype=np.int32,
+        ),
+        "label_score": np.array(
+            [np.nan if label.score is None else label.score for label in labels],
+            dtype=np.float64,
+        ),
+        "label_has_score": np.array(
+            [label.score is not None for label in labels], dtype=bool
+        ),
+        "label_has_box2d": np.array(
+            [label.box2d is not None for label in labels], dtype=bool
+        ),
+        "label_box2d": np.array(
+            [
+                [label.box2d.x1, label.box2d.y1, label.box2d.x2, label.box2d.y2]
+                if label.box2d is not None
+                else [0.0] * 4
+                for label in labels
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4),
+        "label_has_box3d": np.array(
+            [label.box3d is not None for label in labels], dtype=bool
+        ),
+        "label_box3d": np.array(
+            [
+                [label.box3d.alpha]
+                + list(label.box3d.orientation)
+                + list(label.box3d.location)
+                + list(label.box3d.dimension)
+                if label.box3d is not None
+                else [0.0] * 10
+                for label in labels
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 10),
+        "label_has_rle": np.array(
+            [label.rle is not None for label in labels], dtype=bool
+        ),
+        "label_rle_size": np.array(
+            [
+                list(label.rle.size) if label.rle is not None else [0, 0]
+                for label in labels
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 2),
+    }
+    columns["rle_counts"], columns["rle_offsets"] = _pack_strings(
+        [label.rle.counts if label.rle is not None else "" for label in labels]
+    )
+    columns["frame_extra"], columns["frame_extra_offsets"] = _pack_strings(
+        [_extra(frame, _FRAME_COLUMNS) for frame in frames]
+    )
+    columns["label_extra"], columns["label_extra_offsets"] = _pack_strings(
+        [_extra(label, _LABEL_COLUMNS) for label in labels]
+    )
+    columns["dataset_extra"], _ = _pack_strings(
+        [
+            json.dumps(
+                {
+                    "config": dataset.config.dict() if dataset.config else None,
+                    "groups": [group.dict() for group in dataset.groups]
+                    if dataset.groups
+                    else None,
+                }
+            )
+        ]
+    )
+    return columns
+
+
+class CompiledAnnotations:
+    """Compiled ground truth annotations, restored per sequence on demand."""
+
+    def __init__(self, columns: Dict[str, np.ndarray]) -> None:
+        """Unpack the columns once.
+
+        Args:
+            columns (dict[str, np.ndarray]): Columns of compile_annotations.
+        """
+        self.frame_video = columns["frame_video"]
+        self.frame_has_video = columns["frame_has_video"]
+        self.frame_names = columns["frame_name"].tolist()
+        self.frame_videos = self.frame_video.tolist()
+        self.has_video = self.frame_has_video.tolist()
+        self.frame_index = columns["frame_index"].tolist()
+        self.has_index = columns["frame_has_index"].tolist()
+        self.has_labels = columns["frame_has_labels"].tolist()
+        self.label_offsets = columns["label_offsets"].tolist()
+        self.frame_extra = _unpack_strings(
+            columns["frame_extra"], columns["frame_extra_offsets"]
+        )
+        self.categories = columns["categories"].tolist()
+        self.label_id = columns["label_id"].tolist()
+        self.label_category = columns["label_category"].tolist()
+        self.label_score = columns["label_score"].tolist()
+        self.has_score = columns["label_has_score"].tolist()
+        self.has_box2d = columns["label_has_box2d"].tolist()
+        self.box2d = columns["label_box2d"].tolist()
+        self.has_box3d = columns["label_has_box3d"].tolist()
+        self.box3d = columns["label_box3d"].tolist()
+        self.has_rle = columns["label_has_rle"].tolist()
+        self.rle_size = columns["label_rle_size"].tolist()
+        self.rle_counts = _unpack_strings(columns["rle_counts"], columns["rle_offsets"])
+        self.label_extra = _unpack_strings(
+            columns["label_extra"], columns["label_extra_offsets"]
+        )
+        self.dataset_extra = json.loads(
+            columns["dataset_extra"].tobytes().decode("utf-8")
+        )
+
+    def dataset(self, used_seqs=None):
+        """Restore the scalabel dataset, optionally of some sequences only.
+
+        Nested models are constructed without validation, like scalabel does
+        for validate_frames=False, from values that were validated when
+        compiling. Every call returns new objects.
+
+        Args:
+            used_seqs (list[str], optional): Sequences to keep.
+        Returns:
+            Dataset: Same annotations as parsed from the json file and
+                filtered by load_scalabel.
+        """
+        from scalabel.label.typing import Config, Dataset, FrameGroup
+
+        if used_seqs is None:
+            frame_indices = range(len(self.frame_names))
+        else:
+            selected = self.frame_has_video & np.isin(
+                self.frame_video, np.array(list(used_seqs), dtype=str)
+            )
+            frame_indices = np.flatnonzero(selected).tolist()
+        config = self.dataset_extra["config"]
+        groups = self.dataset_extra["groups"]
+        return Dataset.construct(
+            frames=[self._frame(i) for i in frame_indices],
+            groups=[FrameGroup(**group) for group in groups] if groups else None,
+            config=Config(**config) if config is not None else None,
+        )
+
+    def _frame(self, i: int):
+        from scalabel.label.typing import Extrinsics, Frame, ImageSize, Intrinsics
+
+        fields = {"name": self.frame_names[i]}
+        if self.has_video[i]:
+            fields["videoName"] = self.frame_videos[i]
+        if self.has_index[i]:
+            fields["frameIndex"] = self.frame_index[i]
+        if self.has_labels[i]:
+            fields["labels"] = [
+                self._label(j)
+                for j in range(self.label_offsets[i], self.label_offsets[i + 1])
+            ]
+        if self.frame_extra[i]:
+            extra = json.loads(self.frame_extra[i])
+            for key, model in (
+                ("intrinsics", Intrinsics),
+                ("extrinsics", Extrinsics),
+                ("size", ImageSize),
+            ):
+                if key in extra:
+                    extra[key] = model(**extra[key])
+            fields.update(extra)
+        return Frame.construct(**fields)
+
+    def _label(self, j: int):
+        from scalabel.label.typing import RLE, Box2D, Box3D, Graph, Label, Poly2D
+
+        fields = {"id": self.label_id[j]}
+        if self.label_category[j] >= 0:
+            fields["category"] = self.categories[self.label_category[j]]
+        if self.has_score[j]:
+            fields["score"] = self.label_score[j]
+        if self.has_box2d[j]:
+            x1, y1, x2, y2 = self.box2d[j]
+            fields["box2d"] = Box2D.construct(x1=x1, y1=y1, x2=x2, y2=y2)
+        if self.has_box3d[j]:
+            values = self.box3d[j]
+            fields["box3d"] = Box3D.construct(
+                alpha=values[0],
+                orientation=tuple(values[1:4]),
+                location=tuple(values[4:7]),
+                dimension=tuple(values[7:10]),
+            )
+        if self.has_rle[j]:
+            fields["rle"] = RLE.construct(
+                counts=self.rle_counts[j], size=tuple(self.rle_size[j])
+            )
+        if self.label_extra[j]:
+            extra = json.loads(self.label_extra[j])
+            if "poly2d" in extra:
+                extra["poly2d"] = [Poly2D(**poly) for poly in extra["poly2d"]]
+            if "graph" in extra:
+                extra["graph"] = Graph(**extra["graph"])
+            fields.update(extra)
+        return Label.construct(**fields)
+
+
+def annotation_path(file_path: str, key: str) -> str:
+    """Path of the compiled annotations of a ground truth json file."""
+    return os.path.join(ANNOTATION_CACHE_DIR, key, os.path.basename(file_path) + ".npz")
+
+
+def load_compiled(file_path: str, key: Optional[str]) -> CompiledAnnotations:
+    """Load ground truth annotations, compiling them on the first use.
+
+    Args:
+        file_path (str): Path to the unzipped ground truth json file.
+        key (str, optional): Key of the ground truth zip file, see
+            annotation_key. Without a key the compiled annotations are not
+            written to the cache.
+    Returns:
+        CompiledAnnotations: Compiled annotations.
+    """
+    from scalabel.label.io import load
+
+    if key is not None:
+        path = annotation_path(file_path, key)
+        if os.path.exists(path):
+            try:
+                with np.load(path) as columns:
+                    return CompiledAnnotations(dict(columns))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not read compiled annotations {path}: {e}")
+
+    columns = compile_annotations(load(file_path, validate_frames=False))
+    if key is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "wb", dir=os.path.dirname(path), suffix=".tmp", delete=False
+            ) as f:
+                np.savez(f, **columns)
+            os.replace(f.name, path)
+        except OSError as e:
+            print(f"Could not write compiled annotations {path}: {e}")
+    return CompiledAnnotations(columns)
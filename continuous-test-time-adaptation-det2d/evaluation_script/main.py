@@ -1,5 +1,4 @@
 import contextlib
-import io
 import os
 import sys
 import zipfile
@@ -9,9 +8,56 @@ import numpy as np
 
 sys.path.append(str(Path(__file__).parent.absolute()))
 
-from scalabel.eval.detect import evaluate_det
-from utils import (filer_scalabel_by_frame_id, filter_scalabel, get_used_seqs,
-                   load_scalabel, unzip_nested)
+from bootstrap import bootstrap_det
+from frame_table import FrameTableWriter, read_sequence_attributes
+from gt_cache import annotation_key
+from manifest import JsonTask, scan_submission, submission_filter
+from utils import (
+    GT_ANNOTATION_KEYS,
+    SEQ_INFO_PATH_TEST,
+    SEQ_INFO_PATH_VAL,
+    filter_scalabel,
+    get_used_seqs,
+    load_scalabel,
+    release_scalabel,
+    unzip_nested,
+)
+
+PHASE_SPLITS = {"dev": "val", "test": "test"}
+SUBMISSION_TASKS = [JsonTask("det_2d.json")]
+# Unzipped ground truth folders, by ground truth zip file
+GT_CACHE = {}
+GT_JSON_FILES = ["det_2d.json"]
+# Frame id ranges of the source, target and loop back windows
+FRAME_WINDOWS = {
+    "mAP_source": (0, 20),
+    "mAP_target": (180, 220),
+    "mAP_loop_back": (380, 400),
+}
+
+
+def window_units(gt_frames, pred_frames):
+    """
+    Ground truth and prediction indices of all frames and of each frame
+    window, like filer_scalabel_by_frame_id, as units of match_frames or
+    match_units
+
+    Args:
+        gt_frames: ground truth frames
+        pred_frames: predicted frames
+    """
+    units = {"mAP": (list(range(len(gt_frames))), list(range(len(pred_frames))))}
+    for metric, (frame_id_start, frame_id_end) in FRAME_WINDOWS.items():
+        units[metric] = tuple(
+            [
+                i
+                for i, frame in enumerate(frames)
+                if frame.frameIndex >= frame_id_start
+                and frame.frameIndex <= frame_id_end
+            ]
+            for frames in (gt_frames, pred_frames)
+        )
+    return units
 
 
 def evaluate_shift_multitask(
@@ -19,6 +65,9 @@ def evaluate_shift_multitask(
     user_submission_dir: str,
     max_num_seqs: int = -1,
     phase: str = "val",
+    seq_subset=None,
+    det_state=None,
+    frame_table=None,
 ):
     """
     Evaluate SHIFT multitask challenge submission
@@ -29,8 +78,15 @@ def evaluate_shift_multitask(
         max_num_seqs: maximum number of sequences to evaluate. If -1, evaluate 
             all sequences
         phase: val or test
+        seq_subset: if given, only the sequences in it are evaluated
+        det_state: if given, filled with the matched detections of all frames
+            and windows, see det2d_eval.match_frames
+        frame_table: if given, a FrameTableWriter the detection match counts
+            of each frame are appended to, see det2d_eval.frame_match_counts
     """
     used_seqs = get_used_seqs(split=phase)
+    if seq_subset is not None:
+        used_seqs = [seq for seq in used_seqs if seq in seq_subset]
     if max_num_seqs > 0 and max_num_seqs < len(used_seqs):
         used_seqs = used_seqs[:max_num_seqs]
 
@@ -38,6 +94,8 @@ def evaluate_shift_multitask(
 
     # Object detection
     if os.path.exists(os.path.join(user_submission_dir, "det_2d.json")):
+        from det2d_eval import frame_match_counts, match_frames, unit_scores
+
         print(">> Evaluating object detection...")
         det_pred = load_scalabel(
             os.path.join(user_submission_dir, "det_2d.json"), used_seqs
@@ -46,57 +104,62 @@ def evaluate_shift_multitask(
             os.path.join(test_annotation_dir, "det_2d.json"), used_seqs
         )
         det_pred = filter_scalabel(det_pred, det_target)
-        with contextlib.redirect_stdout(io.StringIO()):
-            result_all = evaluate_det(
-                det_target.frames,
-                det_pred.frames,
-                det_target.config,
-                nproc=1,
-            )
-        result_all = result_all.summary()
-        result_dict["mAP"] = result_all["AP"]
-
-        det_target_start = filer_scalabel_by_frame_id(det_target.copy(), 0, 20)
-        det_target_end = filer_scalabel_by_frame_id(det_target.copy(), 180, 220)
-        det_target_loop_back = filer_scalabel_by_frame_id(det_target.copy(), 380, 400)
-        det_pred_start = filer_scalabel_by_frame_id(det_pred.copy(), 0, 20)
-        det_pred_end = filer_scalabel_by_frame_id(det_pred.copy(), 180, 220)
-        det_pred_loop_back = filer_scalabel_by_frame_id(det_pred.copy(), 380, 400)
-        with contextlib.redirect_stdout(io.StringIO()):
-            result_start = evaluate_det(
-                det_target_start.frames,
-                det_pred_start.frames,
-                det_target.config,
-                nproc=1,
-            )
-        result_start = result_start.summary()
-        result_dict["mAP_source"] = result_start["AP"]
-
-        with contextlib.redirect_stdout(io.StringIO()):
-            result_end = evaluate_det(
-                det_target_end.frames,
-                det_pred_end.frames,
-                det_target.config,
-                nproc=1,
-            )
-        result_end = result_end.summary()
-        result_dict["mAP_target"] = result_end["AP"]
-
-        with contextlib.redirect_stdout(io.StringIO()):
-            result_loop_back = evaluate_det(
-                det_target_loop_back.frames,
-                det_pred_loop_back.frames,
-                det_target.config,
-                nproc=1,
-            )
-        result_loop_back = result_loop_back.summary()
-        result_dict["mAP_loop_back"] = result_loop_back["AP"]
+        # Native matching of all frames and windows at once, see det2d_eval.py
+        state = match_frames(
+            det_target.frames,
+            det_pred.frames,
+            window_units(det_target.frames, det_pred.frames),
+            det_target.config,
+        )
+        result_dict.update(unit_scores(state))
+        if det_state is not None:
+            det_state.update(state)
+        if frame_table is not None:
+            counts = frame_match_counts(state, "mAP")
+            frame_table.append(frame_rows(det_target.frames, counts))
         result_dict["mAP_drop"] = result_dict["mAP_source"] - result_dict["mAP_target"]
         print(">> Object detection results:\n", result_dict)
     return result_dict
 
 
-def evaluate_shift(test_annotation_dir, user_submission_dir, phase="val"):
+def frame_rows(gt_frames, counts):
+    """
+    Rows of the frame table of the detection match counts of frames, with
+    the frame window of each frame, see FRAME_WINDOWS
+
+    Args:
+        gt_frames: ground truth frames
+        counts: match counts of frames, see det2d_eval.frame_match_counts
+    """
+    frames = [gt_frames[i] for i in counts["frame"]]
+    windows = [
+        next(
+            (
+                metric
+                for metric, (frame_id_start, frame_id_end) in FRAME_WINDOWS.items()
+                if frame.frameIndex >= frame_id_start
+                and frame.frameIndex <= frame_id_end
+            ),
+            None,
+        )
+        for frame in frames
+    ]
+    return {
+        "sequence": [frame.videoName for frame in frames],
+        "frame": [frame.frameIndex for frame in frames],
+        "window": windows,
+        **{name: values for name, values in counts.items() if name != "frame"},
+    }
+
+
+def evaluate_shift(
+    test_annotation_dir,
+    user_submission_dir,
+    phase="val",
+    seq_subset=None,
+    intervals=None,
+    frame_table=None,
+):
     """
     Evaluate SHIFT challenge submission
 
@@ -104,15 +167,66 @@ def evaluate_shift(test_annotation_dir, user_submission_dir, phase="val"):
         test_annotation_dir: directory of the test annotation
         user_submission_dir: directory of the user submission
         phase: val or test
+        seq_subset: if given, only the sequences in it are evaluated
+        intervals: if given, filled with the bootstrap confidence interval of
+            each score over the sequences, see bootstrap.py
+        frame_table: if given, folder of a table of the detection match
+            counts of each frame, with the sequence attributes, see
+            frame_table.py
     """
+    det_state = {} if intervals is not None else None
+    if frame_table is not None:
+        seq_info_path = SEQ_INFO_PATH_VAL if phase == "val" else SEQ_INFO_PATH_TEST
+        writer = FrameTableWriter(frame_table, read_sequence_attributes(seq_info_path))
+    else:
+        writer = contextlib.nullcontext()
     result_dict = {}
-    result_dict = evaluate_shift_multitask(
-        test_annotation_dir, user_submission_dir, -1, phase=phase
-    )
-    result_dict["overall"] = result_dict["mAP"] - 2 * result_dict["mAP_drop"]
+    with writer as table:
+        result_dict = evaluate_shift_multitask(
+            test_annotation_dir,
+            user_submission_dir,
+            -1,
+            phase=phase,
+            seq_subset=seq_subset,
+            det_state=det_state,
+            frame_table=table,
+        )
+    add_overall_metric(result_dict)
+    if intervals is not None and det_state:
+        intervals.update(bootstrap_det(det_state))
     return result_dict
 
 
+def add_overall_metric(result_dict):
+    result_dict["overall"] = result_dict["mAP"] - 2 * result_dict["mAP_drop"]
+
+
+def prepare_ground_truth(test_annotation_file, preload=False):
+    """
+    Unzip the ground truth once per process, with the json annotations
+    loaded from the compiled annotation cache
+
+    Args:
+        test_annotation_file: path to the ground truth zip file
+        preload: also parse the ground truth json files into the scalabel
+            cache, for long-lived processes
+    """
+    if test_annotation_file not in GT_CACHE:
+        unzip_nested(test_annotation_file)
+        GT_CACHE[test_annotation_file] = test_annotation_file[:-4]
+        key = annotation_key(test_annotation_file)
+        for filename in GT_JSON_FILES:
+            file_path = os.path.join(GT_CACHE[test_annotation_file], filename)
+            GT_ANNOTATION_KEYS[file_path] = key
+    test_annotation_dir = GT_CACHE[test_annotation_file]
+    if preload:
+        for filename in GT_JSON_FILES:
+            file_path = os.path.join(test_annotation_dir, filename)
+            if os.path.exists(file_path):
+                load_scalabel(file_path)
+    return test_annotation_dir
+
+
 def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwargs):
     """
     Evaluates the submission for a particular challenge phase and returns score
@@ -125,7 +239,10 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
         `**kwargs`: keyword arguments that contains additional submission
         metadata that challenge hosts can use to send slack notification.
         You can access the submission metadata
-        with kwargs['submission_metadata']
+        with kwargs['submission_metadata']. A folder in kwargs['frame_table']
+        receives a table of the per-frame results, see frame_table.py. If
+        kwargs['confidence_intervals'] is set, the output also holds the 95%
+        bootstrap confidence interval of each score, see bootstrap.py.
 
         Example: A sample submission metadata can be accessed like this:
         >>> print(kwargs['submission_metadata'])
@@ -162,32 +279,65 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
         user_submission_file[-4:] == ".zip"
     ), "User submission file should be a zip file"
 
+    # Reject obviously broken submissions before unzipping and evaluation
+    keep = None
+    if phase_codename in PHASE_SPLITS:
+        print("Scanning submission...")
+        used_seqs = get_used_seqs(split=PHASE_SPLITS[phase_codename])
+        report = scan_submission(
+            user_submission_file, test_annotation_file, SUBMISSION_TASKS, used_seqs
+        )
+        print(report)
+        assert report.ok, "Submission rejected: {}".format(
+            "; ".join(report.fatal_errors)
+        )
+
+        # Only the files of the used sequences are extracted
+        keep = submission_filter(SUBMISSION_TASKS, used_seqs)
+
     # Unzip the annotation files
     print("Start unzipping...")
     user_submission_dir = user_submission_file[:-4]
-    unzip_nested(user_submission_file)
-    test_annotation_dir = test_annotation_file[:-4]
-    unzip_nested(test_annotation_file)
+    unzip_nested(user_submission_file, keep)
+    test_annotation_dir = prepare_ground_truth(test_annotation_file)
     print("Unzipping completed.")
 
     output = {}
+    intervals = {} if kwargs.get("confidence_intervals") else None
     if phase_codename == "dev":
         print("Evaluation phase: Dev")
         result_dict = evaluate_shift(
-            test_annotation_dir, user_submission_dir, phase="val"
+            test_annotation_dir,
+            user_submission_dir,
+            phase="val",
+            intervals=intervals,
+            frame_table=kwargs.get("frame_table"),
         )
         output["result"] = [{"val_split": result_dict}]
         output["submission_result"] = output["result"][0]["val_split"]
+        if intervals is not None:
+            # 95% bootstrap confidence intervals, next to the scores
+            output["confidence_intervals"] = intervals
+            print("Confidence intervals:", intervals)
         print("Completed evaluation for Dev Phase")
         print(result_dict)
     elif phase_codename == "test":
         print("Evaluation phase: Test")
         result_dict = evaluate_shift(
-            test_annotation_dir, user_submission_dir, phase="test"
+            test_annotation_dir,
+            user_submission_dir,
+            phase="test",
+            intervals=intervals,
+            frame_table=kwargs.get("frame_table"),
         )
         output["result"] = [{"test_split": result_dict}]
         output["submission_result"] = output["result"][0]["test_split"]
+        if intervals is not None:
+            # 95% bootstrap confidence intervals, next to the scores
+            output["confidence_intervals"] = intervals
+            print("Confidence intervals:", intervals)
         print("Completed evaluation for Test Phase")
+    release_scalabel(user_submission_dir)
     return output
 
 
@@ -0,0 +1,545 @@
+"""Submission manifest scan.
+
+Lists a submission (zip central directory or folder tree) against the ground
+truth frame list of the used sequences before any heavy evaluation runs. Image
+frames are checked on their headers only (size and mode), and per-sequence
+prediction stacks on their array headers (shape and dtype), so obviously
+broken submissions are rejected within seconds.
+"""
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Maximum number of example errors kept per task in the report.
+MAX_REPORTED_ERRORS = 10
+
+# Relative paths of the ground truth files, by gt path
+GT_FILE_CACHE = {}
+# (videoName, name) keys of the ground truth json files, by (gt path, file name)
+GT_FRAME_KEY_CACHE = {}
+# Frame size of the ground truth image folders, by (gt path, folder)
+GT_FRAME_SIZE_CACHE = {}
+# Size of the chunks nested zip files are copied and json files decoded in
+CHUNK_SIZE = 1 << 20
+
+
+class ImageTask:
+    """A task submitted as a folder of per-frame images."""
+
+    def __init__(
+        self, folder: str, modes: tuple[str, ...], stack_dtypes: tuple[str, ...] = ()
+    ) -> None:
+        """Initialize the task.
+
+        Args:
+            folder (str): Folder of the task, e.g. "depth".
+            modes (tuple[str, ...]): Accepted PIL image modes.
+            stack_dtypes (tuple[str, ...]): Accepted dtypes of per-sequence
+                .npy or .npz prediction stacks, none if empty.
+        """
+        self.name = folder
+        self.folder = folder
+        self.modes = modes
+        self.stack_dtypes = stack_dtypes
+
+
+class JsonTask:
+    """A task submitted as a single scalabel json file."""
+
+    def __init__(self, filename: str) -> None:
+        """Initialize the task.
+
+        Args:
+            filename (str): Name of the json file, e.g. "det_2d.json".
+        """
+        self.name = filename
+        self.filename = filename
+
+
+class ManifestReport:
+    """Coverage and format errors of a submission, per task."""
+
+    def __init__(self) -> None:
+        """Initialize an empty report."""
+        self.tasks: Dict[str, Dict] = {}
+        self.fatal_errors: List[str] = []
+
+    @property
+    def ok(self) -> bool:
+        """Whether the submission can be evaluated."""
+        return len(self.fatal_errors) == 0
+
+    def add_task(
+        self,
+        name: str,
+        expected: int,
+        present: int,
+        errors: List[str],
+        invalid: Optional[int] = None,
+    ) -> None:
+        """Record the scan result of a task.
+
+        Args:
+            name (str): Name of the task.
+            expected (int): Number of ground truth frames.
+            present (int): Number of submitted frames matching the ground truth.
+            errors (list[str]): Format errors of submitted frames.
+            invalid (int, optional): Number of invalid frames, if an error
+                covers several frames. Defaults to the number of errors.
+        """
+        if invalid is None:
+            invalid = len(errors)
+        valid = present - invalid
+        self.tasks[name] = {
+            "expected": expected,
+            "present": present,
+            "missing": expected - present,
+            "invalid": invalid,
+            "coverage": valid / expected if expected > 0 else float("nan"),
+            "errors": errors[:MAX_REPORTED_ERRORS],
+        }
+        if expected > 0 and valid == 0:
+            self.fatal_errors.append(f"{name}: no valid frame found")
+
+    def __str__(self) -> str:
+        """Human readable summary of the report."""
+        lines = []
+        for name, task in self.tasks.items():
+            lines.append(
+                f" - {name}: {task['present']}/{task['expected']} "
+                f"frames present, {task['invalid']} invalid "
+                f"(coverage {task['coverage'] * 100:.1f}%)"
+            )
+            for error in task["errors"]:
+                lines.append(f"     {error}")
+        for error in self.fatal_errors:
+            lines.append(f" ! {error}")
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def list_files(path: str) -> Iterator[Dict[str, Callable]]:
+    """List the files of a zip file or a folder.
+
+    Nested zip files at the root of the archive are listed as if they were
+    extracted into a folder of the same name, like unzip_nested does. The zip
+    files stay open until the with block is left.
+
+    Args:
+        path (str): Path to a zip file or a folder.
+    Yields:
+        dict[str, Callable]: Relative file path to a function opening the file
+            in binary mode.
+    """
+    if os.path.isdir(path):
+        files = {}
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                full_path = os.path.join(root, filename)
+                rel_path = os.path.relpath(full_path, path).replace(os.sep, "/")
+                files[rel_path] = partial(open, full_path, "rb")
+        yield files
+        return
+    with contextlib.ExitStack() as stack:
+        zip_ref = stack.enter_context(zipfile.ZipFile(path, "r"))
+        yield _list_zip(zip_ref, stack)
+
+
+def _list_zip(
+    zip_ref: zipfile.ZipFile, stack: contextlib.ExitStack, prefix: str = ""
+) -> Dict[str, Callable]:
+    files = {}
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        if "/" not in info.filename and info.filename.endswith(".zip"):
+            # Spilled to a temporary file once: a zip file read from a member
+            # of another is seeked through its compressed stream, which
+            # restarts decompression at every backward seek
+            spill = stack.enter_context(tempfile.TemporaryFile())
+            with zip_ref.open(info) as member:
+                shutil.copyfileobj(member, spill, CHUNK_SIZE)
+            nested = stack.enter_context(zipfile.ZipFile(spill, "r"))
+            files.update(_list_zip(nested, stack, prefix + info.filename[:-4] + "/"))
+        else:
+            files[prefix + info.filename] = partial(zip_ref.open, info)
+    return files
+
+
+def _list_gt_files(gt_path: str, tasks: list) -> frozenset:
+    # Relative paths of the ground truth files, with the frame keys of the
+    # json files and the frame size of the image folders of the tasks, read
+    # once per gt path: the daemon scans every submission against the same
+    # ground truth
+    missing = [
+        task
+        for task in tasks
+        if (
+            isinstance(task, JsonTask)
+            and (gt_path, task.name) not in GT_FRAME_KEY_CACHE
+        )
+        or (
+            isinstance(task, ImageTask)
+            and (gt_path, task.name) not in GT_FRAME_SIZE_CACHE
+        )
+    ]
+    if gt_path in GT_FILE_CACHE and not missing:
+        return GT_FILE_CACHE[gt_path]
+    with list_files(gt_path) as gt_files:
+        GT_FILE_CACHE[gt_path] = frozenset(gt_files)
+        for task in missing:
+            if isinstance(task, JsonTask):
+                GT_FRAME_KEY_CACHE[gt_path, task.name] = (
+                    _load_frame_keys(gt_files[task.filename])
+                    if task.filename in gt_files
+                    else None
+                )
+                continue
+            first = next(
+                (path for path in gt_files if _seq_of(path, task.folder) is not None),
+                None,
+            )
+            GT_FRAME_SIZE_CACHE[gt_path, task.name] = (
+                _read_image_header(gt_files[first])[0] if first is not None else None
+            )
+    return GT_FILE_CACHE[gt_path]
+
+
+def _read_image_header(opener: Callable) -> tuple[tuple[int, int], str]:
+    from PIL import Image
+
+    with opener() as f:
+        image = Image.open(f)
+        return image.size, image.mode
+
+
+def _check_image(
+    rel_path: str, opener: Callable, size: tuple[int, int], modes: tuple[str, ...]
+) -> Optional[str]:
+    try:
+        frame_size, mode = _read_image_header(opener)
+    except Exception as e:
+        return f"{rel_path}: unreadable image ({e})"
+    if frame_size != size:
+        return f"{rel_path}: size {frame_size} does not match {size}"
+    if mode not in modes:
+        return f"{rel_path}: unsupported mode {mode}"
+    return None
+
+
+def _read_stack_header(rel_path: str, opener: Callable) -> tuple:
+    # Shape, dtype and frame names of a prediction stack, from its headers
+    import numpy as np
+
+    def read_header(f):
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(f)
+        return np.lib.format.read_array_header_2_0(f)
+
+    with opener() as f:
+        if rel_path.endswith(".npy"):
+            shape, _, dtype = read_header(f)
+            return shape, dtype, None
+        with zipfile.ZipFile(f, "r") as npz:
+            with npz.open("data.npy") as data:
+                shape, _, dtype = read_header(data)
+            frames = None
+            if "frames.npy" in npz.namelist():
+                with npz.open("frames.npy") as names:
+                    frames = np.lib.format.read_array(names, allow_pickle=False)
+                frames = frames.tolist()
+            return shape, dtype, frames
+
+
+def _check_stack(
+    rel_path: str,
+    opener: Callable,
+    frame_names: List[str],
+    size: tuple[int, int],
+    dtypes: tuple[str, ...],
+) -> tuple[set, Optional[str]]:
+    # Ground truth frames covered by a prediction stack, and its format error
+    try:
+        shape, dtype, frames = _read_stack_header(rel_path, opener)
+    except Exception as e:
+        return set(frame_names), f"{rel_path}: unreadable stack ({e})"
+    if frames is None:
+        frames = frame_names
+    covered = set(frames) & set(frame_names)
+    width, height = size
+    if len(shape) != 3 or shape[0] != len(frames) or shape[1:] != (height, width):
+        return covered, (
+            f"{rel_path}: shape {shape} does not match "
+            f"({len(frames)}, {height}, {width})"
+        )
+    if dtype.name not in dtypes:
+        return covered, f"{rel_path}: unsupported dtype {dtype.name}"
+    return covered, None
+
+
+def _stack_seq_of(rel_path: str, folder: str) -> Optional[str]:
+    parts = rel_path.split("/")
+    if len(parts) != 2 or parts[0] != folder:
+        return None
+    for ext in (".npy", ".npz"):
+        if parts[1].endswith(ext):
+            return parts[1][: -len(ext)]
+    return None
+
+
+def _seq_of(rel_path: str, folder: str) -> Optional[str]:
+    parts = rel_path.split("/")
+    if len(parts) != 3 or parts[0] != folder or not parts[2].endswith(".png"):
+        return None
+    return parts[1]
+
+
+class _JsonStream:
+    # Values of a json file decoded one at a time from chunks of the file
+
+    _whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, f) -> None:
+        self.reader = io.TextIOWrapper(f, encoding="utf-8")
+        self.decoder = json.JSONDecoder()
+        self.buf, self.pos, self.eof = "", 0, False
+
+    def _fill(self) -> bool:
+        chunk = self.reader.read(CHUNK_SIZE)
+        self.buf, self.pos = self.buf[self.pos :] + chunk, 0
+        self.eof = not chunk
+        return not self.eof
+
+    def peek(self) -> str:
+        # Next character after whitespace, empty at the end of the file
+        while True:
+            self.pos = self._whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos : self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"expected one of {chars!r} at {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the chunk may continue in the next one
+            if end < len(self.buf) or self.eof or not self._fill():
+                self.pos = end
+                return value
+
+    def array(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def _iter_frames(opener: Callable):
+    # Frames of a scalabel json file, a list of frames or a dict with a
+    # "frames" list, without holding the whole file in memory
+    with opener() as f:
+        stream = _JsonStream(f)
+        if stream.peek() != "{":
+            yield from stream.array()
+            return
+        stream.expect("{")
+        found = False
+        while stream.peek() != "}":
+            key = stream.value()
+            stream.expect(":")
+            if key == "frames":
+                found = True
+                yield from stream.array()
+            else:
+                stream.value()
+            if stream.expect(",}") == "}":
+                break
+        if not found:
+            raise KeyError("frames")
+
+
+def _load_frame_keys(opener: Callable) -> set:
+    return set(
+        (frame.get("videoName"), frame["name"]) for frame in _iter_frames(opener)
+    )
+
+
+def _scan_image_task(report, task, pred_files, gt_files, gt_path, used_seqs, pool):
+    gt_frames = [
+        rel_path for rel_path in gt_files if _seq_of(rel_path, task.folder) in used_seqs
+    ]
+    if not gt_frames:
+        return
+    size = GT_FRAME_SIZE_CACHE[gt_path, task.name]
+
+    # Sequences predicted by a stack instead of png files
+    stacks = {}
+    if task.stack_dtypes:
+        for rel_path in pred_files:
+            seq_name = _stack_seq_of(rel_path, task.folder)
+            # A .npy stack is used over a .npz stack, like find_stack
+            if seq_name in used_seqs and (
+                seq_name not in stacks or rel_path.endswith(".npy")
+            ):
+                stacks[seq_name] = rel_path
+    seq_frames: Dict[str, List[str]] = {}
+    for rel_path in gt_frames:
+        seq_frames.setdefault(_seq_of(rel_path, task.folder), []).append(
+            rel_path.split("/")[2]
+        )
+    errors, num_present, num_invalid = [], 0, 0
+    for seq_name, rel_path in sorted(stacks.items()):
+        covered, error = _check_stack(
+            rel_path,
+            pred_files[rel_path],
+            sorted(seq_frames.get(seq_name, [])),
+            size,
+            task.stack_dtypes,
+        )
+        num_present += len(covered)
+        if error is not None:
+            errors.append(error)
+            num_invalid += len(covered)
+
+    present = [
+        rel_path
+        for rel_path in gt_frames
+        if rel_path in pred_files and _seq_of(rel_path, task.folder) not in stacks
+    ]
+    results = pool.map(
+        lambda rel_path: _check_image(rel_path, pred_files[rel_path], size, task.modes),
+        present,
+    )
+    image_errors = [error for error in results if error is not None]
+    report.add_task(
+        task.name,
+        len(gt_frames),
+        num_present + len(present),
+        errors + image_errors,
+        num_invalid + len(image_errors),
+    )
+
+
+def _scan_json_task(report, task, pred_files, gt_path, used_seqs):
+    gt_frame_keys = GT_FRAME_KEY_CACHE[gt_path, task.name]
+    if gt_frame_keys is None:
+        return
+    try:
+        pred_keys = _load_frame_keys(pred_files[task.filename])
+    except Exception as e:
+        report.fatal_errors.append(f"{task.name}: unreadable json ({e})")
+        return
+    expected = [key for key in gt_frame_keys if key[0] in used_seqs]
+    present = [key for key in expected if key in pred_keys]
+    report.add_task(task.name, len(expected), len(present), [])
+
+
+def scan_submission(
+    submission_path: str,
+    gt_path: str,
+    tasks: list,
+    used_seqs: List[str],
+    num_workers: int = 16,
+) -> ManifestReport:
+    """Scan a submission against the ground truth frame list.
+
+    Args:
+        submission_path (str): Path to the submission zip file or folder.
+        gt_path (str): Path to the ground truth zip file or folder.
+        tasks (list): ImageTask and JsonTask instances of the challenge.
+        used_seqs (list[str]): Sequences evaluated in the current phase.
+        num_workers (int): Number of threads for the header checks.
+    Returns:
+        ManifestReport: Coverage and format errors of the submission.
+    """
+    with list_files(submission_path) as pred_files:
+        return _scan_files(pred_files, gt_path, tasks, set(used_seqs), num_workers)
+
+
+def _scan_files(pred_files, gt_path, tasks, used_seqs, num_workers):
+    report = ManifestReport()
+    submitted = [
+        task
+        for task in tasks
+        if (isinstance(task, JsonTask) and task.filename in pred_files)
+        or (
+            isinstance(task, ImageTask)
+            and any(rel_path.startswith(task.folder + "/") for rel_path in pred_files)
+        )
+    ]
+    if not submitted:
+        report.fatal_errors.append(
+            "no known task found, expected one of "
+            + ", ".join(task.name for task in tasks)
+        )
+        return report
+
+    gt_files = _list_gt_files(gt_path, submitted)
+    with ThreadPoolExecutor(num_workers) as pool:
+        futures = [
+            pool.submit(_scan_json_task, report, task, pred_files, gt_path, used_seqs)
+            for task in submitted
+            if isinstance(task, JsonTask)
+        ]
+        for task in submitted:
+            if isinstance(task, ImageTask):
+                _scan_image_task(
+                    report, task, pred_files, gt_files, gt_path, used_seqs, pool
+                )
+        for future in futures:
+            future.result()
+    return report
+
+
+def submission_filter(tasks: list, used_seqs: List[str]) -> Callable[[str], bool]:
+    """Filter of the submission files read by the evaluation.
+
+    Args:
+        tasks (list): ImageTask and JsonTask instances of the challenge.
+        used_seqs (list[str]): Sequences evaluated in the current phase.
+    Returns:
+        Callable[[str], bool]: Whether a relative file path, as listed by
+            list_files, is needed: a json file of a task, or a png file or a
+            prediction stack of a used sequence in an image task folder.
+    """
+    used_seqs = set(used_seqs)
+    filenames = {task.filename for task in tasks if isinstance(task, JsonTask)}
+    image_tasks = [task for task in tasks if isinstance(task, ImageTask)]
+
+    def keep(rel_path: str) -> bool:
+        if rel_path in filenames:
+            return True
+        for task in image_tasks:
+            if _seq_of(rel_path, task.folder) in used_seqs:
+                return True
+            if task.stack_dtypes and _stack_seq_of(rel_path, task.folder) in used_seqs:
+                return True
+        return False
+
+    return keep
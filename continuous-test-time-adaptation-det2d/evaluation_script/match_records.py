@@ -0,0 +1,381 @@
+"""Per-image COCO match records for sharded detection evaluation.
+
+COCOeval matches the detections of every (image, category, area range) on its
+own and only combines these per-image records when accumulating, in the order
+of the image ids. scalabel assigns the image ids after a stable sort of the
+ground truth frames by name, so a shard can compute the records of its frames
+together with their global image positions, and a reducer can accumulate the
+records of all shards with the same result as a single evaluation.
+"""
+from __future__ import annotations
+
+import contextlib
+import copy
+import io
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scalabel.eval.detect import COCOV2, COCOevalV2, DetResult
+from scalabel.eval.utils import check_overlap
+from scalabel.label.to_coco import scalabel2coco_detection, scalabel2coco_ins_seg
+from scalabel.label.typing import Config, Frame
+
+# Fields of the COCOeval per-image records used by accumulate
+RECORD_FIELDS = ["dtScores", "dtMatches", "dtIgnore", "gtIgnore"]
+# Detections of each image and category evaluated by COCOeval
+MAX_DETS = 100
+
+
+def image_positions(gt_frames: Sequence[Frame]) -> List[int]:
+    """Image position of each ground truth frame in a scalabel evaluation.
+
+    Args:
+        gt_frames (list[Frame]): Ground truth frames in file order.
+    Returns:
+        list[int]: Position of each frame after the stable sort by name.
+    """
+    order = sorted(range(len(gt_frames)), key=lambda i: gt_frames[i].name)
+    positions = [0] * len(gt_frames)
+    for position, i in enumerate(order):
+        positions[i] = position
+    return positions
+
+
+def assign_preds(
+    gt_frames: Sequence[Frame],
+    pred_frames: Sequence[Frame],
+    use_video: Optional[bool] = None,
+) -> List[Optional[int]]:
+    """Assign predictions to ground truth frames like reorder_preds.
+
+    Frames are matched by name, or by video and name if the prediction names
+    are not unique and all frames have a video name.
+
+    Args:
+        gt_frames (list[Frame]): Ground truth frames.
+        pred_frames (list[Frame]): Predicted frames.
+        use_video (bool, optional): Whether to match by video and name, None
+            to decide from the predicted frames as above.
+    Returns:
+        list[int | None]: Index of the predicted frame of each ground truth
+            frame, or None if it is missing.
+    """
+    if use_video is None:
+        pred_names = [frame.name for frame in pred_frames]
+        use_video = False
+        if len(pred_names) != len(set(pred_names)):
+            use_video = all(frame.videoName for frame in pred_frames) and all(
+                frame.videoName for frame in gt_frames
+            )
+
+    def name_of(frame: Frame) -> str:
+        if use_video:
+            return f"{frame.videoName}/{frame.name}"
+        return frame.name
+
+    pred_map = {name_of(frame): i for i, frame in enumerate(pred_frames)}
+    return [pred_map.get(name_of(frame)) for frame in gt_frames]
+
+
+def top_predictions(
+    frames: Sequence[Frame], iou_type: str = "bbox", max_dets: int = MAX_DETS
+) -> List[Frame]:
+    """Drop the predictions that cannot count in a COCO evaluation.
+
+    COCOeval only evaluates the max_dets best detections of each image and
+    category, after a stable sort by decreasing score, so the labels after
+    them are dropped before any conversion or decoding, with the same result.
+    Labels without the geometry of the evaluation are left untouched, and so
+    are categories with a missing score.
+
+    Args:
+        frames (list[Frame]): Predicted frames.
+        iou_type (str): "bbox" for detection, "segm" for instance segmentation.
+        max_dets (int): Detections evaluated per image and category.
+    Returns:
+        list[Frame]: The frames, copied if any of their labels are dropped.
+    """
+    pruned = []
+    for frame in frames:
+        groups: Dict[str, List[int]] = {}
+        for i, label in enumerate(frame.labels or []):
+            if iou_type == "segm":
+                evaluated = label.rle is not None or label.poly2d is not None
+            else:
+                evaluated = label.box2d is not None
+            if evaluated:
+                groups.setdefault(label.category, []).append(i)
+        dropped = set()
+        for indices in groups.values():
+            scores = [frame.labels[i].score for i in indices]
+            if len(indices) <= max_dets or None in scores:
+                continue
+            order = np.argsort(-np.array(scores), kind="mergesort")
+            dropped.update(indices[i] for i in order[max_dets:])
+        if dropped:
+            frame = frame.copy()
+            frame.labels = [
+                label for i, label in enumerate(frame.labels) if i not in dropped
+            ]
+        pruned.append(frame)
+    return pruned
+
+
+def match_images(
+    pairs: List[Tuple[Frame, Optional[Frame]]],
+    config: Config,
+    iou_type: str = "bbox",
+    evaluator: type = COCOevalV2,
+) -> Dict:
+    """Compute the COCOeval per-image records of (ground truth, prediction) pairs.
+
+    Args:
+        pairs (list[tuple[Frame, Frame | None]]): Ground truth frames and their
+            assigned predicted frames, None for a missing prediction.
+        config (Config): Dataset config.
+        iou_type (str): "bbox" for detection, "segm" for instance segmentation.
+        evaluator (type): COCOevalV2 or a subclass with the same results.
+    Returns:
+        dict: "records", a tuple of (category, area range) records per pair,
+            "num_preds" and "gt_cat_ids" per pair, and the "categories",
+            "cat_ids" and "cat_names" of the evaluation.
+    """
+    gt_frames = [gt_frame for gt_frame, _ in pairs]
+    pred_frames = []
+    for gt_frame, pred_frame in pairs:
+        if pred_frame is None:
+            pred_frame = gt_frame.copy()
+            pred_frame.labels = None
+        pred_frames.append(pred_frame)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if iou_type == "segm":
+            gt_coco = scalabel2coco_ins_seg(gt_frames, config)
+            gt_coco["annotations"] = [
+                ann for ann in gt_coco["annotations"] if "segmentation" in ann
+            ]
+            check_overlap(pred_frames, config, nproc=1)
+            pred_frames = top_predictions(pred_frames, iou_type)
+            pred_res = scalabel2coco_ins_seg(pred_frames, config)["annotations"]
+            for ann in pred_res:
+                ann.pop("bbox", None)
+        else:
+            gt_coco = scalabel2coco_detection(gt_frames, config)
+            pred_frames = top_predictions(pred_frames, iou_type)
+            pred_res = scalabel2coco_detection(pred_frames, config)["annotations"]
+        coco_gt = COCOV2(None, gt_coco)
+        if pred_res:
+            coco_dt = coco_gt.loadRes(pred_res)
+        else:
+            coco_dt = COCOV2(None, dict(gt_coco, annotations=[]))
+
+        cat_ids = coco_dt.getCatIds()
+        cat_names = [cat["name"] for cat in coco_dt.loadCats(cat_ids)]
+        img_ids = sorted(coco_gt.getImgIds())
+        coco_eval = evaluator(cat_names, coco_gt, coco_dt, iou_type, nproc=1)
+        coco_eval.params.imgIds = img_ids
+        coco_eval.evaluate()
+
+    num_images = len(img_ids)
+    num_areas = len(coco_eval.params.areaRng)
+    num_cats = len(coco_eval.params.catIds)
+    records = [
+        tuple(
+            _strip(coco_eval.evalImgs[(k * num_areas + a) * num_images + i])
+            for k in range(num_cats)
+            for a in range(num_areas)
+        )
+        for i in range(num_images)
+    ]
+    num_preds = [0] * num_images
+    for ann in pred_res:
+        num_preds[ann["image_id"] - 1] += 1
+    gt_cat_ids = [set() for _ in range(num_images)]
+    for ann in gt_coco["annotations"]:
+        gt_cat_ids[ann["image_id"] - 1].add(ann["category_id"])
+    return {
+        "records": records,
+        "num_preds": num_preds,
+        "gt_cat_ids": gt_cat_ids,
+        "cat_ids": [int(cat_id) for cat_id in coco_eval.params.catIds],
+        "cat_names": cat_names,
+        "categories": list(coco_gt.cats.values()),
+    }
+
+
+def _strip(record: Optional[Dict]) -> Optional[Dict]:
+    if record is None:
+        return None
+    return {field: record[field] for field in RECORD_FIELDS}
+
+
+def accumulate_records(
+    records: List[Tuple[Optional[Dict], ...]],
+    num_preds: int,
+    gt_cat_ids: set,
+    categories: List[Dict],
+    cat_ids: List[int],
+    cat_names: List[str],
+    iou_type: str = "bbox",
+) -> DetResult:
+    """Accumulate per-image records into the scalabel detection result.
+
+    Args:
+        records (list[tuple]): Records of all images, in image order.
+        num_preds (int): Number of predicted annotations of all images.
+        gt_cat_ids (set): Categories of all ground truth annotations.
+        categories (list[dict]): COCO categories of the evaluation.
+        cat_ids (list[int]): Category ids of the evaluation.
+        cat_names (list[str]): Category names of the evaluation.
+        iou_type (str): "bbox" for detection, "segm" for instance segmentation.
+    Returns:
+        DetResult: Same result as evaluate_det or evaluate_ins_seg.
+    """
+    if num_preds == 0:
+        coco_gt = SimpleNamespace(
+            cats={cat["id"]: cat for cat in categories},
+            anns={i: {"category_id": cat_id} for i, cat_id in enumerate(gt_cat_ids)},
+        )
+        return DetResult.empty(coco_gt)
+    coco_eval = COCOevalV2(cat_names, iouType=iou_type, nproc=1)
+    params = coco_eval.params
+    params.imgIds = list(range(1, len(records) + 1))
+    params.catIds = list(cat_ids)
+    params.maxDets = sorted(params.maxDets)
+    coco_eval._paramsEval = copy.deepcopy(params)
+    num_areas = len(params.areaRng)
+    coco_eval.evalImgs = [
+        image_records[k * num_areas + a]
+        for k in range(len(cat_ids))
+        for a in range(num_areas)
+        for image_records in records
+    ]
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval.accumulate()
+    return coco_eval.summarize()
+
+
+def match_units(
+    gt_frames: List[Frame],
+    pred_frames: List[Frame],
+    units: Dict[str, Tuple[List[int], List[int]]],
+    seqs: set,
+    config: Config,
+    iou_type: str = "bbox",
+) -> Dict:
+    """Compute the partial state of several evaluations for a shard.
+
+    Each unit is one scalabel evaluation, e.g. of a condition or a frame
+    window, given by the indices of its ground truth and predicted frames.
+    Only ground truth frames of the shard's sequences are matched, but the
+    predictions are assigned on the whole unit, as reorder_preds would. Pairs
+    shared by several units are matched once.
+
+    Args:
+        gt_frames (list[Frame]): All ground truth frames.
+        pred_frames (list[Frame]): All predicted frames.
+        units (dict[str, tuple[list[int], list[int]]]): Ground truth and
+            prediction indices of each unit, in file order.
+        seqs (set): Sequences of the shard.
+        config (Config): Dataset config.
+        iou_type (str): "bbox" for detection, "segm" for instance segmentation.
+    Returns:
+        dict: Partial state, to be merged with reduce_units. Besides the
+            records of match_images, it holds the "units" and the "videos"
+            of the matched pairs.
+    """
+    pairs: Dict[Tuple[int, Optional[int]], int] = {}
+    unit_states = {}
+    for name, (gt_indices, pred_indices) in units.items():
+        unit_gt_frames = [gt_frames[i] for i in gt_indices]
+        assigned = assign_preds(unit_gt_frames, [pred_frames[j] for j in pred_indices])
+        images = []
+        for i, position, pred_index in zip(
+            gt_indices, image_positions(unit_gt_frames), assigned
+        ):
+            if gt_frames[i].videoName not in seqs:
+                continue
+            pair = (i, pred_indices[pred_index] if pred_index is not None else None)
+            images.append((position, pairs.setdefault(pair, len(pairs))))
+        unit_states[name] = {"num_images": len(gt_indices), "images": images}
+    state = match_images(
+        [(gt_frames[i], pred_frames[j] if j is not None else None) for i, j in pairs],
+        config,
+        iou_type,
+    )
+    state["units"] = unit_states
+    state["videos"] = [gt_frames[i].videoName for i, _ in pairs]
+    return state
+
+
+def reduce_units(states: List[Dict], iou_type: str = "bbox") -> Dict[str, DetResult]:
+    """Merge the partial states of all shards, in any order.
+
+    Args:
+        states (list[dict]): Partial states of match_units.
+        iou_type (str): "bbox" for detection, "segm" for instance segmentation.
+    Returns:
+        dict[str, DetResult]: Evaluation result of each unit.
+    """
+    results = {}
+    for name, unit in states[0]["units"].items():
+        records: List[Optional[Tuple]] = [None] * unit["num_images"]
+        num_preds, gt_cat_ids = 0, set()
+        for state in states:
+            assert state["units"][name]["num_images"] == unit["num_images"]
+            for position, pair in state["units"][name]["images"]:
+                assert records[position] is None, f"Image {position} is duplicated"
+                records[position] = state["records"][pair]
+                num_preds += state["num_preds"][pair]
+                gt_cat_ids |= state["gt_cat_ids"][pair]
+        assert all(
+            record is not None for record in records
+        ), f"Images of {name} are missing in the shards"
+        results[name] = accumulate_records(
+            records,
+            num_preds,
+            gt_cat_ids,
+            states[0]["categories"],
+            states[0]["cat_ids"],
+            states[0]["cat_names"],
+            iou_type,
+        )
+    return results
+
+
+def reduce_slice(
+    states: List[Dict], unit: str, seqs: set, iou_type: str = "bbox"
+) -> DetResult:
+    """Evaluation of the frames of some sequences of a unit, from its records.
+
+    The images of the sequences keep their order in the unit, which is the
+    order of a scalabel evaluation of only these frames, since the stable
+    sort by name of a subset is the subset of the sort. The predictions stay
+    assigned on the whole unit, which is the same as on the slice when they
+    are matched by video and name, as with several predicted sequences.
+
+    Args:
+        states (list[dict]): Partial states of match_units of all shards.
+        unit (str): Unit covering the sequences, e.g. of all frames.
+        seqs (set): Sequences of the slice.
+        iou_type (str): "bbox" for detection, "segm" for instance segmentation.
+    Returns:
+        DetResult: Evaluation result of the slice.
+    """
+    images = [
+        (position, state, pair)
+        for state in states
+        for position, pair in state["units"][unit]["images"]
+        if state["videos"][pair] in seqs
+    ]
+    images.sort(key=lambda image: image[0])
+    return accumulate_records(
+        [state["records"][pair] for _, state, pair in images],
+        sum(state["num_preds"][pair] for _, state, pair in images),
+        set().union(*[state["gt_cat_ids"][pair] for _, state, pair in images]),
+        states[0]["categories"],
+        states[0]["cat_ids"],
+        states[0]["cat_names"],
+        iou_type,
+    )
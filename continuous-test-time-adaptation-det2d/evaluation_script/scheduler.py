@@ -0,0 +1,445 @@
+"""Memory-aware scheduler running several submissions at once on one host.
+
+Each submission is estimated up front from the uncompressed size of the tasks
+it contains, and admitted once its estimated memory and CPUs fit into the host
+budget. Admitted submissions run in forked processes of a LocalWorker, so they
+share its resident ground truth copy-on-write. Dev-phase submissions are served
+before test-phase ones, and cheaper submissions before more expensive ones
+within a phase, but a submission overtaken by MAX_BYPASS later ones is served
+next.
+
+Example:
+    python -m evaluation_script.scheduler --gt dev=val_gt.zip \
+        --gt test=test_gt.zip --memory-gb 64 --cpus 16 requests.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import socketserver
+import sys
+import threading
+import time
+import zipfile
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+from daemon import LocalWorker, dump_output, parse_ground_truths
+from main import SUBMISSION_TASKS
+from manifest import ImageTask, JsonTask
+
+# Phases served first, lower is earlier. Unknown phases go last.
+PHASE_PRIORITY = {"dev": 0, "test": 1}
+# Rough per-task cost figures, to be tuned for the host:
+# (memory bytes per uncompressed byte, CPU seconds per uncompressed MB)
+TASK_COSTS = {
+    "det_2d.json": (20.0, 2.0),
+}
+# Number of later submissions that may be served before a queued one, so a
+# steady stream of dev-phase submissions does not starve test-phase ones
+MAX_BYPASS = 8
+# Memory of an evaluation process beyond its task data
+BASE_MEMORY = 512 * 1024**2
+
+
+class Job:
+    """A submission with its estimated cost and its timings."""
+
+    def __init__(self, request: dict, index: int) -> None:
+        """Estimate the cost of a submission request.
+
+        Args:
+            request (dict): Request with the keys "user_submission_file",
+                "phase_codename" and optionally "submission_metadata".
+            index (int): Arrival index, used to break ties in FIFO order.
+        """
+        self.request = request
+        self.index = index
+        self.phase_codename = request["phase_codename"]
+        try:
+            self.task_sizes = submission_sizes(
+                request["user_submission_file"], SUBMISSION_TASKS
+            )
+        except (OSError, zipfile.BadZipFile):
+            # Let evaluate() report the broken submission
+            self.task_sizes = {}
+        self.memory, self.cost = estimate(self.task_sizes)
+        # CPUs used at once, the evaluation runs in a single process
+        self.cpus = 1
+        self.output: Optional[dict] = None
+        self.peak_memory: Optional[int] = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.bypassed = 0
+        self.done = threading.Event()
+
+    @property
+    def priority(self) -> tuple:
+        """Sort key of the job in the queue."""
+        return (
+            PHASE_PRIORITY.get(self.phase_codename, len(PHASE_PRIORITY)),
+            self.cost,
+            self.index,
+        )
+
+    def __lt__(self, other: Job) -> bool:
+        """Order jobs by priority."""
+        return self.priority < other.priority
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        """Seconds between submission and start."""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+    @property
+    def service_time(self) -> Optional[float]:
+        """Seconds between start and end of the evaluation."""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def timing(self) -> dict:
+        """Estimates and timings of the job, for reporting."""
+        return {
+            "phase_codename": self.phase_codename,
+            "estimated_memory_mb": self.memory / 1024**2,
+            "estimated_cost_s": self.cost,
+            "estimated_cpus": self.cpus,
+            "peak_memory_mb": (
+                self.peak_memory / 1024**2 if self.peak_memory is not None else None
+            ),
+            "queue_wait_s": self.queue_wait,
+            "service_time_s": self.service_time,
+        }
+
+
+def submission_sizes(user_submission_file: str, tasks: list) -> Dict[str, int]:
+    """Sum the uncompressed size of each task in a submission zip file.
+
+    Only the central directories are read, including those of nested zip files
+    at the root of the archive.
+
+    Args:
+        user_submission_file (str): Path to the submission zip file.
+        tasks (list): ImageTask and JsonTask instances of the challenge.
+    Returns:
+        dict[str, int]: Uncompressed bytes, by name of the tasks present.
+    """
+    with zipfile.ZipFile(user_submission_file, "r") as zip_ref:
+        file_sizes = _zip_sizes(zip_ref)
+    sizes = {}
+    for task in tasks:
+        if isinstance(task, JsonTask) and task.filename in file_sizes:
+            sizes[task.name] = file_sizes[task.filename]
+        elif isinstance(task, ImageTask):
+            size = sum(
+                file_size
+                for rel_path, file_size in file_sizes.items()
+                if rel_path.startswith(task.folder + "/")
+            )
+            if size > 0:
+                sizes[task.name] = size
+    return sizes
+
+
+def _zip_sizes(zip_ref: zipfile.ZipFile, prefix: str = "") -> Dict[str, int]:
+    sizes = {}
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        if "/" not in info.filename and info.filename.endswith(".zip"):
+            with zipfile.ZipFile(zip_ref.open(info), "r") as nested:
+                sizes.update(_zip_sizes(nested, prefix + info.filename[:-4] + "/"))
+        else:
+            sizes[prefix + info.filename] = info.file_size
+    return sizes
+
+
+def estimate(task_sizes: Dict[str, int]) -> tuple[int, float]:
+    """Estimate the memory and CPU time of a submission.
+
+    Args:
+        task_sizes (dict[str, int]): Uncompressed bytes, by task name.
+    Returns:
+        tuple[int, float]: Peak memory in bytes and CPU time in seconds.
+    """
+    memory, cost = BASE_MEMORY, 0.0
+    for name, size in task_sizes.items():
+        memory_factor, seconds_per_mb = TASK_COSTS[name]
+        memory += int(size * memory_factor)
+        cost += size / 1024**2 * seconds_per_mb
+    return memory, cost
+
+
+def host_memory() -> int:
+    """Physical memory of the host in bytes."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _run_job(worker: LocalWorker, request: dict, conn) -> None:
+    output = worker.handle_request(request)
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    conn.send((output, peak_memory))
+    conn.close()
+
+
+class Scheduler:
+    """Admit submissions under a host memory and CPU budget."""
+
+    def __init__(
+        self,
+        worker: LocalWorker,
+        memory_budget: Optional[int] = None,
+        cpu_budget: Optional[int] = None,
+    ) -> None:
+        """Initialize the scheduler.
+
+        Args:
+            worker (LocalWorker): Worker holding the resident ground truth.
+            memory_budget (int, optional): Memory available to the running
+                evaluations in bytes. Defaults to 80% of the host memory.
+            cpu_budget (int, optional): CPUs available to the running
+                evaluations, counting their worker pools. Defaults to the
+                number of CPUs.
+        """
+        self.worker = worker
+        self.memory_budget = memory_budget or int(host_memory() * 0.8)
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.context = multiprocessing.get_context("fork")
+        self.queue: List[Job] = []
+        self.running: Dict[object, tuple] = {}
+        self.finished: List[Job] = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def submit(self, request: dict) -> Job:
+        """Queue a submission request.
+
+        Args:
+            request (dict): Request with the keys "user_submission_file",
+                "phase_codename" and optionally "submission_metadata".
+        Returns:
+            Job: The queued job. Its done event is set once it has finished.
+        """
+        job = Job(request, next(self.counter))
+        with self.condition:
+            heapq.heappush(self.queue, job)
+            self.condition.notify()
+        return job
+
+    @property
+    def memory_in_use(self) -> int:
+        """Estimated memory of the running jobs."""
+        return sum(job.memory for job, _, _ in self.running.values())
+
+    @property
+    def cpus_in_use(self) -> int:
+        """Estimated CPUs of the running jobs."""
+        return sum(job.cpus for job, _, _ in self.running.values())
+
+    def _next_job(self) -> Job:
+        # The job of highest priority, unless an earlier job has been overtaken
+        # MAX_BYPASS times
+        starved = [job for job in self.queue if job.bypassed >= MAX_BYPASS]
+        if starved:
+            return min(starved, key=lambda job: job.index)
+        return self.queue[0]
+
+    def _admit(self) -> None:
+        # The next job is not overtaken while it waits for memory or CPUs, so
+        # large jobs do not starve. A job larger than the whole budget runs
+        # alone.
+        while self.queue and self.cpus_in_use < self.cpu_budget:
+            job = self._next_job()
+            if self.running and (
+                self.memory_in_use + job.memory > self.memory_budget
+                or self.cpus_in_use + job.cpus > self.cpu_budget
+            ):
+                break
+            self.queue.remove(job)
+            heapq.heapify(self.queue)
+            for other in self.queue:
+                if other.index < job.index:
+                    other.bypassed += 1
+            recv_conn, send_conn = self.context.Pipe(duplex=False)
+            process = self.context.Process(
+                target=_run_job, args=(self.worker, job.request, send_conn)
+            )
+            job.started_at = time.time()
+            # Do not duplicate buffered output in the child
+            sys.stdout.flush()
+            process.start()
+            send_conn.close()
+            self.running[recv_conn] = (job, process, recv_conn)
+
+    def _collect(self, timeout: float) -> None:
+        for conn in wait(list(self.running), timeout=timeout):
+            job, process, _ = self.running.pop(conn)
+            try:
+                job.output, job.peak_memory = conn.recv()
+            except EOFError:
+                job.output = {"error": "evaluation process exited unexpectedly"}
+            conn.close()
+            process.join()
+            if process.exitcode:
+                job.output.setdefault(
+                    "error", f"evaluation process exited with code {process.exitcode}"
+                )
+            job.finished_at = time.time()
+            self.finished.append(job)
+            print(format_timing(job))
+            job.done.set()
+
+    def run(self) -> None:
+        """Dispatch queued jobs until stop() is called and the queue is empty."""
+        while True:
+            with self.condition:
+                self._admit()
+                if not self.running:
+                    if self.stopped and not self.queue:
+                        return
+                    self.condition.wait(timeout=1.0)
+                    continue
+            self._collect(timeout=0.5)
+
+    def stop(self) -> None:
+        """Stop run() once all queued jobs have finished."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run_all(self, requests: List[dict]) -> List[Job]:
+        """Evaluate a batch of requests and wait for all of them.
+
+        Args:
+            requests (list[dict]): Submission requests.
+        Returns:
+            list[Job]: The finished jobs, in the order of the requests.
+        """
+        jobs = [self.submit(request) for request in requests]
+        self.stop()
+        self.run()
+        return jobs
+
+    def serve_socket(self, socket_path: str) -> None:
+        """Evaluate requests from a Unix socket, concurrently.
+
+        Same protocol as LocalWorker.serve_socket, but connections are served
+        in threads and the evaluations are admitted by the scheduler.
+
+        Args:
+            socket_path (str): Path of the Unix socket to listen on.
+        """
+        scheduler = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                request = json.loads(self.rfile.readline())
+                try:
+                    job = scheduler.submit(request)
+                except Exception as e:
+                    output = {"error": f"{type(e).__name__}: {e}"}
+                else:
+                    job.done.wait()
+                    output = job.output
+                self.wfile.write(dump_output(output) + b"\n")
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+            server.daemon_threads = True
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            print(f"Listening on {socket_path}")
+            try:
+                self.run()
+            finally:
+                server.shutdown()
+                os.remove(socket_path)
+
+    def summary(self) -> Dict[str, dict]:
+        """Mean and maximum queue wait and service time, by phase."""
+        summary = {}
+        for phase_codename in sorted(set(job.phase_codename for job in self.finished)):
+            jobs = [
+                job for job in self.finished if job.phase_codename == phase_codename
+            ]
+            waits = [job.queue_wait for job in jobs]
+            services = [job.service_time for job in jobs]
+            summary[phase_codename] = {
+                "jobs": len(jobs),
+                "mean_queue_wait_s": sum(waits) / len(jobs),
+                "max_queue_wait_s": max(waits),
+                "mean_service_time_s": sum(services) / len(jobs),
+                "max_service_time_s": max(services),
+            }
+        return summary
+
+
+def format_timing(job: Job) -> str:
+    """One line report of a finished job."""
+    timing = job.timing()
+    peak = timing["peak_memory_mb"]
+    return (
+        f"[{job.phase_codename}] {job.request['user_submission_file']}: "
+        f"waited {timing['queue_wait_s']:.1f}s, "
+        f"ran {timing['service_time_s']:.1f}s "
+        f"(estimated {timing['estimated_cost_s']:.1f}s), "
+        f"peak memory {peak if peak is not None else float('nan'):.0f}MB "
+        f"(estimated {timing['estimated_memory_mb']:.0f}MB)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--gt",
+        action="append",
+        required=True,
+        help="ground truth zip file of a phase, as PHASE=PATH",
+    )
+    parser.add_argument(
+        "--memory-gb", type=float, help="memory budget, default 80%% of the host"
+    )
+    parser.add_argument(
+        "--cpus", type=int, help="CPUs of the evaluations, default number of CPUs"
+    )
+    parser.add_argument("--socket", help="serve requests from this Unix socket")
+    parser.add_argument(
+        "requests",
+        nargs="?",
+        help="json lines file of requests to evaluate, '-' for stdin",
+    )
+    args = parser.parse_args()
+    assert (args.socket is None) != (
+        args.requests is None
+    ), "Pass either a requests file or --socket"
+
+    scheduler = Scheduler(
+        LocalWorker(parse_ground_truths(args.gt)),
+        memory_budget=int(args.memory_gb * 1024**3) if args.memory_gb else None,
+        cpu_budget=args.cpus,
+    )
+    if args.socket is not None:
+        scheduler.serve_socket(args.socket)
+    else:
+        f = sys.stdin if args.requests == "-" else open(args.requests, "r")
+        with f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        for job in scheduler.run_all(requests):
+            sys.stdout.buffer.write(
+                dump_output({**job.output, "timing": job.timing()}) + b"\n"
+            )
+        print(json.dumps(scheduler.summary(), indent=2))
@@ -0,0 +1,132 @@
+"""Parallel, selective and incremental extraction of nested zip files.
+
+The members of an archive are extracted by a pool of threads, each reading
+through its own handle on the zip file, since zlib releases the GIL while
+inflating. Nested zip files at the root of an archive are extracted into a
+folder of the same name as soon as they are written, concurrently with the
+other members. Members already extracted with the same size and CRC-32 are
+kept as they are, so extracting the same zip file again only reads it.
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import zipfile
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional, Tuple
+
+# Number of extraction threads
+NUM_WORKERS = min(8, os.cpu_count() or 1)
+BUFFER_SIZE = 1 << 20
+
+
+def target_path(output_path: str, filename: str) -> str:
+    """Path of an extracted member, sanitized like ZipFile.extract does."""
+    arcname = os.path.splitdrive(filename.replace("/", os.path.sep))[1]
+    parts = [
+        part
+        for part in arcname.split(os.path.sep)
+        if part not in ("", os.path.curdir, os.path.pardir)
+    ]
+    return os.path.normpath(os.path.join(output_path, *parts))
+
+
+def is_extracted(info: zipfile.ZipInfo, path: str) -> bool:
+    """Whether a member is already extracted, by its size and CRC-32."""
+    try:
+        if os.path.getsize(path) != info.file_size:
+            return False
+        crc = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+    except OSError:
+        return False
+    return crc == info.CRC
+
+
+def _is_nested(info: zipfile.ZipInfo) -> bool:
+    return "/" not in info.filename and info.filename.endswith(".zip")
+
+
+def _extract_members(
+    file_path: str, infos: List[zipfile.ZipInfo], output_path: str
+) -> List[str]:
+    # Extract members through a handle of this thread, return the nested zips
+    nested = []
+    with zipfile.ZipFile(file_path, "r") as zip_ref:
+        for info in infos:
+            path = target_path(output_path, info.filename)
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+            if not is_extracted(info, path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with zip_ref.open(info) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, BUFFER_SIZE)
+            if _is_nested(info):
+                nested.append(path)
+    return nested
+
+
+def _submit_archive(
+    pool: ThreadPoolExecutor,
+    file_path: str,
+    prefix: str,
+    keep: Optional[Callable[[str], bool]],
+    num_workers: int,
+) -> List[Tuple]:
+    output_path = file_path[:-4]
+    os.makedirs(output_path, exist_ok=True)
+    with zipfile.ZipFile(file_path, "r") as zip_ref:
+        infos = zip_ref.infolist()
+    nested, members = [], []
+    for info in infos:
+        if _is_nested(info):
+            nested.append(info)
+        elif keep is None or (not info.is_dir() and keep(prefix + info.filename)):
+            members.append(info)
+    # Nested zip files first, one per job, then the members in balanced chunks
+    jobs = [[info] for info in nested]
+    chunks = [[] for _ in range(max(1, min(num_workers, len(members))))]
+    members.sort(key=lambda info: info.compress_size, reverse=True)
+    for i, info in enumerate(members):
+        chunks[i % len(chunks)].append(info)
+    jobs.extend(chunk for chunk in chunks if chunk)
+    return [
+        (pool.submit(_extract_members, file_path, job, output_path), prefix)
+        for job in jobs
+    ]
+
+
+def unzip_nested(
+    file_path: str,
+    keep: Optional[Callable[[str], bool]] = None,
+    num_workers: int = NUM_WORKERS,
+) -> None:
+    """Unzip a zip file and the zip files nested at its root.
+
+    Args:
+        file_path (str): Path to the zip file, extracted into the same path
+            without the .zip extension.
+        keep (Callable[[str], bool], optional): Whether to extract a member,
+            by its path relative to the output folder, with nested zip files
+            extracted into folders, see manifest.list_files. Nested zip files
+            are always extracted. Defaults to extracting all members.
+        num_workers (int): Number of extraction threads.
+    """
+    assert file_path.endswith(".zip"), "Not a zip file"
+    with ThreadPoolExecutor(num_workers) as pool:
+        pending = dict(_submit_archive(pool, file_path, "", keep, num_workers))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix = pending.pop(future)
+                for nested_path in future.result():
+                    nested_prefix = prefix + os.path.basename(nested_path)[:-4] + "/"
+                    pending.update(
+                        _submit_archive(
+                            pool, nested_path, nested_prefix, keep, num_workers
+                        )
+                    )
@@ -2,12 +2,15 @@ import copy
 import csv
 import os
 import sys
-import zipfile
 from pathlib import Path
 
+import numpy as np
+
 sys.path.append(str(Path(__file__).parent.absolute()))
 
-from scalabel.label.io import load
+from frame_index import FrameIndex, frame_keys, join_frames
+from gt_cache import load_compiled
+from unzip import unzip_nested
 
 SEQ_INFO_PATH_VAL = os.path.join(
     str(Path(__file__).parent.absolute()), "val_front_images_seq.csv"
@@ -17,18 +20,6 @@ SEQ_INFO_PATH_TEST = os.path.join(
 )
 
 
-def unzip_nested(file_path):
-    """Unzip nested zip files."""
-    assert file_path.endswith(".zip"), "Not a zip file"
-
-    output_path = file_path[:-4]
-    with zipfile.ZipFile(file_path, "r") as zip_ref:
-        zip_ref.extractall(output_path)
-    for file in os.listdir(output_path):
-        if file.endswith(".zip"):
-            unzip_nested(os.path.join(output_path, file))
-
-
 # Load sequence info
 with open(SEQ_INFO_PATH_VAL, "r") as f:
     reader = csv.DictReader(f)
@@ -69,10 +60,22 @@ def get_used_seqs(split="val"):
 
 
 SCALABEL_CACHE = {}
+# Compiled annotation cache keys of the ground truth json files, by file path
+GT_ANNOTATION_KEYS = {}
 
 
 def load_scalabel(file_path, used_seqs=None):
     """Load scalabel."""
+    if file_path in GT_ANNOTATION_KEYS:
+        # Compiled ground truth, restored for the used sequences only
+        if file_path not in SCALABEL_CACHE:
+            SCALABEL_CACHE[file_path] = load_compiled(
+                file_path, GT_ANNOTATION_KEYS[file_path]
+            )
+        return SCALABEL_CACHE[file_path].dataset(used_seqs)
+
+    from scalabel.label.io import load
+
     if file_path in SCALABEL_CACHE:
         data_ = copy.deepcopy(SCALABEL_CACHE[file_path])
     else:
@@ -84,26 +87,38 @@ def load_scalabel(file_path, used_seqs=None):
     return data_
 
 
+def release_scalabel(folder):
+    """Drop cached scalabel files below a folder, e.g. a finished submission."""
+    folder = os.path.join(folder, "")
+    for file_path in list(SCALABEL_CACHE):
+        if file_path.startswith(folder):
+            del SCALABEL_CACHE[file_path]
+
+
 def filter_scalabel(pred, target):
     """Filter the scalabel by target."""
-    used_frames = []
-    for frame in target.frames:
-        used_frames.append(frame.videoName + frame.name)
-    used_frames = set(used_frames)
-    pred.frames = [
-        frame for frame in pred.frames if frame.videoName + frame.name in used_frames
-    ]
+    index = FrameIndex.from_frames(target.frames)
+    join = join_frames(index, frame_keys(pred.frames))
+    if len(join.duplicates) > 0:
+        print(f">> {len(join.duplicates)} frames are predicted more than once")
+    pred.frames = [pred.frames[i] for i in join.kept]
     return pred
 
 
 def filer_scalabel_by_frame_id(pred, frame_id_start, frame_id_end):
     """Filter the scalabel by frame id."""
-    used_frames = []
-    for frame in pred.frames:
-        if frame.frameIndex >= frame_id_start and frame.frameIndex <= frame_id_end:
-            used_frames.append(frame.videoName + frame.name)
-    used_frames = set(used_frames)
+    # Frames of a key with any frame in the range are kept
+    index = FrameIndex.from_frames(pred.frames)
+    in_range = np.array(
+        [
+            frame.frameIndex >= frame_id_start and frame.frameIndex <= frame_id_end
+            for frame in pred.frames
+        ],
+        dtype=bool,
+    )
+    used_ids = np.zeros(len(index), dtype=bool)
+    used_ids[index.frame_ids[in_range]] = True
     pred.frames = [
-        frame for frame in pred.frames if frame.videoName + frame.name in used_frames
+        frame for frame, used in zip(pred.frames, used_ids[index.frame_ids]) if used
     ]
     return pred
@@ -1,47 +1,14 @@
 """
 # Q. How to install custom python pip packages?
 
-# A. Uncomment the below code to install the custom python packages.
+# A. Add the package to REQUIREMENTS in preflight.py. Missing packages are
+#    installed once and the result is cached, see preflight.preflight().
 
 """
 
-import os
-import subprocess
-import sys
-from pathlib import Path
+from .preflight import install, install_local_package, preflight
 
-
-def install(package):
-    # Install a pip python package
-
-    # Args:
-    #     package ([str]): Package name with version
-
-    subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-
-
-def install_local_package(folder_name):
-    # Install a local python package
-
-    # Args:
-    #     folder_name ([str]): name of the folder placed in evaluation_script/
-
-    subprocess.check_output(
-        [
-            sys.executable,
-            "-m",
-            "pip",
-            "install",
-            os.path.join(str(Path(__file__).parent.absolute()) + folder_name),
-        ]
-    )
-
-
-install("tqdm")
-install("numpy==1.21")
-install("git+https://github.com/scalabel/scalabel.git@scalabel-evalAPI")
-# install("nuscenes-devkit==1.1.10")
-# install("pyquaternion==0.9.9")
+preflight()
 
 
 from .main import evaluate
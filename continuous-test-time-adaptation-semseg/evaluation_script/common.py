@@ -5,17 +5,31 @@ import os
 from typing import Any
 
 import numpy as np
-from PIL import Image
 import tqdm
 
+from frame_table import FrameTableWriter
+from image_decode import get_decoder
+from stacks import PredictionStack, find_stack
+
 
 class Evaluator:
     """Abstract evaluator class."""
 
     METRICS: list[str] = []
+    # Accepted dtypes of per-sequence prediction stacks, see stacks.py
+    STACK_DTYPES: tuple = ()
+    # Rows from the top and channel of the png files used by the evaluator,
+    # None for all, see image_decode.py
+    DECODE_ROWS: int | None = None
+    DECODE_CHANNEL: int | None = None
 
     def __init__(self) -> None:
         """Initialize evaluator."""
+        self.decoder = get_decoder()
+        # Decoded images by buffer name, reused for the next image of a size
+        self.buffers: dict[str, np.ndarray] = {}
+        # Whether process keeps the results of each frame, see frame_results
+        self.record_frames = False
         self.reset()
 
     def reset(self) -> None:
@@ -43,6 +57,39 @@ class Evaluator:
         """
         return data
 
+    def preprocess_stack(self, data: np.array) -> np.array:
+        """Preprocess a frame of a prediction stack, like preprocess of the png.
+
+        Args:
+            data (np.array): Frame of the stack, in shape (H, W).
+        Returns:
+            np.array: Processed data.
+        """
+        return self.preprocess(np.asarray(data))
+
+    def open_prediction_stack(
+        self, pred_folder_path: str, seq_name: str, frame_names: list[str]
+    ) -> PredictionStack | None:
+        """Open the prediction stack of a sequence, if submitted and valid.
+
+        Args:
+            pred_folder_path (str): Path to folder containing predictions.
+            seq_name (str): Name of the sequence.
+            frame_names (list[str]): Sorted target frame names.
+        Returns:
+            PredictionStack | None: The opened stack, None if there is none.
+        """
+        if not self.STACK_DTYPES:
+            return None
+        path = find_stack(pred_folder_path, seq_name)
+        if path is None:
+            return None
+        try:
+            return PredictionStack(path, frame_names, self.STACK_DTYPES)
+        except Exception as e:
+            print(f"Error when opening {path}: {e}")
+            return None
+
     def on_next_sequence(self, seq_name: str) -> None:
         """Called when a new sequence is processed.
 
@@ -51,55 +98,201 @@ class Evaluator:
         """
         pass
 
+    def get_state(self) -> dict[str, Any]:
+        """Return the partial state accumulated since the last reset.
+
+        Returns:
+            dict[str, Any]: Picklable state, to be combined with merge_states.
+        """
+        return {metric: list(values) for metric, values in self.metrics.items()}
+
+    def merge_states(self, states: list[dict[str, Any]]) -> None:
+        """Replace the current state by the combination of partial states.
+
+        Args:
+            states (list[dict[str, Any]]): States returned by get_state, in
+                the order the frames would be processed.
+        """
+        self.reset()
+        for state in states:
+            for metric in self.METRICS:
+                self.metrics[metric].extend(state[metric])
+
+    def read_image(self, path: str, buffer: str) -> np.ndarray:
+        """Decode the rows and channel of a png file used by the evaluator.
+
+        Args:
+            path (str): Path to the image file.
+            buffer (str): Name of the buffer to decode into, e.g. "pred", so
+                the image is overwritten by the next one decoded into it.
+        Returns:
+            np.ndarray: Decoded image.
+        """
+        image = self.decoder.decode(
+            path, self.DECODE_ROWS, self.DECODE_CHANNEL, self.buffers.get(buffer)
+        )
+        self.buffers[buffer] = image
+        return image
+
+    def list_targets(self, target_folder_path: str, seq_name: str) -> list[str]:
+        """List the target frames of a sequence, sorted by name.
+
+        Args:
+            target_folder_path (str): Path to folder containing targets.
+            seq_name (str): Name of the sequence.
+        Returns:
+            list[str]: Frame names of the sequence.
+        """
+        return [
+            frame_name
+            for frame_name in sorted(
+                os.listdir(os.path.join(target_folder_path, seq_name))
+            )
+            if frame_name.endswith(".png")
+        ]
+
+    def load_target(
+        self, target_folder_path: str, seq_name: str, frame_name: str
+    ) -> Any:
+        """Load and preprocess the target of a frame, as passed to process.
+
+        Args:
+            target_folder_path (str): Path to folder containing targets.
+            seq_name (str): Name of the sequence.
+            frame_name (str): Name of the frame.
+        Returns:
+            Any: Target of the frame.
+        """
+        target = self.read_image(
+            os.path.join(target_folder_path, seq_name, frame_name), "target"
+        )
+        return self.preprocess(target)
+
     def append_empty_sample(self, *args: Any, **kwargs: Any) -> None:
         """Process all predictions in a folder of images."""
         raise NotImplementedError
 
+    def append_empty_samples(self, frame_ids: list[int]) -> None:
+        """Append empty results for frames without a valid prediction.
+
+        Args:
+            frame_ids (list[int]): Frame ids of the frames.
+        """
+        for frame_id in frame_ids:
+            self.append_empty_sample(frame_id)
+
+    def frame_results(self, frame_ids: list[int]) -> dict[str, Any]:
+        """Per-frame results of the frames of the last processed sequence.
+
+        The results are kept by process while record_frames is set.
+
+        Args:
+            frame_ids (list[int]): Frame ids of the frames.
+        Returns:
+            dict[str, Any]: Values of each result for each frame.
+        """
+        return {}
+
     def process_from_folder(
         self,
         pred_folder_path: str,
         target_folder_path: str,
         max_num_seqs: int = -1,
         used_seqs=None,
+        states: dict[str, dict[str, Any]] | None = None,
+        table: FrameTableWriter | None = None,
     ) -> dict[str, float]:
         """Process all predictions in a folder of images.
 
+        Frames without a prediction are found by comparing the folder listings
+        once and are appended as empty results in bulk. A sequence can also be
+        predicted by a .npy or .npz stack instead of png files, see stacks.py.
+
         Args:
             pred_folder_path (str): Path to folder containing predictions.
             target_folder_path (str): Path to folder containing targets.
+            states (dict, optional): If given, the partial state of each
+                sequence is stored in it by sequence name, e.g. for sharded
+                evaluation.
+            table (FrameTableWriter, optional): If given, the results of each
+                frame are appended to it, see frame_results, with the sequence,
+                frame id and whether the prediction was evaluated.
 
         Returns:
             dict[str, float]: Evaluation results.
         """
+        self.record_frames = table is not None
         self.reset()
         seqs = sorted(os.listdir(target_folder_path))
         if max_num_seqs > 0:
             seqs = seqs[:max_num_seqs]
+        num_frames, num_missing = 0, 0
+        processed_seqs = []
         for seq_name in tqdm.tqdm(seqs):
             if used_seqs is not None and seq_name not in used_seqs:
                 continue
+            if states is not None:
+                self.reset()
             self.on_next_sequence(seq_name)
-            for frame_name in sorted(
-                os.listdir(os.path.join(target_folder_path, seq_name))
-            ):
-                if not frame_name.endswith(".png"):
+            frame_names = self.list_targets(target_folder_path, seq_name)
+            pred_seq_path = os.path.join(pred_folder_path, seq_name)
+            stack = self.open_prediction_stack(pred_folder_path, seq_name, frame_names)
+            if stack is not None:
+                pred_frame_names = set(stack.frame_names)
+            elif os.path.isdir(pred_seq_path):
+                pred_frame_names = set(os.listdir(pred_seq_path))
+            else:
+                pred_frame_names = set()
+            missing = [
+                int(frame_name.split("_")[0])
+                for frame_name in frame_names
+                if frame_name not in pred_frame_names
+            ]
+            self.append_empty_samples(missing)
+            num_frames += len(frame_names)
+            num_missing += len(missing)
+
+            evaluated = np.zeros(len(frame_names), dtype=bool)
+            for k, frame_name in enumerate(frame_names):
+                if frame_name not in pred_frame_names:
                     continue
+                frame_id = int(frame_name.split("_")[0])
                 try:
-                    pred = np.array(
-                        Image.open(os.path.join(pred_folder_path, seq_name, frame_name))
-                    )
-                    target = np.array(
-                        Image.open(
-                            os.path.join(target_folder_path, seq_name, frame_name)
+                    if stack is not None:
+                        pred = self.preprocess_stack(stack[frame_name])
+                    else:
+                        pred = self.read_image(
+                            os.path.join(pred_seq_path, frame_name), "pred"
                         )
-                    )
-                    frame_id = int(frame_name.split("_")[0])
-                    pred = self.preprocess(pred)
-                    target = self.preprocess(target)
+                        pred = self.preprocess(pred)
+                    target = self.load_target(target_folder_path, seq_name, frame_name)
                     self.process(pred, target, frame_id)
+                    evaluated[k] = True
 
                 except Exception as e:
                     print(f"Error when evaluating {seq_name}/{frame_name}: {e}")
                     # apppend empty result
                     self.append_empty_sample(frame_id)
+            if table is not None:
+                frame_ids = [
+                    int(frame_name.split("_")[0]) for frame_name in frame_names
+                ]
+                table.append(
+                    {
+                        "sequence": [seq_name] * len(frame_names),
+                        "frame": frame_ids,
+                        "evaluated": evaluated,
+                        **self.frame_results(frame_ids),
+                    }
+                )
+            if states is not None:
+                states[seq_name] = self.get_state()
+                processed_seqs.append(seq_name)
+        if states is not None:
+            self.merge_states([states[seq_name] for seq_name in processed_seqs])
+        if num_missing > 0:
+            print(
+                f"{num_missing} of {num_frames} frames are missing in the "
+                "prediction and evaluated as empty results."
+            )
         return self.evaluate()
@@ -0,0 +1,244 @@
+"""Long-lived evaluation daemon with resident ground truth.
+
+The ground truth of every phase is unzipped and compiled once when the daemon
+starts, and each submission then only pays for its own unzipping and
+evaluation. Submissions are accepted from a local queue or a Unix socket, one
+json request per line:
+
+    {"user_submission_file": "/path/to/submission.zip", "phase_codename": "dev"}
+
+and answered with the output dict of evaluate(), or {"error": "..."}. With
+"preview": true in the request, the output dict of evaluate_preview() is sent
+first, and the full evaluation continues unless the preview failed. With
+"confidence_intervals": true, evaluate() also computes the bootstrap
+confidence intervals of the scores.
+
+Example:
+    python -m evaluation_script.daemon --gt dev=val_gt.zip --gt test=test_gt.zip \
+        --socket /tmp/shift-eval.sock
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import traceback
+import sys
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+from main import evaluate, prepare_ground_truth
+from preview import evaluate_preview
+
+
+class LocalWorker:
+    """Local stand-in for the EvalAI submission worker interface.
+
+    Like the EvalAI worker, it calls evaluate() with the annotation file of the
+    phase and forwards the submission metadata, but it keeps the ground truth
+    of all phases resident between submissions.
+    """
+
+    def __init__(self, ground_truths: Dict[str, str]) -> None:
+        """Load the ground truth of all phases.
+
+        Args:
+            ground_truths (dict[str, str]): Ground truth zip file, by phase
+                codename.
+        """
+        self.ground_truths = ground_truths
+        for phase_codename, test_annotation_file in ground_truths.items():
+            print(f"Loading ground truth of phase {phase_codename}...")
+            prepare_ground_truth(test_annotation_file)
+
+    def run_submission(
+        self,
+        user_submission_file: str,
+        phase_codename: str,
+        submission_metadata: Optional[dict] = None,
+        confidence_intervals: bool = False,
+    ) -> dict:
+        """Evaluate a single submission.
+
+        Args:
+            user_submission_file (str): Path to the submission zip file.
+            phase_codename (str): Phase to which the submission is made.
+            submission_metadata (dict, optional): EvalAI submission metadata.
+            confidence_intervals (bool): Also compute the bootstrap confidence
+                intervals of the scores.
+        Returns:
+            dict: The output dict of evaluate().
+        """
+        assert (
+            phase_codename in self.ground_truths
+        ), f"No ground truth loaded for phase {phase_codename}"
+        return evaluate(
+            self.ground_truths[phase_codename],
+            user_submission_file,
+            phase_codename,
+            submission_metadata=submission_metadata or {},
+            confidence_intervals=confidence_intervals,
+        )
+
+    def handle_preview(self, request: dict) -> dict:
+        """Preview a submission request and catch its errors.
+
+        Args:
+            request (dict): Request with the keys "user_submission_file" and
+                "phase_codename".
+        Returns:
+            dict: The output dict of evaluate_preview(), or {"error": message}.
+        """
+        try:
+            phase_codename = request["phase_codename"]
+            assert (
+                phase_codename in self.ground_truths
+            ), f"No ground truth loaded for phase {phase_codename}"
+            return evaluate_preview(
+                self.ground_truths[phase_codename],
+                request["user_submission_file"],
+                phase_codename,
+            )
+        except Exception as e:
+            traceback.print_exc()
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    def handle_request(self, request: dict) -> dict:
+        """Evaluate a submission request and catch its errors.
+
+        Args:
+            request (dict): Request with the keys "user_submission_file",
+                "phase_codename" and optionally "submission_metadata" and
+                "confidence_intervals".
+        Returns:
+            dict: The output dict of evaluate(), or {"error": message}.
+        """
+        try:
+            return self.run_submission(
+                request["user_submission_file"],
+                request["phase_codename"],
+                request.get("submission_metadata"),
+                request.get("confidence_intervals", False),
+            )
+        except Exception as e:
+            traceback.print_exc()
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    def serve_queue(self, requests, results) -> None:
+        """Evaluate requests from a local queue until None is received.
+
+        Args:
+            requests (queue.Queue): Queue of request dicts.
+            results (queue.Queue): Queue receiving (request, output) tuples.
+        """
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            if request.get("preview"):
+                output = self.handle_preview(request)
+                results.put((request, output))
+                if "error" in output:
+                    continue
+            results.put((request, self.handle_request(request)))
+
+    def serve_socket(self, socket_path: str) -> None:
+        """Evaluate requests from a Unix socket, one connection per request.
+
+        Args:
+            socket_path (str): Path of the Unix socket to listen on.
+        """
+        worker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                request = json.loads(self.rfile.readline())
+                if request.get("preview"):
+                    output = worker.handle_preview(request)
+                    self.wfile.write(dump_output(output) + b"\n")
+                    self.wfile.flush()
+                    if "error" in output:
+                        return
+                output = worker.handle_request(request)
+                self.wfile.write(dump_output(output) + b"\n")
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socketserver.UnixStreamServer(socket_path, Handler) as server:
+            print(f"Listening on {socket_path}")
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(socket_path)
+
+
+def dump_output(output: dict) -> bytes:
+    """Serialize an output dict, converting numpy scalars to floats."""
+    return json.dumps(output, default=float).encode("utf-8")
+
+
+def submit(
+    socket_path: str,
+    user_submission_file: str,
+    phase_codename: str,
+    submission_metadata: Optional[dict] = None,
+    on_preview: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """Send a submission to a running daemon and wait for the output.
+
+    Args:
+        socket_path (str): Path of the daemon's Unix socket.
+        user_submission_file (str): Path to the submission zip file.
+        phase_codename (str): Phase to which the submission is made.
+        submission_metadata (dict, optional): EvalAI submission metadata.
+        on_preview (Callable[[dict], None], optional): If given, a preview is
+            requested and its output dict is passed to it as soon as received.
+    Returns:
+        dict: The output dict of evaluate(), or {"error": message}.
+    """
+    request = {
+        "user_submission_file": os.path.abspath(user_submission_file),
+        "phase_codename": phase_codename,
+        "submission_metadata": submission_metadata or {},
+        "preview": on_preview is not None,
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(request).encode("utf-8") + b"\n")
+            f.flush()
+            if on_preview is not None:
+                output = json.loads(f.readline())
+                on_preview(output)
+                if "error" in output:
+                    return output
+            return json.loads(f.readline())
+
+
+def parse_ground_truths(values) -> Dict[str, str]:
+    """Parse PHASE=PATH arguments into a dict."""
+    ground_truths = {}
+    for value in values:
+        phase_codename, _, path = value.partition("=")
+        assert path.endswith(".zip"), f"Expected PHASE=PATH.zip, got {value}"
+        ground_truths[phase_codename] = os.path.abspath(path)
+    return ground_truths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--gt",
+        action="append",
+        required=True,
+        help="ground truth zip file of a phase, as PHASE=PATH",
+    )
+    parser.add_argument(
+        "--socket", default="/tmp/shift-eval.sock", help="Unix socket to listen on"
+    )
+    args = parser.parse_args()
+    LocalWorker(parse_ground_truths(args.gt)).serve_socket(args.socket)
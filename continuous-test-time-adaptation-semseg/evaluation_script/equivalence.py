@@ -0,0 +1,305 @@
+"""Differential check of the fast semseg paths against the reference.
+
+Every faster path to the leaderboard numbers must give the same numbers as
+SemanticSegmentationEvaluator.evaluate on the png files of the ground truth,
+decoded with Pillow: the compiled ground truth (semseg_cube.py), the OpenCV
+decoder (image_decode.py), prediction stacks (stacks.py) and the sum of
+sharded per-sequence states (shard.py).
+
+The check runs the reference and all engines on generated cases, random ones
+and adversarial ones: frames with all pixels ignored, missing predictions and
+missing window frames, exact predictions and predictions of a few classes.
+The results must agree within TOLERANCE, and the time of each engine is
+reported relative to the reference:
+
+    python evaluation_script/equivalence.py --cases 12
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import math
+import os
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+from image_decode import DECODERS, get_decoder
+from semseg_cube import compile_semseg_gt, open_semseg_gt
+from semseg_eval import WINDOW_FRAMES, SemanticSegmentationEvaluator
+
+# Relative and absolute tolerance. The confusion matrices are integer pixel
+# counts on every path, so the metrics must agree exactly.
+TOLERANCE = (0.0, 0.0)
+# Adversarial kinds of the generated cases, one after the other
+KINDS = ["random", "ignored", "missing", "exact", "few_classes"]
+# Frame ids of the generated frames, around the window frames
+FRAME_IDS = sorted({i + d for i in WINDOW_FRAMES.values() for d in (0, 1, 2)})
+
+
+class Case(NamedTuple):
+    """Generated input of the check"""
+
+    name: str  # kind and number of the case
+    data: Any  # input of the reference and of the engines
+
+
+def compare(
+    expected: dict[str, float], actual: dict[str, float], rtol: float, atol: float
+) -> list[str]:
+    """
+    Differences of two results beyond a tolerance, NaN only agreeing with NaN
+
+    Args:
+        expected: reference result
+        actual: result of an engine
+        rtol: tolerance relative to the reference value
+        atol: absolute tolerance
+    """
+    diffs = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual or key not in expected:
+            where = "reference" if key in expected else "engine"
+            diffs.append(f"{key} only in {where}")
+            continue
+        a, b = float(actual[key]), float(expected[key])
+        if a == b or (math.isnan(a) and math.isnan(b)):
+            continue
+        if not (abs(a - b) <= atol + rtol * abs(b)):
+            diffs.append(f"{key}: {a!r} != {b!r}")
+    return diffs
+
+
+def run_check(
+    cases: Iterator[Case],
+    reference: Callable[[Any], Any],
+    engines: dict[str, Callable[[Any], Any]],
+) -> dict[str, dict[str, float]]:
+    """
+    Run the reference and the engines on cases and compare their results
+
+    Args:
+        cases: generated cases
+        reference: reference evaluation of the data of a case
+        engines: fast evaluations of the data of a case, by name, returning
+            None if they do not apply to the case
+    Returns:
+        for each engine, the number of "cases" it ran on, the number of
+        "mismatches" and the "speedup", the time of the reference divided by
+        the time of the engine on these cases
+    """
+    rtol, atol = TOLERANCE
+    stats = {
+        name: {"cases": 0, "mismatches": 0, "ref": 0.0, "time": 0.0} for name in engines
+    }
+    for case in cases:
+        expected, ref_time = _timed(reference, case.data)
+        for name, engine in engines.items():
+            actual, elapsed = _timed(engine, case.data)
+            if actual is None:
+                continue
+            diffs = compare(expected, actual, rtol, atol)
+            stat = stats[name]
+            stat["cases"] += 1
+            stat["ref"] += ref_time
+            stat["time"] += elapsed
+            if diffs:
+                stat["mismatches"] += 1
+                print(f"semseg/{name} differs on {case.name}: {'; '.join(diffs[:5])}")
+    return {
+        name: {
+            "cases": stat["cases"],
+            "mismatches": stat["mismatches"],
+            "speedup": stat["ref"] / stat["time"] if stat["time"] > 0 else math.nan,
+        }
+        for name, stat in stats.items()
+    }
+
+
+def _timed(function: Callable[[Any], Any], data: Any) -> tuple:
+    # Result and time of a quiet call, without the progress bars and the
+    # warnings of empty means
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ), warnings.catch_warnings(), np.errstate(all="ignore"):
+        warnings.simplefilter("ignore")
+        start = time.perf_counter()
+        result = function(data)
+        elapsed = time.perf_counter() - start
+    return result, elapsed
+
+
+def semseg_cases(
+    root: str, num_cases: int, rng: np.random.Generator, num_classes: int = 23
+) -> Iterator[Case]:
+    """
+    Semseg cases, written as ground truth and prediction folders
+
+    The labels are written to the first channel of RGB png files, like the
+    ground truth, and the predictions also as uint8 prediction stacks. The
+    ground truth is compiled once per case, as for the leaderboard.
+
+    Args:
+        root: folder to write the cases to
+        num_cases: number of cases
+        rng: random generator
+        num_classes: number of classes of the evaluator
+    """
+    height, width = 48, 64
+    for k in range(num_cases):
+        kind = KINDS[k % len(KINDS)]
+        folders = {
+            name: os.path.join(root, f"semseg_{k}", name)
+            for name in ("gt", "png", "stack")
+        }
+        for folder in folders.values():
+            os.makedirs(folder)
+        for s in range(int(rng.integers(1, 4))):
+            seq_name = f"seq{s}"
+            frame_ids = sorted(
+                rng.choice(FRAME_IDS, int(rng.integers(1, 6)), replace=False)
+            )
+            frames, stack = [], []
+            for frame_id in frame_ids:
+                frame_name = f"{frame_id:08d}_semseg_front.png"
+                # Regions of a class, with some ignored and out of range labels
+                labels = rng.integers(0, num_classes, (height // 8, width // 8))
+                labels = np.kron(labels, np.ones((8, 8), dtype=labels.dtype))
+                labels[rng.random(labels.shape) < 0.05] = 255
+                if kind == "ignored" and (s == 0 or rng.random() < 0.5):
+                    labels[:] = 0
+                _write_labels(folders["gt"], seq_name, frame_name, labels)
+
+                if kind == "missing" and (s == 0 or rng.random() < 0.4):
+                    continue
+                if kind == "exact":
+                    pred = labels.copy()
+                elif kind == "few_classes":
+                    pred = rng.choice([1, 2], labels.shape)
+                else:
+                    pred = np.where(
+                        rng.random(labels.shape) < 0.7,
+                        labels,
+                        rng.integers(0, num_classes, labels.shape),
+                    )
+                    pred[pred >= num_classes] = 0
+                _write_labels(folders["png"], seq_name, frame_name, pred)
+                frames.append(frame_name)
+                stack.append(pred)
+            if frames:
+                np.savez(
+                    os.path.join(folders["stack"], seq_name + ".npz"),
+                    data=np.stack(stack).astype(np.uint8),
+                    frames=np.array(frames),
+                )
+        with contextlib.redirect_stdout(io.StringIO()):
+            compile_semseg_gt(folders["gt"], num_classes)
+        yield Case(f"{kind} #{k}", folders)
+
+
+def _write_labels(folder: str, seq_name: str, frame_name: str, labels: np.ndarray):
+    # Labels in the first channel of an RGB png file
+    path = os.path.join(folder, seq_name, frame_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rgb = np.zeros(labels.shape + (3,), dtype=np.uint8)
+    rgb[:, :, 0] = labels
+    rgb[:, :, 1] = 255 - labels.astype(np.uint8)
+    Image.fromarray(rgb).save(path)
+
+
+def semseg_metrics(
+    gt_dir: str,
+    pred_dir: str,
+    gt_cube: Any = None,
+    decoder: str | None = None,
+    num_shards: int = 1,
+) -> dict[str, float]:
+    """
+    Semseg metrics of a prediction folder, as evaluated by main
+
+    Args:
+        gt_dir: ground truth semseg folder
+        pred_dir: prediction folder of png files or stacks
+        gt_cube: compiled ground truth (SemsegGroundTruth)
+        decoder: image decoder, see get_decoder
+        num_shards: number of shards evaluating every n-th sequence into
+            per-sequence states, merged as by shard.py
+    """
+    seqs = sorted(os.listdir(gt_dir))
+    states = []
+    for shard_index in range(num_shards):
+        evaluator = SemanticSegmentationEvaluator(gt_cube=gt_cube)
+        if decoder is not None:
+            evaluator.decoder = get_decoder(decoder)
+        if num_shards == 1:
+            return evaluator.process_from_folder(pred_dir, gt_dir)
+        seq_states = {}
+        evaluator.process_from_folder(
+            pred_dir,
+            gt_dir,
+            used_seqs=seqs[shard_index::num_shards],
+            states=seq_states,
+        )
+        states.extend(seq_states.values())
+    evaluator.merge_states(states)
+    return evaluator.evaluate()
+
+
+def check_semseg(num_cases: int, rng: np.random.Generator) -> dict[str, dict]:
+    """
+    Compare the fast semseg paths with the png reference, see run_check
+
+    Args:
+        num_cases: number of generated cases
+        rng: random generator
+    """
+
+    def reference(case: dict) -> dict[str, float]:
+        return semseg_metrics(case["gt"], case["png"], decoder="pil")
+
+    def cube(case: dict) -> dict[str, float]:
+        gt_cube = open_semseg_gt(case["gt"])
+        return semseg_metrics(case["gt"], case["png"], gt_cube, "pil")
+
+    def stack(case: dict) -> dict[str, float]:
+        return semseg_metrics(case["gt"], case["stack"])
+
+    def shards(case: dict) -> dict[str, float]:
+        return semseg_metrics(case["gt"], case["png"], decoder="pil", num_shards=2)
+
+    def cv2(case: dict) -> dict[str, float]:
+        return semseg_metrics(case["gt"], case["png"], decoder="cv2")
+
+    engines = {"cube": cube, "stack": stack, "shards": shards}
+    if DECODERS["cv2"].available():
+        engines["cv2"] = cv2
+    with tempfile.TemporaryDirectory(prefix="equivalence-") as root:
+        return run_check(semseg_cases(root, num_cases, rng), reference, engines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the fast semseg paths with their reference."
+    )
+    parser.add_argument("--cases", type=int, default=12, help="number of cases")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    results = check_semseg(args.cases, np.random.default_rng(args.seed))
+    rtol, atol = TOLERANCE
+    for name, result in results.items():
+        print(
+            f"semseg/{name}: {result['mismatches']} of {result['cases']} cases "
+            f"differ (rtol {rtol}, atol {atol}), "
+            f"{result['speedup']:.2f}x the speed of the reference"
+        )
+    sys.exit(0 if all(r["mismatches"] == 0 for r in results.values()) else 1)
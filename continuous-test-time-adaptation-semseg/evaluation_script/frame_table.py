@@ -0,0 +1,239 @@
+"""Columnar tables of per-frame evaluation results.
+
+A table is a folder with one .npy file per column and an index.json:
+
+ - <column>.npy: values of all rows, in shape (N, ...), e.g. a per-frame
+   metric in shape (N,) or per-frame confusion counts in shape (N, K, K),
+ - index.json: number of rows, and the dtype, row shape and categories of
+   each column, in order.
+
+Text columns, e.g. sequence names and condition attributes, are stored as
+int32 codes into the categories of the column. FrameTableWriter appends rows
+in batches, e.g. the frames of one sequence, to a raw file per column, so its
+memory use does not grow with the number of frames, and only adds the .npy
+headers when it is closed. read_frame_table memory-maps the columns back.
+
+Example:
+    with FrameTableWriter("frames", attributes) as table:
+        table.append({"sequence": [...], "frame": [...], "silog": [...]})
+    columns = read_frame_table("frames")
+"""
+from __future__ import annotations
+
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+TABLE_VERSION = 1
+# Column names are file names
+_COLUMN_NAME = re.compile(r"^\w+$")
+
+
+def read_sequence_attributes(path: str) -> Dict[str, Dict[str, Any]]:
+    """Attributes of each sequence of a sequence csv file.
+
+    Args:
+        path (str): Path to a *_front_images_seq.csv file.
+    Returns:
+        dict[str, dict]: Attributes of each sequence by video name, float for
+            the columns with numbers only and str for the others.
+    """
+    with open(path, "r") as f:
+        rows = list(csv.DictReader(f))
+    names = [name for name in (rows[0] if rows else {}) if name != "video"]
+    columns = {}
+    for name in names:
+        values = [row[name] for row in rows]
+        try:
+            columns[name] = [float(value) for value in values]
+        except ValueError:
+            columns[name] = values
+    return {
+        row["video"]: {name: columns[name][i] for name in names}
+        for i, row in enumerate(rows)
+    }
+
+
+class FrameTableWriter:
+    """Streaming writer of a frame table."""
+
+    def __init__(
+        self,
+        path: str,
+        attributes: Optional[Dict[str, Dict[str, Any]]] = None,
+        constants: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Start a table, written to its folder when closed.
+
+        Args:
+            path (str): Folder of the table, replaced on close.
+            attributes (dict, optional): Attributes of each sequence, see
+                read_sequence_attributes, added as columns to the rows with a
+                "sequence" column.
+            constants (dict, optional): Values of all rows appended from now
+                on, e.g. the evaluated condition. Can be changed between
+                appends.
+        """
+        self.path = path
+        self.attributes = attributes or {}
+        self.constants = dict(constants or {})
+        self.num_rows = 0
+        # Dtype, row shape and categories of each column, in order
+        self.columns: Dict[str, Dict[str, Any]] = {}
+        self._attribute_names = list(
+            dict.fromkeys(
+                name for values in self.attributes.values() for name in values
+            )
+        )
+        self._codes: Dict[str, Dict[str, int]] = {}
+        self._files: Dict[str, Any] = {}
+        self._tmp_dir: Optional[str] = None
+
+    def __enter__(self) -> FrameTableWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, columns: Dict[str, Any]) -> None:
+        """Append rows to the table.
+
+        Args:
+            columns (dict): Values of the rows by column, all of the same
+                length. Text values are stored as categories, None as "".
+                All appends must have the same columns.
+        """
+        columns = dict(columns)
+        num_rows = len(next(iter(columns.values()), []))
+        for name, value in self.constants.items():
+            columns.setdefault(name, [value] * num_rows)
+        if "sequence" in columns:
+            seqs = list(columns["sequence"])
+            for name in self._attribute_names:
+                columns.setdefault(
+                    name, [self.attributes.get(seq, {}).get(name) for seq in seqs]
+                )
+        if self.columns and set(columns) != set(self.columns):
+            raise ValueError(
+                f"Columns {sorted(columns)} differ from {sorted(self.columns)}"
+            )
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths {sorted(lengths)}")
+        if num_rows == 0:
+            return
+        if self._tmp_dir is None:
+            self._tmp_dir = self._make_tmp_dir()
+        for name, values in columns.items():
+            self._write(name, values)
+        self.num_rows += num_rows
+
+    def _make_tmp_dir(self) -> str:
+        parent = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(parent, exist_ok=True)
+        return tempfile.mkdtemp(prefix=".frame_table-", dir=parent)
+
+    def _write(self, name: str, values: Any) -> None:
+        spec = self.columns.get(name)
+        if spec is None:
+            if not _COLUMN_NAME.match(name):
+                raise ValueError(f"Invalid column name {name!r}")
+            array = np.asarray(values)
+            spec = {"dtype": array.dtype.str, "shape": list(array.shape[1:])}
+            if array.dtype.kind in "OSU":
+                spec.update(dtype=np.dtype(np.int32).str, categories=[])
+                self._codes[name] = {}
+            self.columns[name] = spec
+            self._files[name] = open(os.path.join(self._tmp_dir, name + ".bin"), "wb")
+        if name in self._codes:
+            codes, categories = self._codes[name], spec["categories"]
+            array = np.empty(len(values), dtype=np.int32)
+            for i, value in enumerate(values):
+                value = "" if value is None else str(value)
+                if value not in codes:
+                    codes[value] = len(categories)
+                    categories.append(value)
+                array[i] = codes[value]
+        else:
+            array = np.asarray(values, dtype=spec["dtype"])
+        if list(array.shape[1:]) != spec["shape"]:
+            raise ValueError(
+                f"Rows of column {name} have shape {list(array.shape[1:])}, "
+                f"not {spec['shape']}"
+            )
+        np.ascontiguousarray(array).tofile(self._files[name])
+
+    def close(self) -> None:
+        """Write the table to its folder, replacing any previous table."""
+        if self._tmp_dir is None:
+            self._tmp_dir = self._make_tmp_dir()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        for name, spec in self.columns.items():
+            raw_path = os.path.join(self._tmp_dir, name + ".bin")
+            with open(os.path.join(self._tmp_dir, name + ".npy"), "wb") as f:
+                np.lib.format.write_array_header_1_0(
+                    f,
+                    {
+                        "descr": spec["dtype"],
+                        "fortran_order": False,
+                        "shape": (self.num_rows, *spec["shape"]),
+                    },
+                )
+                with open(raw_path, "rb") as raw:
+                    shutil.copyfileobj(raw, f)
+            os.remove(raw_path)
+        index = {
+            "version": TABLE_VERSION,
+            "num_rows": self.num_rows,
+            "columns": self.columns,
+        }
+        with open(os.path.join(self._tmp_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self._tmp_dir, self.path)
+        self._tmp_dir = None
+
+    def abort(self) -> None:
+        """Drop the rows written so far, keeping any previous table."""
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+
+def read_frame_table(path: str, decode: bool = True) -> Dict[str, np.ndarray]:
+    """Read the columns of a frame table.
+
+    Args:
+        path (str): Folder written by FrameTableWriter.
+        decode (bool): Return the values of the text columns instead of their
+            codes, see the categories in index.json.
+    Returns:
+        dict[str, np.ndarray]: Memory-mapped values of each column, in shape
+            (N, ...), decoded text columns in memory.
+    """
+    with open(os.path.join(path, "index.json"), "r") as f:
+        index = json.load(f)
+    # An empty file cannot be memory-mapped
+    mmap_mode = "r" if index["num_rows"] > 0 else None
+    columns = {}
+    for name, spec in index["columns"].items():
+        values = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+        if decode and "categories" in spec:
+            values = np.array(spec["categories"], dtype=str)[values]
+        columns[name] = values
+    return columns
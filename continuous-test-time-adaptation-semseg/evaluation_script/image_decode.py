@@ -0,0 +1,285 @@
+"""Decode backends for the png files of the image tasks.
+
+An evaluator reads its predictions and targets through an ImageDecoder, which
+decodes only what the evaluator uses: the first rows of the image, e.g. the
+rows kept by the depth crop, and one channel of the color images, e.g. the
+label channel of semseg. The result is written into a buffer of the caller
+when it has the right shape and dtype, so that the same buffer is reused for
+all frames of the same size.
+
+Backends:
+
+ - pil: the default, Pillow. The png decoder is stopped after the requested
+   rows, the remaining compressed data is not inflated.
+ - cv2: OpenCV, if installed, for 8-bit gray, RGB and RGBA and 16-bit gray
+   png files without transparency chunk. Other files, e.g. palette images, are
+   decoded with pil, since OpenCV would convert them.
+
+The backend is chosen with the SHIFT_EVAL_DECODER environment variable, pil
+by default, or auto for the fastest installed one. Run the module on png files
+or folders to check that each backend decodes the same pixels as Pillow, and
+to compare their speed:
+
+    python -m evaluation_script.image_decode submission/depth --rows 740
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Order of the backends tried by "auto", fastest first
+AUTO_ORDER = ["cv2", "pil"]
+
+
+class PngInfo(NamedTuple):
+    """Header of a png file."""
+
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int  # 0 gray, 2 RGB, 3 palette, 4 gray and alpha, 6 RGBA
+    interlaced: bool
+    transparency: bool  # whether a tRNS chunk precedes the image data
+
+
+def read_png_info(path: str) -> Optional[PngInfo]:
+    """Read the header chunks of a png file, up to its image data.
+
+    Args:
+        path (str): Path to the file.
+    Returns:
+        PngInfo | None: Header, None if the file is not a png file.
+    """
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        header = f.read(8 + 13)
+        if len(header) < 21 or header[4:8] != b"IHDR":
+            return None
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+            ">IIBBBBB", header[8:]
+        )
+        transparency = False
+        f.seek(4, os.SEEK_CUR)  # CRC of IHDR
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8 or chunk[4:8] in (b"IDAT", b"IEND"):
+                break
+            if chunk[4:8] == b"tRNS":
+                transparency = True
+            f.seek(struct.unpack(">I", chunk[:4])[0] + 4, os.SEEK_CUR)
+    return PngInfo(width, height, bit_depth, color_type, interlace == 1, transparency)
+
+
+def _into(array: np.ndarray, out: Optional[np.ndarray]) -> np.ndarray:
+    # Copy into the buffer of the caller if it fits, else into a new array
+    if out is not None and out.shape == array.shape and out.dtype == array.dtype:
+        np.copyto(out, array)
+        return out
+    return np.array(array)
+
+
+class ImageDecoder:
+    """Pillow decoder, the reference of the other backends."""
+
+    name = "pil"
+
+    @classmethod
+    def available(cls) -> bool:
+        """Whether the backend is installed."""
+        return True
+
+    def decode(
+        self,
+        path: str,
+        rows: Optional[int] = None,
+        channel: Optional[int] = None,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Decode a png file as np.array(Image.open(path)), or a part of it.
+
+        Args:
+            path (str): Path to the image file.
+            rows (int, optional): Number of rows to decode from the top, all
+                if None or if the image has fewer rows.
+            channel (int, optional): Channel to keep of an image with
+                channels, all if None. Images without channels are kept.
+            out (np.ndarray, optional): Buffer for the result, used if it has
+                its shape and dtype, e.g. the result of the previous frame.
+        Returns:
+            np.ndarray: Pixels, in shape (rows, W) or (rows, W, C), equal to
+                np.array(Image.open(path))[:rows][..., channel].
+        """
+        with Image.open(path) as image:
+            if rows is not None and rows < image.height:
+                self._limit_rows(image, rows)
+            array = np.asarray(image)
+        if channel is not None and array.ndim == 3:
+            array = array[:, :, channel]
+        return _into(array, out)
+
+    @staticmethod
+    def _limit_rows(image: Image.Image, rows: int) -> None:
+        # A single tile of a non-interlaced png is inflated row by row, so the
+        # decoder stops when the shortened tile is full
+        if (
+            image.format != "PNG"
+            or image.info.get("interlace")
+            or len(image.tile) != 1
+            or tuple(image.tile[0][1]) != (0, 0, image.width, image.height)
+        ):
+            return
+        tile = image.tile[0]
+        image.tile = [(tile[0], (0, 0, image.width, rows), *tile[2:])]
+        image._size = (image.width, rows)
+
+
+class Cv2Decoder(ImageDecoder):
+    """OpenCV decoder of the png files it decodes like Pillow."""
+
+    name = "cv2"
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            import cv2  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @staticmethod
+    def supports(info: Optional[PngInfo]) -> bool:
+        """Whether OpenCV decodes a png file to the same pixels as Pillow."""
+        if info is None or info.transparency:
+            return False
+        if info.bit_depth == 8:
+            return info.color_type in (0, 2, 6)
+        return info.bit_depth == 16 and info.color_type == 0
+
+    def decode(
+        self,
+        path: str,
+        rows: Optional[int] = None,
+        channel: Optional[int] = None,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        import cv2
+
+        if not self.supports(read_png_info(path)):
+            return super().decode(path, rows, channel, out)
+        array = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if array is None:
+            return super().decode(path, rows, channel, out)
+        if rows is not None:
+            array = array[:rows]
+        if array.ndim == 3:
+            # BGR(A) to RGB(A)
+            order = [2, 1, 0, 3][: array.shape[2]]
+            array = (
+                array[:, :, order[channel]]
+                if channel is not None
+                else array[:, :, order]
+            )
+        return _into(array, out)
+
+
+DECODERS = {decoder.name: decoder for decoder in (ImageDecoder, Cv2Decoder)}
+
+
+def get_decoder(name: Optional[str] = None) -> ImageDecoder:
+    """Decoder of a backend, falling back to pil if it is not installed.
+
+    Args:
+        name (str, optional): Backend name, or auto for the fastest installed
+            one. Defaults to the SHIFT_EVAL_DECODER environment variable, or
+            pil.
+    Returns:
+        ImageDecoder: Decoder of the backend.
+    """
+    if name is None:
+        name = os.environ.get("SHIFT_EVAL_DECODER", "pil")
+    if name == "auto":
+        name = next(n for n in AUTO_ORDER if DECODERS[n].available())
+    decoder = DECODERS.get(name)
+    if decoder is None or not decoder.available():
+        print(f"Image decoder {name} is not available, using pil")
+        decoder = ImageDecoder
+    return decoder()
+
+
+def _list_pngs(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                files.extend(
+                    os.path.join(root, name)
+                    for name in sorted(names)
+                    if name.endswith(".png")
+                )
+        else:
+            files.append(path)
+    return files
+
+
+def check_decoders(
+    files: List[str], rows: Optional[int] = None, channel: Optional[int] = None
+) -> Dict[str, Dict[str, float]]:
+    """Compare the installed backends with the full Pillow decode.
+
+    Args:
+        files (list[str]): Paths to png files.
+        rows (int, optional): Rows decoded, as in ImageDecoder.decode.
+        channel (int, optional): Channel decoded, as in ImageDecoder.decode.
+    Returns:
+        dict[str, dict[str, float]]: For each installed backend, the number
+            of files decoded to other pixels than the reference under
+            "mismatches" and the mean decode time in ms under "ms".
+    """
+    results = {}
+    for name, decoder_class in DECODERS.items():
+        if not decoder_class.available():
+            continue
+        decoder = decoder_class()
+        mismatches, elapsed, out = 0, 0.0, None
+        for path in files:
+            reference = np.array(Image.open(path))[:rows]
+            if channel is not None and reference.ndim == 3:
+                reference = reference[:, :, channel]
+            start = time.perf_counter()
+            out = decoder.decode(path, rows, channel, out)
+            elapsed += time.perf_counter() - start
+            if out.dtype != reference.dtype or not np.array_equal(out, reference):
+                mismatches += 1
+        results[name] = {
+            "mismatches": mismatches,
+            "ms": 1000 * elapsed / max(1, len(files)),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check and time the image decode backends on png files."
+    )
+    parser.add_argument("paths", nargs="+", help="png files or folders")
+    parser.add_argument("--rows", type=int, default=None, help="rows decoded")
+    parser.add_argument("--channel", type=int, default=None, help="channel kept")
+    args = parser.parse_args()
+
+    files = _list_pngs(args.paths)
+    results = check_decoders(files, args.rows, args.channel)
+    for name, result in results.items():
+        print(
+            f"{name}: {result['ms']:.2f} ms per image, "
+            f"{result['mismatches']} of {len(files)} images differ from Pillow"
+        )
+    sys.exit(0 if all(r["mismatches"] == 0 for r in results.values()) else 1)
@@ -1,3 +1,4 @@
+import contextlib
 import numpy as np
 import os
 import sys
@@ -5,15 +6,38 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.absolute()))
 
+from bootstrap import bootstrap_semseg
+from frame_table import FrameTableWriter, read_sequence_attributes
+from manifest import ImageTask, scan_submission, submission_filter
+from semseg_cube import compile_semseg_gt, open_semseg_gt
 from semseg_eval import SemanticSegmentationEvaluator
 
-from utils import get_used_seqs, unzip_nested
+from utils import SEQ_INFO_PATH_TEST, SEQ_INFO_PATH_VAL, get_used_seqs, unzip_nested
+
+PHASE_SPLITS = {"dev": "val", "test": "test"}
+SUBMISSION_TASKS = [
+    ImageTask(
+        "semseg",
+        modes=("L", "P", "RGB", "RGBA"),
+        stack_dtypes=SemanticSegmentationEvaluator.STACK_DTYPES,
+    )
+]
+# Unzipped ground truth folders, by ground truth zip file
+GT_CACHE = {}
 
 
 def evaluate_shift_multitask(
-    test_annotation_dir, user_submission_dir, max_num_seqs=-1, phase="val"
+    test_annotation_dir,
+    user_submission_dir,
+    max_num_seqs=-1,
+    phase="val",
+    seq_subset=None,
+    seq_states=None,
+    frame_table=None,
 ):
     used_seqs = get_used_seqs(None, split=phase)
+    if seq_subset is not None:
+        used_seqs = [seq for seq in used_seqs if seq in seq_subset]
     if max_num_seqs > 0 and max_num_seqs < len(used_seqs):
         used_seqs = used_seqs[:max_num_seqs]
 
@@ -22,32 +46,95 @@ def evaluate_shift_multitask(
     # Semantic segmentation metrics
     if os.path.exists(os.path.join(user_submission_dir, "semseg")):
         print(">> Evaluating semantic segmentation estimation...")
-        sem_eval = SemanticSegmentationEvaluator()
+        sem_eval = SemanticSegmentationEvaluator(
+            gt_cube=open_semseg_gt(os.path.join(test_annotation_dir, "semseg"))
+        )
         sem_eval.process_from_folder(
             os.path.join(user_submission_dir, "semseg"),
             os.path.join(test_annotation_dir, "semseg"),
             max_num_seqs=max_num_seqs,
             used_seqs=used_seqs,
+            states=seq_states,
+            table=frame_table,
         )
         sem_result = sem_eval.evaluate()
-        result_dict["mIoU"] = sem_result["mIoU"]
-        result_dict["mIoU_drop"] = sem_result["mIoU_drop"]
-        result_dict["mIoU_source"] = sem_result["start_mIoU"]
-        result_dict["mIoU_target"] = sem_result["end_mIoU"]
+        add_semseg_metrics(result_dict, sem_result)
         print(">> Semantic segmentation results:\n", sem_result)
 
     return result_dict
 
 
-def evaluate_shift(test_annotation_dir, user_submission_dir, phase="val"):
+def add_semseg_metrics(result_dict, sem_result):
+    result_dict["mIoU"] = sem_result["mIoU"]
+    result_dict["mIoU_drop"] = sem_result["mIoU_drop"]
+    result_dict["mIoU_source"] = sem_result["start_mIoU"]
+    result_dict["mIoU_target"] = sem_result["end_mIoU"]
+
+
+def evaluate_shift(
+    test_annotation_dir,
+    user_submission_dir,
+    phase="val",
+    seq_subset=None,
+    intervals=None,
+    frame_table=None,
+):
+    """
+    Evaluate SHIFT challenge submission
+
+    Args:
+        test_annotation_dir: directory of the test annotation
+        user_submission_dir: directory of the user submission
+        phase: val or test
+        seq_subset: if given, only the sequences in it are evaluated
+        intervals: if given, filled with the bootstrap confidence interval of
+            each score over the sequences, see bootstrap.py
+        frame_table: if given, folder of a table of the confusion counts of
+            each frame, with the sequence attributes, see frame_table.py
+    """
+    seq_states = {} if intervals is not None else None
+    if frame_table is not None:
+        seq_info_path = SEQ_INFO_PATH_VAL if phase == "val" else SEQ_INFO_PATH_TEST
+        writer = FrameTableWriter(frame_table, read_sequence_attributes(seq_info_path))
+    else:
+        writer = contextlib.nullcontext()
     result_dict = {}
-    result_dict = evaluate_shift_multitask(
-        test_annotation_dir, user_submission_dir, phase=phase
-    )
-    result_dict["overall"] = result_dict["mIoU"] - 2 * result_dict["mIoU_drop"]
+    with writer as table:
+        result_dict = evaluate_shift_multitask(
+            test_annotation_dir,
+            user_submission_dir,
+            phase=phase,
+            seq_subset=seq_subset,
+            seq_states=seq_states,
+            frame_table=table,
+        )
+    add_overall_metric(result_dict)
+    if intervals is not None:
+        intervals.update(bootstrap_semseg(seq_states))
     return result_dict
 
 
+def add_overall_metric(result_dict):
+    result_dict["overall"] = result_dict["mIoU"] - 2 * result_dict["mIoU_drop"]
+
+
+def prepare_ground_truth(test_annotation_file):
+    """
+    Unzip the ground truth once per process and compile the label maps into
+    a memory-mapped cube, which is reused while the png files are unchanged
+
+    Args:
+        test_annotation_file: path to the ground truth zip file
+    """
+    if test_annotation_file not in GT_CACHE:
+        unzip_nested(test_annotation_file)
+        GT_CACHE[test_annotation_file] = test_annotation_file[:-4]
+        semseg_dir = os.path.join(GT_CACHE[test_annotation_file], "semseg")
+        if os.path.isdir(semseg_dir):
+            compile_semseg_gt(semseg_dir)
+    return GT_CACHE[test_annotation_file]
+
+
 def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwargs):
     """
     Evaluates the submission for a particular challenge phase and returns score
@@ -60,7 +147,10 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
         `**kwargs`: keyword arguments that contains additional submission
         metadata that challenge hosts can use to send slack notification.
         You can access the submission metadata
-        with kwargs['submission_metadata']
+        with kwargs['submission_metadata']. A folder in kwargs['frame_table']
+        receives a table of the per-frame results, see frame_table.py. If
+        kwargs['confidence_intervals'] is set, the output also holds the 95%
+        bootstrap confidence interval of each score, see bootstrap.py.
 
         Example: A sample submission metadata can be accessed like this:
         >>> print(kwargs['submission_metadata'])
@@ -97,31 +187,63 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
         user_submission_file[-4:] == ".zip"
     ), "User submission file should be a zip file"
 
+    # Reject obviously broken submissions before unzipping and evaluation
+    keep = None
+    if phase_codename in PHASE_SPLITS:
+        print("Scanning submission...")
+        used_seqs = get_used_seqs(None, split=PHASE_SPLITS[phase_codename])
+        report = scan_submission(
+            user_submission_file, test_annotation_file, SUBMISSION_TASKS, used_seqs
+        )
+        print(report)
+        assert report.ok, "Submission rejected: {}".format(
+            "; ".join(report.fatal_errors)
+        )
+
+        # Only the files of the used sequences are extracted
+        keep = submission_filter(SUBMISSION_TASKS, used_seqs)
+
     # Unzip the annotation files
     print("Start unzipping...")
     user_submission_dir = user_submission_file[:-4]
-    unzip_nested(user_submission_file)
-    test_annotation_dir = test_annotation_file[:-4]
-    unzip_nested(test_annotation_file)
+    unzip_nested(user_submission_file, keep)
+    test_annotation_dir = prepare_ground_truth(test_annotation_file)
     print("Unzipping completed.")
 
     output = {}
+    intervals = {} if kwargs.get("confidence_intervals") else None
     if phase_codename == "dev":
         print("Evaluation phase: Dev")
         result_dict = evaluate_shift(
-            test_annotation_dir, user_submission_dir, phase="val"
+            test_annotation_dir,
+            user_submission_dir,
+            phase="val",
+            intervals=intervals,
+            frame_table=kwargs.get("frame_table"),
         )
         output["result"] = [{"val_split": result_dict}]
         output["submission_result"] = output["result"][0]["val_split"]
+        if intervals is not None:
+            # 95% bootstrap confidence intervals, next to the scores
+            output["confidence_intervals"] = intervals
+            print("Confidence intervals:", intervals)
         print("Completed evaluation for Dev Phase")
         print(result_dict)
     elif phase_codename == "test":
         print("Evaluation phase: Test")
         result_dict = evaluate_shift(
-            test_annotation_dir, user_submission_dir, phase="test"
+            test_annotation_dir,
+            user_submission_dir,
+            phase="test",
+            intervals=intervals,
+            frame_table=kwargs.get("frame_table"),
         )
         output["result"] = [{"test_split": result_dict}]
         output["submission_result"] = output["result"][0]["test_split"]
+        if intervals is not None:
+            # 95% bootstrap confidence intervals, next to the scores
+            output["confidence_intervals"] = intervals
+            print("Confidence intervals:", intervals)
         print("Completed evaluation for Test Phase")
     return output
 
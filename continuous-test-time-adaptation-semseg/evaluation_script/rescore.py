@@ -0,0 +1,168 @@
+"""Batch re-scoring of past submissions against resident ground truth.
+
+The ground truth of every phase is unzipped, compiled and parsed once, then a
+pool of forked processes shares it copy-on-write and evaluates the submissions
+one after the other. Each result is appended to a json lines table as soon as
+it is known, so an interrupted run resumes with the submissions missing from
+the table. Failed submissions are only evaluated again with --retry-errors,
+and the last row of a submission in the table is the current one.
+
+Example:
+    python -m evaluation_script.rescore --gt dev=val_gt.zip \
+        --gt test=test_gt.zip --workers 8 --table rescored.jsonl requests.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+from daemon import LocalWorker, dump_output, parse_ground_truths
+
+# Submissions evaluated by a pool process before it is replaced by a fresh
+# fork, to bound the memory left over by past submissions
+TASKS_PER_PROCESS = 32
+
+# Worker of the pool processes, inherited through fork
+_WORKER: Optional[LocalWorker] = None
+
+
+def request_key(request: dict) -> Tuple[str, str]:
+    """Key of a request in the table."""
+    return (
+        os.path.abspath(request["user_submission_file"]),
+        request["phase_codename"],
+    )
+
+
+def read_table(table_path: str, retry_errors: bool = False) -> Set[Tuple[str, str]]:
+    """Keys of the requests already in a table.
+
+    Args:
+        table_path (str): Path to the json lines table.
+        retry_errors (bool): Leave out the requests which failed.
+    Returns:
+        set[tuple[str, str]]: Submission file and phase of each row.
+    """
+    keys = set()
+    if not os.path.exists(table_path):
+        return keys
+    with open(table_path, "r") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # Last row cut off by an interruption
+                continue
+            if retry_errors and "error" in row:
+                continue
+            keys.add(request_key(row))
+    return keys
+
+
+def _rescore(request: dict) -> Tuple[dict, dict, float]:
+    start = time.time()
+    output = _WORKER.handle_request(request)
+    return request, output, time.time() - start
+
+
+def rescore(
+    worker: LocalWorker,
+    requests: List[dict],
+    num_workers: int = 1,
+) -> Iterator[dict]:
+    """Evaluate submissions in forked processes sharing the ground truth.
+
+    Args:
+        worker (LocalWorker): Worker holding the resident ground truth.
+        requests (list[dict]): Requests with the keys "user_submission_file",
+            "phase_codename" and optionally "submission_metadata".
+        num_workers (int): Number of concurrent evaluations.
+    Yields:
+        dict: Row of the table for each request, in completion order.
+    """
+    global _WORKER
+    _WORKER = worker
+    # Do not duplicate buffered output in the children
+    sys.stdout.flush()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(num_workers, maxtasksperchild=TASKS_PER_PROCESS) as pool:
+        for request, output, seconds in pool.imap_unordered(_rescore, requests):
+            user_submission_file, phase_codename = request_key(request)
+            row = {
+                "user_submission_file": user_submission_file,
+                "phase_codename": phase_codename,
+                "seconds": seconds,
+            }
+            if "error" in output:
+                row["error"] = output["error"]
+            else:
+                row["submission_result"] = output["submission_result"]
+                if "confidence_intervals" in output:
+                    row["confidence_intervals"] = output["confidence_intervals"]
+            yield row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--gt",
+        action="append",
+        required=True,
+        help="ground truth zip file of a phase, as PHASE=PATH",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="pool processes"
+    )
+    parser.add_argument(
+        "--table", required=True, help="json lines table the results are added to"
+    )
+    parser.add_argument(
+        "--retry-errors", action="store_true", help="evaluate failed rows again"
+    )
+    parser.add_argument(
+        "--confidence-intervals",
+        action="store_true",
+        help="add the bootstrap confidence intervals of the scores to the rows",
+    )
+    parser.add_argument(
+        "requests", help="json lines file of requests to evaluate, '-' for stdin"
+    )
+    args = parser.parse_args()
+
+    f = sys.stdin if args.requests == "-" else open(args.requests, "r")
+    with f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    done = read_table(args.table, args.retry_errors)
+    pending, seen = [], set(done)
+    for request in requests:
+        if request_key(request) not in seen:
+            seen.add(request_key(request))
+            if args.confidence_intervals:
+                request["confidence_intervals"] = True
+            pending.append(request)
+    print(f"{len(requests) - len(pending)} submissions in the table already")
+    if pending:
+        worker = LocalWorker(parse_ground_truths(args.gt))
+        with open(args.table, "ab+") as table:
+            table.seek(0, os.SEEK_END)
+            if table.tell() > 0:
+                table.seek(-1, os.SEEK_END)
+                if table.read(1) != b"\n":
+                    # Terminate a row cut off by an interruption
+                    table.write(b"\n")
+            for i, row in enumerate(rescore(worker, pending, args.workers)):
+                table.write(dump_output(row) + b"\n")
+                table.flush()
+                status = row.get("error") or row["submission_result"].get("overall")
+                print(
+                    f"[{i + 1}/{len(pending)}] {row['user_submission_file']}"
+                    f" ({row['phase_codename']}): {status}"
+                )
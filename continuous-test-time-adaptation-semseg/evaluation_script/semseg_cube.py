@@ -0,0 +1,243 @@
+"""Precompiled, memory-mapped semantic segmentation ground truth.
+
+The ground truth label maps are decoded once into a folder next to the ground
+truth semseg tree:
+
+ - labels.npy: labels of all frames, in shape (N, H, W), uint8,
+ - valid.npy: masks of the pixels counted in the confusion matrices, bool,
+ - index.json: frame names, frame ids and windows (start, end, loop_back) of
+   each sequence, and the signature of the png files.
+
+The evaluator reads the targets as views of the memory-mapped arrays, so only
+the predictions are decoded per submission.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from semseg_eval import WINDOW_OF_FRAME, SemanticSegmentationEvaluator, SemsegTarget
+
+CUBE_VERSION = 1
+# Compiled ground truth, by semseg folder
+SEMSEG_GT_CACHE = {}
+
+
+class SemsegGroundTruth:
+    """Memory-mapped compiled semantic segmentation ground truth."""
+
+    def __init__(self, cube_dir: str) -> None:
+        """Open a compiled ground truth folder.
+
+        Args:
+            cube_dir (str): Folder written by compile_semseg_gt.
+        """
+        with open(os.path.join(cube_dir, "index.json"), "r") as f:
+            self.index = json.load(f)
+        self.num_classes = self.index["num_classes"]
+        self.class_to_ignore = self.index["class_to_ignore"]
+        self.labels = np.load(os.path.join(cube_dir, "labels.npy"), mmap_mode="r")
+        self.valid = np.load(os.path.join(cube_dir, "valid.npy"), mmap_mode="r")
+        self.frames = {}
+        for seq_name, seq in self.index["seqs"].items():
+            for i, frame_name in enumerate(seq["frame_names"]):
+                self.frames[(seq_name, frame_name)] = seq["start"] + i
+        self.windows = self.index["windows"]
+        self.broken = set(self.index["broken"])
+
+    def frame_names(self, seq_name: str) -> list[str]:
+        """Frame names of a sequence, in evaluation order.
+
+        Args:
+            seq_name (str): Name of the sequence.
+        Returns:
+            list[str]: Frame names, empty for an unknown sequence.
+        """
+        if seq_name not in self.index["seqs"]:
+            return []
+        return self.index["seqs"][seq_name]["frame_names"]
+
+    def target(self, seq_name: str, frame_name: str) -> SemsegTarget:
+        """Target of a frame, as views of the memory-mapped arrays.
+
+        Args:
+            seq_name (str): Name of the sequence.
+            frame_name (str): Name of the frame.
+        Returns:
+            SemsegTarget: Labels, valid mask and window of the frame.
+        """
+        k = self.frames[(seq_name, frame_name)]
+        if k in self.broken:
+            raise ValueError(f"Ground truth {seq_name}/{frame_name} is unreadable")
+        return SemsegTarget(self.labels[k], self.valid[k], self.windows[k])
+
+
+def cube_path(semseg_dir: str) -> str:
+    """Folder of the compiled ground truth of a semseg folder.
+
+    Args:
+        semseg_dir (str): Ground truth semseg folder.
+    Returns:
+        str: Path of the compiled ground truth folder.
+    """
+    return os.path.normpath(semseg_dir) + "_cube"
+
+
+def _list_frames(semseg_dir: str) -> dict[str, list[str]]:
+    evaluator = SemanticSegmentationEvaluator()
+    return {
+        seq_name: evaluator.list_targets(semseg_dir, seq_name)
+        for seq_name in sorted(os.listdir(semseg_dir))
+        if os.path.isdir(os.path.join(semseg_dir, seq_name))
+    }
+
+
+def _signature(semseg_dir: str, seqs: dict[str, list[str]]) -> str:
+    # Content hash of the png files, since unzipping resets their mtimes
+    digest = hashlib.sha1(str(CUBE_VERSION).encode())
+    for seq_name, frame_names in seqs.items():
+        for frame_name in frame_names:
+            digest.update(f"{seq_name}/{frame_name}".encode())
+            with open(os.path.join(semseg_dir, seq_name, frame_name), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def compile_semseg_gt(
+    semseg_dir: str, num_classes: int = 23, class_to_ignore: int = 0
+) -> SemsegGroundTruth:
+    """Compile a ground truth semseg folder, unless it is already compiled.
+
+    Args:
+        semseg_dir (str): Ground truth semseg folder, with a folder of png
+            files per sequence.
+        num_classes (int): Number of classes of the evaluator.
+        class_to_ignore (int): Ignored class of the evaluator.
+    Returns:
+        SemsegGroundTruth: The compiled ground truth.
+    """
+    cube_dir = cube_path(semseg_dir)
+    seqs = _list_frames(semseg_dir)
+    signature = _signature(semseg_dir, seqs)
+    cube = _open_if_current(cube_dir, signature, num_classes, class_to_ignore)
+    if cube is None:
+        print(f"Compiling semseg ground truth into {cube_dir}...")
+        evaluator = SemanticSegmentationEvaluator(num_classes, class_to_ignore)
+        tmp_dir = tempfile.mkdtemp(
+            prefix=".semseg_cube-", dir=os.path.dirname(cube_dir)
+        )
+        index = {
+            "version": CUBE_VERSION,
+            "signature": signature,
+            "num_classes": num_classes,
+            "class_to_ignore": class_to_ignore,
+        }
+        index.update(_write_cube(tmp_dir, semseg_dir, seqs, evaluator))
+        with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+        if os.path.exists(cube_dir):
+            shutil.rmtree(cube_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, cube_dir)
+        except OSError:
+            # Another process compiled the same ground truth meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        cube = SemsegGroundTruth(cube_dir)
+    SEMSEG_GT_CACHE[os.path.normpath(semseg_dir)] = cube
+    return cube
+
+
+def _open_if_current(
+    cube_dir: str, signature: str, num_classes: int, class_to_ignore: int
+) -> SemsegGroundTruth | None:
+    try:
+        cube = SemsegGroundTruth(cube_dir)
+    except (OSError, ValueError, KeyError):
+        return None
+    if (
+        cube.index.get("version") != CUBE_VERSION
+        or cube.index.get("signature") != signature
+        or (cube.num_classes, cube.class_to_ignore) != (num_classes, class_to_ignore)
+    ):
+        return None
+    return cube
+
+
+def _write_cube(
+    cube_dir: str,
+    semseg_dir: str,
+    seqs: dict[str, list[str]],
+    evaluator: SemanticSegmentationEvaluator,
+) -> dict:
+    frames = [
+        (seq_name, frame_name)
+        for seq_name, frame_names in seqs.items()
+        for frame_name in frame_names
+    ]
+    shape = None
+    labels, valid = None, None
+    broken = []
+    for k, (seq_name, frame_name) in enumerate(frames):
+        try:
+            with open(os.path.join(semseg_dir, seq_name, frame_name), "rb") as f:
+                target = np.array(Image.open(io.BytesIO(f.read())))
+            target = evaluator.preprocess(target)
+        except Exception as e:
+            print(f"Error when compiling {seq_name}/{frame_name}: {e}")
+            broken.append(k)
+            continue
+        if labels is None:
+            shape = (len(frames),) + target.shape
+            labels = np.lib.format.open_memmap(
+                os.path.join(cube_dir, "labels.npy"), "w+", np.uint8, shape
+            )
+            valid = np.lib.format.open_memmap(
+                os.path.join(cube_dir, "valid.npy"), "w+", np.bool_, shape
+            )
+        if target.shape != shape[1:]:
+            print(f"Error when compiling {seq_name}/{frame_name}: size mismatch")
+            broken.append(k)
+            continue
+        labels[k] = target
+        valid[k] = evaluator.valid_mask(target)
+    if labels is None:
+        shape = (len(frames), 0, 0)
+        labels = np.lib.format.open_memmap(
+            os.path.join(cube_dir, "labels.npy"), "w+", np.uint8, shape
+        )
+        valid = np.lib.format.open_memmap(
+            os.path.join(cube_dir, "valid.npy"), "w+", np.bool_, shape
+        )
+    labels.flush()
+    valid.flush()
+    del labels, valid
+
+    seq_index, windows, start = {}, [], 0
+    for seq_name, frame_names in seqs.items():
+        frame_ids = [int(frame_name.split("_")[0]) for frame_name in frame_names]
+        seq_index[seq_name] = {
+            "start": start,
+            "frame_names": frame_names,
+            "frame_ids": frame_ids,
+        }
+        windows.extend(WINDOW_OF_FRAME.get(frame_id) for frame_id in frame_ids)
+        start += len(frame_names)
+    return {"seqs": seq_index, "windows": windows, "broken": broken}
+
+
+def open_semseg_gt(semseg_dir: str) -> SemsegGroundTruth | None:
+    """Compiled ground truth of a semseg folder, if compiled by this process.
+
+    Args:
+        semseg_dir (str): Ground truth semseg folder.
+    Returns:
+        SemsegGroundTruth | None: The compiled ground truth, if any.
+    """
+    return SEMSEG_GT_CACHE.get(os.path.normpath(semseg_dir))
@@ -1,18 +1,50 @@
 """SHIFT depth evaluation."""
 from __future__ import annotations
 
+from typing import Any, NamedTuple
+
 import numpy as np
 
 from common import Evaluator
 
+# Frame id of each window with its own confusion matrix
+WINDOW_FRAMES = {"start": 0, "end": 200, "loop_back": 400}
+WINDOW_OF_FRAME = {frame_id: window for window, frame_id in WINDOW_FRAMES.items()}
+
+
+class SemsegTarget(NamedTuple):
+    """Precompiled target of a frame, see semseg_cube."""
+
+    labels: np.ndarray  # label map, in shape (H, W)
+    valid: np.ndarray  # pixels counted in the confusion matrices
+    window: str | None  # window of the frame, see WINDOW_FRAMES
+
 
 class SemanticSegmentationEvaluator(Evaluator):
     METRICS = ["mIoU", "mAcc", "start_mIoU", "end_mIoU"]
+    STACK_DTYPES = ("uint8",)
+    # Labels are read from the first channel of color images, see preprocess
+    DECODE_CHANNEL = 0
 
-    def __init__(self, num_classes: int = 23, class_to_ignore: int = 0) -> None:
-        """Initialize the semantic segmentation evaluator."""
+    def __init__(
+        self, num_classes: int = 23, class_to_ignore: int = 0, gt_cube: Any = None
+    ) -> None:
+        """Initialize the semantic segmentation evaluator.
+
+        Args:
+            num_classes (int): Number of classes.
+            class_to_ignore (int): Class not counted in the confusion matrices.
+            gt_cube (SemsegGroundTruth, optional): Compiled ground truth to read
+                the targets from instead of decoding the png files.
+        """
         self.num_classes = num_classes
         self.class_to_ignore = class_to_ignore
+        if gt_cube is not None:
+            assert (gt_cube.num_classes, gt_cube.class_to_ignore) == (
+                num_classes,
+                class_to_ignore,
+            ), "Ground truth cube was compiled for other classes"
+        self.gt_cube = gt_cube
         super().__init__()
 
     def reset(self) -> None:
@@ -23,6 +55,31 @@ class SemanticSegmentationEvaluator(Evaluator):
         self._confusion_matrix_loop_back = np.zeros(
             (self.num_classes, self.num_classes)
         )
+        # Confusion matrix and window of each processed frame, by frame id,
+        # while record_frames is set
+        self._frame_confusions: dict[int, tuple[np.ndarray, str | None]] = {}
+
+    def get_state(self) -> dict[str, np.array]:
+        """Return the confusion matrices accumulated since the last reset."""
+        return {
+            "all": self._confusion_matrix.copy(),
+            "start": self._confusion_matrix_start.copy(),
+            "end": self._confusion_matrix_end.copy(),
+            "loop_back": self._confusion_matrix_loop_back.copy(),
+        }
+
+    def merge_states(self, states: list[dict[str, np.array]]) -> None:
+        """Replace the confusion matrices by the sum of partial states.
+
+        The matrices hold integer pixel counts, so the sum does not depend on
+        the order of the states.
+        """
+        self.reset()
+        for state in states:
+            self._confusion_matrix += state["all"]
+            self._confusion_matrix_start += state["start"]
+            self._confusion_matrix_end += state["end"]
+            self._confusion_matrix_loop_back += state["loop_back"]
 
     def append_empty_sample(self, frame_id: int) -> None:
         """Append an empty sample to the evaluation."""
@@ -38,6 +95,14 @@ class SemanticSegmentationEvaluator(Evaluator):
                 (self.num_classes, self.num_classes)
             )
 
+    def append_empty_samples(self, frame_ids: list[int]) -> None:
+        """Append empty samples to the evaluation.
+
+        An empty sample adds no pixel to any confusion matrix, so nothing needs
+        to be accumulated for them.
+        """
+        pass
+
     def calc_confusion_matrix(self, prediction: np.array, target: np.array) -> np.array:
         """Calculate the confusion matrix.
         Args:
@@ -46,16 +111,50 @@ class SemanticSegmentationEvaluator(Evaluator):
         Returns:
             np.array: Confusion matrix.
         """
-        mask = (
+        mask = self.valid_mask(target)
+        return np.bincount(
+            self.num_classes * target[mask].astype(np.int32) + prediction[mask],
+            minlength=self.num_classes**2,
+        ).reshape(self.num_classes, self.num_classes)
+
+    def valid_mask(self, target: np.array) -> np.array:
+        """Mask of the target pixels counted in the confusion matrices."""
+        return (
             (target >= 0)
             & (target < self.num_classes)
             & (target != self.class_to_ignore)
         )
+
+    def calc_compiled_confusion_matrix(
+        self, prediction: np.array, target: SemsegTarget
+    ) -> np.array:
+        """Calculate the confusion matrix against a precompiled target.
+
+        Args:
+            prediction (np.array): Prediction semantic segmentation map, in shape
+                (H, W).
+            target (SemsegTarget): Precompiled target, with the same shape.
+        Returns:
+            np.array: Confusion matrix.
+        """
+        mask = target.valid
         return np.bincount(
-            self.num_classes * target[mask].astype(np.int32) + prediction[mask],
+            self.num_classes * target.labels[mask].astype(np.int32) + prediction[mask],
             minlength=self.num_classes**2,
         ).reshape(self.num_classes, self.num_classes)
 
+    def list_targets(self, target_folder_path: str, seq_name: str) -> list[str]:
+        if self.gt_cube is not None:
+            return self.gt_cube.frame_names(seq_name)
+        return super().list_targets(target_folder_path, seq_name)
+
+    def load_target(
+        self, target_folder_path: str, seq_name: str, frame_name: str
+    ) -> Any:
+        if self.gt_cube is not None:
+            return self.gt_cube.target(seq_name, frame_name)
+        return super().load_target(target_folder_path, seq_name, frame_name)
+
     def preprocess(self, data: np.array) -> np.array:
         if len(data.shape) == 3:
             return data.astype(np.uint8)[:, :, 0]
@@ -65,19 +164,48 @@ class SemanticSegmentationEvaluator(Evaluator):
         """Process a batch of data.
         Args:
             prediction (np.array): Prediction semantic segmentation map.
-            target (np.array): Target semantic segmentation map.
+            target (np.array): Target semantic segmentation map, or a
+                precompiled SemsegTarget.
         """
-        self._confusion_matrix += self.calc_confusion_matrix(prediction, target)
-        if frame == 0:
-            self._confusion_matrix_start += self.calc_confusion_matrix(
-                prediction, target
-            )
-        elif frame == 200:
-            self._confusion_matrix_end += self.calc_confusion_matrix(prediction, target)
-        elif frame == 400:
-            self._confusion_matrix_loop_back += self.calc_confusion_matrix(
-                prediction, target
+        if isinstance(target, SemsegTarget):
+            confusion_matrix = self.calc_compiled_confusion_matrix(prediction, target)
+            window = target.window
+        else:
+            confusion_matrix = self.calc_confusion_matrix(prediction, target)
+            window = WINDOW_OF_FRAME.get(frame)
+        if self.record_frames:
+            self._frame_confusions[frame] = (confusion_matrix, window)
+        self._confusion_matrix += confusion_matrix
+        if window == "start":
+            self._confusion_matrix_start += confusion_matrix
+        elif window == "end":
+            self._confusion_matrix_end += confusion_matrix
+        elif window == "loop_back":
+            self._confusion_matrix_loop_back += confusion_matrix
+
+    def frame_results(self, frame_ids: list[int]) -> dict[str, Any]:
+        """Confusion counts and window of each frame of the last processed sequence.
+
+        Frames without a valid prediction have zero counts.
+
+        Args:
+            frame_ids (list[int]): Frame ids of the frames.
+        Returns:
+            dict[str, Any]: "window" of each frame and its "confusion" counts,
+                in shape (N, K, K) with the target class first.
+        """
+        confusion = np.zeros(
+            (len(frame_ids), self.num_classes, self.num_classes), dtype=np.int32
+        )
+        windows = []
+        for k, frame_id in enumerate(frame_ids):
+            frame_confusion, window = self._frame_confusions.pop(
+                frame_id, (None, WINDOW_OF_FRAME.get(frame_id))
             )
+            if frame_confusion is not None:
+                confusion[k] = frame_confusion
+            windows.append(window)
+        return {"window": windows, "confusion": confusion}
 
     def evaluate(self) -> dict[str, float]:
         """Evaluate all predictions according to given metric.
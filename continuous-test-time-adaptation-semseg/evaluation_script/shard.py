@@ -0,0 +1,209 @@
+"""Sharded evaluation with mergeable partial states.
+
+A large submission can be evaluated by several workers sharing a filesystem.
+Each worker evaluates every n-th sequence of the phase ("map") and writes the
+confusion matrices of its sequences. The reducer sums the states of all
+shards, in any order, into the same output dict as evaluate() on a single node.
+
+Example:
+    python -m evaluation_script.shard map --gt gt.zip --submission sub.zip \
+        --phase dev --num-shards 8 --shard-index 0 --output-dir /shared/sub
+    python -m evaluation_script.shard reduce --output-dir /shared/sub
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import pickle
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.append(str(Path(__file__).parent.absolute()))
+
+from main import PHASE_SPLITS, SUBMISSION_TASKS, add_overall_metric, add_semseg_metrics
+from manifest import submission_filter
+from semseg_eval import SemanticSegmentationEvaluator
+from utils import get_used_seqs, unzip_nested
+
+SHARD_STATE_VERSION = 1
+
+
+def shard_seqs(seqs: List[str], num_shards: int, shard_index: int) -> List[str]:
+    """Sequences evaluated by a shard."""
+    assert 0 <= shard_index < num_shards, "shard_index must be below num_shards"
+    return seqs[shard_index::num_shards]
+
+
+def evaluate_shard(
+    test_annotation_dir: str,
+    user_submission_dir: str,
+    phase: str = "val",
+    num_shards: int = 1,
+    shard_index: int = 0,
+) -> Dict:
+    """
+    Evaluate the sequences of one shard into a partial state
+
+    Args:
+        test_annotation_dir: unzipped ground truth folder
+        user_submission_dir: unzipped submission folder
+        phase: val or test
+        num_shards: total number of shards
+        shard_index: index of this shard
+    """
+    seqs = set(shard_seqs(get_used_seqs(None, split=phase), num_shards, shard_index))
+    state = {
+        "version": SHARD_STATE_VERSION,
+        "phase": phase,
+        "num_shards": num_shards,
+        "shard_index": shard_index,
+        "seqs": sorted(seqs),
+        "tasks": {},
+    }
+
+    # Semantic segmentation metrics
+    if os.path.exists(os.path.join(user_submission_dir, "semseg")):
+        print(">> Evaluating semantic segmentation estimation...")
+        sem_states = {}
+        SemanticSegmentationEvaluator().process_from_folder(
+            os.path.join(user_submission_dir, "semseg"),
+            os.path.join(test_annotation_dir, "semseg"),
+            used_seqs=seqs,
+            states=sem_states,
+        )
+        state["tasks"]["semseg"] = sem_states
+    return state
+
+
+def reduce_shards(states: List[Dict]) -> Dict:
+    """
+    Merge the partial states of all shards into the output of evaluate()
+
+    Args:
+        states: partial states of all shards, in any order
+    """
+    phase = states[0]["phase"]
+    num_shards = states[0]["num_shards"]
+    tasks = set(states[0]["tasks"])
+    for state in states:
+        assert state["version"] == SHARD_STATE_VERSION, "Incompatible shard state"
+        assert state["phase"] == phase and state["num_shards"] == num_shards
+        assert set(state["tasks"]) == tasks, "Shards evaluated different tasks"
+    shard_indices = sorted(state["shard_index"] for state in states)
+    assert shard_indices == list(
+        range(num_shards)
+    ), f"Expected {num_shards} shards, got {shard_indices}"
+
+    result_dict = {}
+    if "semseg" in tasks:
+        sem_eval = SemanticSegmentationEvaluator()
+        sem_eval.merge_states(
+            [
+                seq_state
+                for state in states
+                for seq_state in state["tasks"]["semseg"].values()
+            ]
+        )
+        add_semseg_metrics(result_dict, sem_eval.evaluate())
+    add_overall_metric(result_dict)
+
+    split = "val_split" if phase == "val" else "test_split"
+    output = {"result": [{split: result_dict}]}
+    output["submission_result"] = output["result"][0][split]
+    return output
+
+
+def state_path(output_dir: str, num_shards: int, shard_index: int) -> str:
+    """Path of the state file of a shard."""
+    return os.path.join(output_dir, f"shard-{shard_index:05d}-of-{num_shards:05d}.pkl")
+
+
+def write_state(state: Dict, output_dir: str) -> str:
+    """Write the state of a shard atomically, for readers on other nodes."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = state_path(output_dir, state["num_shards"], state["shard_index"])
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=output_dir, suffix=".tmp", delete=False
+    ) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, path)
+    return path
+
+
+def read_states(output_dir: str) -> List[Dict]:
+    """Read the states of all shards in a folder."""
+    states = []
+    for path in sorted(glob.glob(os.path.join(output_dir, "shard-*-of-*.pkl"))):
+        with open(path, "rb") as f:
+            states.append(pickle.load(f))
+    assert states, f"No shard state found in {output_dir}"
+    return states
+
+
+def extract(zip_path: str, work_dir: str, keep=None) -> str:
+    """
+    Unzip a zip file into a worker-local folder and return its path
+
+    Args:
+        zip_path: zip file
+        work_dir: worker-local folder
+        keep: filter of the extracted files, see unzip_nested
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    link_path = os.path.join(work_dir, os.path.basename(zip_path))
+    if not os.path.exists(link_path):
+        os.symlink(os.path.abspath(zip_path), link_path)
+    unzip_nested(link_path, keep)
+    return link_path[:-4]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="step", required=True)
+    map_parser = subparsers.add_parser("map", help="evaluate one shard")
+    map_parser.add_argument("--gt", required=True, help="ground truth zip file")
+    map_parser.add_argument("--submission", required=True, help="submission zip file")
+    map_parser.add_argument("--phase", required=True, choices=sorted(PHASE_SPLITS))
+    map_parser.add_argument("--num-shards", type=int, required=True)
+    map_parser.add_argument("--shard-index", type=int, required=True)
+    map_parser.add_argument("--output-dir", required=True, help="shared state folder")
+    map_parser.add_argument(
+        "--work-dir", help="worker-local folder to unzip into, default a temp folder"
+    )
+    reduce_parser = subparsers.add_parser("reduce", help="merge all shards")
+    reduce_parser.add_argument(
+        "--output-dir", required=True, help="shared state folder"
+    )
+    reduce_parser.add_argument("--output", help="json file for the output dict")
+    args = parser.parse_args()
+
+    if args.step == "map":
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix="shift-shard-")
+        # Only the submission files of the sequences of the shard are extracted
+        seqs = shard_seqs(
+            get_used_seqs(None, split=PHASE_SPLITS[args.phase]),
+            args.num_shards,
+            args.shard_index,
+        )
+        state = evaluate_shard(
+            extract(args.gt, os.path.join(work_dir, "gt")),
+            extract(
+                args.submission,
+                os.path.join(work_dir, "submission"),
+                submission_filter(SUBMISSION_TASKS, seqs),
+            ),
+            phase=PHASE_SPLITS[args.phase],
+            num_shards=args.num_shards,
+            shard_index=args.shard_index,
+        )
+        print("Wrote", write_state(state, args.output_dir))
+    else:
+        output = reduce_shards(read_states(args.output_dir))
+        print(output["submission_result"])
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(output, f, default=float)
@@ -0,0 +1,128 @@
+"""Per-sequence binary prediction stacks.
+
+Besides one png file per frame, image tasks accept one array file per
+sequence in the task folder, which skips the png encoding and decoding:
+
+ - <task>/<seq>.npy: array of shape (N, H, W) with the N ground truth frames of
+   the sequence, in the order of their sorted names,
+ - <task>/<seq>.npz: array "data" of shape (N, H, W) and optionally an array
+   "frames" of the N frame names, for a subset of the frames in any order.
+
+The accepted dtypes depend on the evaluator, see Evaluator.STACK_DTYPES. The
+arrays are memory-mapped from the .npy file, or from the .npz file if the
+member is stored without compression.
+"""
+from __future__ import annotations
+
+import os
+import zipfile
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+STACK_EXTENSIONS = (".npy", ".npz")
+
+
+def find_stack(pred_folder_path: str, seq_name: str) -> Optional[str]:
+    """Path of the prediction stack of a sequence, if submitted."""
+    for ext in STACK_EXTENSIONS:
+        path = os.path.join(pred_folder_path, seq_name + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _mmap_npz_member(path: str, name: str) -> np.ndarray:
+    # Memory-map a member stored without compression, or read it
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        info = zip_ref.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zip_ref.open(info) as f:
+                return np.lib.format.read_array(f, allow_pickle=False)
+    with open(path, "rb") as f:
+        # Local file header: 30 bytes, then the file name and extra field
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length = int.from_bytes(local_header[26:28], "little")
+        extra_length = int.from_bytes(local_header[28:30], "little")
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            header = np.lib.format.read_array_header_2_0(f)
+        else:
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            return np.lib.format.read_array(f, allow_pickle=False)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+    if dtype.hasobject:
+        raise ValueError(f"{name} has object dtype")
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+def open_stack(path: str) -> Tuple[np.ndarray, Optional[List[str]]]:
+    """Open a prediction stack without reading the frames.
+
+    Args:
+        path (str): Path to the .npy or .npz file.
+    Returns:
+        tuple[np.ndarray, list[str] | None]: Memory-mapped array, and the frame
+            names of a .npz file if given.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r", allow_pickle=False), None
+    with np.load(path, allow_pickle=False) as npz:
+        names = set(npz.files)
+        frames = npz["frames"].tolist() if "frames" in names else None
+    if "data" not in names:
+        raise ValueError("missing array 'data'")
+    return _mmap_npz_member(path, "data.npy"), frames
+
+
+class PredictionStack:
+    """Prediction stack of a sequence, validated when opened."""
+
+    def __init__(
+        self, path: str, frame_names: List[str], dtypes: Tuple[str, ...]
+    ) -> None:
+        """Open and validate a prediction stack.
+
+        Args:
+            path (str): Path to the .npy or .npz file.
+            frame_names (list[str]): Sorted ground truth frame names.
+            dtypes (tuple[str, ...]): Accepted dtypes.
+        """
+        self.data, frames = open_stack(path)
+        if self.data.ndim != 3:
+            raise ValueError(f"expected shape (N, H, W), got {self.data.shape}")
+        if self.data.dtype.name not in dtypes:
+            raise ValueError(
+                f"unsupported dtype {self.data.dtype.name}, expected one of "
+                + ", ".join(dtypes)
+            )
+        if frames is None:
+            frames = frame_names
+        if len(frames) != len(self.data):
+            raise ValueError(
+                f"{len(self.data)} arrays for {len(frames)} frames in the stack"
+            )
+        self.index = {frame_name: i for i, frame_name in enumerate(frames)}
+
+    @property
+    def frame_names(self) -> List[str]:
+        """Names of the frames in the stack."""
+        return list(self.index)
+
+    def __getitem__(self, frame_name: str) -> np.ndarray:
+        """Array of a frame, as a view of the memory-mapped stack."""
+        return self.data[self.index[frame_name]]
@@ -2,20 +2,32 @@
 from __future__ import annotations
 
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import tqdm
-from PIL import Image
+
+from .frame_table import FrameTableWriter
+from .image_decode import get_decoder
+from .stacks import PredictionStack, find_stack
 
 
 class Evaluator:
     """Abstract evaluator class."""
 
     METRICS: List[str] = []
+    # Accepted dtypes of per-sequence prediction stacks, see stacks.py
+    STACK_DTYPES: tuple = ()
+    # Rows from the top and channel of the png files used by the evaluator,
+    # None for all, see image_decode.py
+    DECODE_ROWS: Optional[int] = None
+    DECODE_CHANNEL: Optional[int] = None
 
     def __init__(self) -> None:
         """Initialize evaluator."""
+        self.decoder = get_decoder()
+        # Decoded images by buffer name, reused for the next image of a size
+        self.buffers: Dict[str, np.ndarray] = {}
         self.reset()
 
     def reset(self) -> None:
@@ -43,18 +55,159 @@ class Evaluator:
         """
         return data
 
+    def preprocess_stack(self, data: np.array) -> np.array:
+        """Preprocess a frame of a prediction stack before evaluation.
+
+        Args:
+            data (np.array): Frame of the stack, in shape (H, W).
+        Returns:
+            np.array: Processed data, like preprocess of the png frame.
+        """
+        return self.preprocess(np.asarray(data))
+
+    def open_prediction_stack(
+        self, pred_folder_path: str, seq_name: str, frame_names: List[str]
+    ) -> Optional[PredictionStack]:
+        """Open the prediction stack of a sequence, if submitted and valid.
+
+        Args:
+            pred_folder_path (str): Path to folder containing predictions.
+            seq_name (str): Name of the sequence.
+            frame_names (list[str]): Sorted target frame names.
+        Returns:
+            PredictionStack | None: Validated stack, or None.
+        """
+        if not self.STACK_DTYPES:
+            return None
+        path = find_stack(pred_folder_path, seq_name)
+        if path is None:
+            return None
+        try:
+            return PredictionStack(path, frame_names, self.STACK_DTYPES)
+        except Exception as e:
+            print(f"Error when opening {path}: {e}")
+            return None
+
+    def get_state(self) -> Dict[str, Any]:
+        """Return the partial state accumulated since the last reset.
+
+        Returns:
+            dict[str, Any]: Picklable state, to be combined with merge_states.
+        """
+        return {metric: list(values) for metric, values in self.metrics.items()}
+
+    def merge_states(self, states: List[Dict[str, Any]]) -> None:
+        """Replace the current state by the combination of partial states.
+
+        The per-frame metrics are concatenated in the given order, so the
+        states should be passed in the order the frames would be processed.
+
+        Args:
+            states (list[dict[str, Any]]): States returned by get_state.
+        """
+        self.reset()
+        for state in states:
+            for metric in self.METRICS:
+                self.metrics[metric].extend(state[metric])
+
+    def read_image(self, path: str, buffer: str) -> np.ndarray:
+        """Decode the rows and channel of a png file used by the evaluator.
+
+        Args:
+            path (str): Path to the image file.
+            buffer (str): Name of the buffer to decode into, e.g. "pred".
+        Returns:
+            np.ndarray: Decoded image, overwritten by the next image decoded
+                into the same buffer.
+        """
+        image = self.decoder.decode(
+            path, self.DECODE_ROWS, self.DECODE_CHANNEL, self.buffers.get(buffer)
+        )
+        self.buffers[buffer] = image
+        return image
+
+    def list_targets(self, target_folder_path: str, seq_name: str) -> List[str]:
+        """List the target frames of a sequence.
+
+        Args:
+            target_folder_path (str): Path to folder containing targets.
+            seq_name (str): Name of the sequence.
+        Returns:
+            list[str]: Sorted frame names.
+        """
+        return [
+            frame_name
+            for frame_name in sorted(
+                os.listdir(os.path.join(target_folder_path, seq_name))
+            )
+            if frame_name.endswith(".png")
+        ]
+
+    def load_target(
+        self, target_folder_path: str, seq_name: str, frame_name: str
+    ) -> Any:
+        """Load and preprocess the target of a frame.
+
+        Args:
+            target_folder_path (str): Path to folder containing targets.
+            seq_name (str): Name of the sequence.
+            frame_name (str): Name of the frame.
+        Returns:
+            Any: Target, as passed to process.
+        """
+        target = self.read_image(
+            os.path.join(target_folder_path, seq_name, frame_name), "target"
+        )
+        return self.preprocess(target)
+
+    def append_empty_samples(self, frame_names: List[str]) -> None:
+        """Append the penalty for frames without a valid prediction.
+
+        Args:
+            frame_names (list[str]): Names of the frames.
+        """
+        for metric in self.METRICS:
+            self.metrics[metric].extend([0.0] * len(frame_names))
+
+    def frame_results(self, frame_ids: List[int]) -> Dict[str, np.ndarray]:
+        """Per-frame results of the frames of the last processed sequence.
+
+        Args:
+            frame_ids (list[int]): Frame ids of the frames, in processing order.
+        Returns:
+            dict[str, np.ndarray]: Value of each metric for each frame.
+        """
+        num_frames = len(frame_ids)
+        return {
+            metric: np.asarray(values[len(values) - num_frames :], dtype=np.float64)
+            for metric, values in self.metrics.items()
+        }
+
     def process_from_folder(
         self,
         pred_folder_path: str,
         target_folder_path: str,
         max_num_seqs: int = -1,
         used_seqs=None,
+        states: Optional[Dict[str, Dict[str, Any]]] = None,
+        table: Optional[FrameTableWriter] = None,
     ) -> Dict[str, float]:
         """Process all predictions in a folder of images.
 
+        Frames without a prediction are found by comparing the folder listings
+        once and are scored with the penalty in bulk, keeping the frame order.
+        A sequence can also be predicted by a .npy or .npz stack instead of a
+        folder of png files, see stacks.py.
+
         Args:
             pred_folder_path (str): Path to folder containing predictions.
             target_folder_path (str): Path to folder containing targets.
+            states (dict, optional): If given, the partial state of each
+                sequence is stored in it by sequence name, e.g. for sharded
+                evaluation.
+            table (FrameTableWriter, optional): If given, the results of each
+                frame are appended to it, see frame_results, with the sequence,
+                frame id and whether the prediction was evaluated.
 
         Returns:
             dict[str, float]: Evaluation results.
@@ -63,29 +216,72 @@ class Evaluator:
         seqs = sorted(os.listdir(target_folder_path))
         if max_num_seqs > 0:
             seqs = seqs[:max_num_seqs]
+        num_frames, num_missing = 0, 0
+        processed_seqs = []
         for seq_name in tqdm.tqdm(seqs):
             if used_seqs is not None and seq_name not in used_seqs:
                 continue
-            for frame_name in sorted(
-                os.listdir(os.path.join(target_folder_path, seq_name))
-            ):
-                if not frame_name.endswith(".png"):
+            if states is not None:
+                self.reset()
+            frame_names = self.list_targets(target_folder_path, seq_name)
+            pred_seq_path = os.path.join(pred_folder_path, seq_name)
+            stack = self.open_prediction_stack(pred_folder_path, seq_name, frame_names)
+            if stack is not None:
+                pred_frame_names = set(stack.frame_names)
+            elif os.path.isdir(pred_seq_path):
+                pred_frame_names = set(os.listdir(pred_seq_path))
+            else:
+                pred_frame_names = set()
+            num_frames += len(frame_names)
+
+            missing = []
+            evaluated = np.zeros(len(frame_names), dtype=bool)
+            for k, frame_name in enumerate(frame_names):
+                if frame_name not in pred_frame_names:
+                    missing.append(frame_name)
                     continue
+                if missing:
+                    self.append_empty_samples(missing)
+                    num_missing += len(missing)
+                    missing = []
                 try:
-                    pred = np.array(
-                        Image.open(os.path.join(pred_folder_path, seq_name, frame_name))
-                    )
-                    target = np.array(
-                        Image.open(
-                            os.path.join(target_folder_path, seq_name, frame_name)
+                    if stack is not None:
+                        pred = self.preprocess_stack(stack[frame_name])
+                    else:
+                        pred = self.read_image(
+                            os.path.join(pred_seq_path, frame_name), "pred"
                         )
-                    )
-                    pred = self.preprocess(pred)
-                    target = self.preprocess(target)
+                        pred = self.preprocess(pred)
+                    target = self.load_target(target_folder_path, seq_name, frame_name)
                     self.process(pred, target)
+                    evaluated[k] = True
                 except Exception as e:
                     print(f"Error when evaluating {seq_name}/{frame_name}: {e}")
                     # append 0 to metrics
-                    for metric in self.METRICS:
-                        self.metrics[metric].append(0.0)
+                    self.append_empty_samples([frame_name])
+            if missing:
+                self.append_empty_samples(missing)
+                num_missing += len(missing)
+            if table is not None:
+                frame_ids = [
+                    int(frame_name.split("_")[0]) for frame_name in frame_names
+                ]
+                table.append(
+                    {
+                        "sequence": [seq_name] * len(frame_names),
+                        "frame": frame_ids,
+                        "evaluated": evaluated,
+                        **self.frame_results(frame_ids),
+                    }
+                )
+            if states is not None:
+                states[seq_name] = self.get_state()
+                processed_seqs.append(seq_name)
+        if states is not None:
+            self.merge_states([states[seq_name] for seq_name in processed_seqs])
+        if num_missing > 0:
+            print(
+                f"{num_missing} of {num_frames} frames are missing in the "
+                "prediction and evaluated as empty predictions."
+            )
         return self.evaluate()
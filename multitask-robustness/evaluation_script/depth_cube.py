@@ -0,0 +1,251 @@
+"""Precompiled, memory-mapped depth ground truth.
+
+The ground truth depth maps are decoded, cropped and masked once into a folder
+next to the ground truth depth tree:
+
+ - depth.npy: cropped depth of all frames, in shape (N, H, W), float32,
+ - valid.npy: valid depth masks, in shape (N, H, W), bool,
+ - log_depth.npy: log(depth + eps) of the valid pixels of all frames,
+ - index.json: frame names of each sequence, the offsets of each frame in
+   log_depth.npy and the signature of the ground truth.
+
+The evaluator reads the targets as views of the memory-mapped arrays, so only
+the predictions are decoded per submission.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from .depth_eval import DepthEvaluator, DepthTarget
+
+CUBE_VERSION = 1
+# Compiled ground truth, by depth folder
+DEPTH_GT_CACHE: Dict[str, "DepthGroundTruth"] = {}
+
+
+class DepthGroundTruth:
+    """Memory-mapped compiled depth ground truth."""
+
+    def __init__(self, cube_dir: str) -> None:
+        """Open a compiled ground truth folder.
+
+        Args:
+            cube_dir (str): Folder written by compile_depth_gt.
+        """
+        with open(os.path.join(cube_dir, "index.json"), "r") as f:
+            self.index = json.load(f)
+        self.min_depth = self.index["min_depth"]
+        self.max_depth = self.index["max_depth"]
+        self.depth = np.load(os.path.join(cube_dir, "depth.npy"), mmap_mode="r")
+        self.valid = np.load(os.path.join(cube_dir, "valid.npy"), mmap_mode="r")
+        self.log_depth = np.load(os.path.join(cube_dir, "log_depth.npy"), mmap_mode="r")
+        self.offsets = self.index["offsets"]
+        self.frames = {}
+        for seq_name, (start, frame_names) in self.index["seqs"].items():
+            for i, frame_name in enumerate(frame_names):
+                self.frames[(seq_name, frame_name)] = start + i
+        self.broken = set(self.index["broken"])
+
+    def frame_names(self, seq_name: str) -> List[str]:
+        """Frame names of a sequence, in evaluation order."""
+        if seq_name not in self.index["seqs"]:
+            return []
+        return self.index["seqs"][seq_name][1]
+
+    def target(self, seq_name: str, frame_name: str) -> DepthTarget:
+        """Target of a frame, as views of the memory-mapped arrays."""
+        k = self.frames[(seq_name, frame_name)]
+        if k in self.broken:
+            raise ValueError(f"Ground truth {seq_name}/{frame_name} is unreadable")
+        return DepthTarget(
+            self.depth[k],
+            self.valid[k],
+            self.log_depth[self.offsets[k] : self.offsets[k + 1]],
+        )
+
+
+def cube_path(depth_dir: str) -> str:
+    """Folder of the compiled ground truth of a depth folder."""
+    return os.path.normpath(depth_dir) + "_cube"
+
+
+def _list_frames(depth_dir: str) -> Dict[str, List[str]]:
+    evaluator = DepthEvaluator()
+    return {
+        seq_name: evaluator.list_targets(depth_dir, seq_name)
+        for seq_name in sorted(os.listdir(depth_dir))
+        if os.path.isdir(os.path.join(depth_dir, seq_name))
+    }
+
+
+def _signature(
+    depth_dir: str, seqs: Dict[str, List[str]], gt_zip: Optional[str] = None
+) -> str:
+    # Hash of the names, CRCs and sizes of the depth entries in the central
+    # directory of the ground truth zip file, like gt_cache.annotation_key, or
+    # else of the png files, since unzipping resets their mtimes
+    digest = hashlib.sha1(str(CUBE_VERSION).encode())
+    if gt_zip is not None:
+        folder = os.path.basename(os.path.normpath(depth_dir))
+        with zipfile.ZipFile(gt_zip, "r") as zip_ref:
+            for info in sorted(zip_ref.infolist(), key=lambda info: info.filename):
+                if info.filename.split("/")[0] in (folder, folder + ".zip"):
+                    digest.update(
+                        f"{info.filename}:{info.CRC}:{info.file_size};".encode()
+                    )
+        return digest.hexdigest()
+    for seq_name, frame_names in seqs.items():
+        for frame_name in frame_names:
+            digest.update(f"{seq_name}/{frame_name}".encode())
+            with open(os.path.join(depth_dir, seq_name, frame_name), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def compile_depth_gt(
+    depth_dir: str,
+    min_depth: float = 1.0,
+    max_depth: float = 80.0,
+    eps: float = 1e-6,
+    gt_zip: Optional[str] = None,
+) -> DepthGroundTruth:
+    """Compile a ground truth depth folder, unless it is already compiled.
+
+    Args:
+        depth_dir (str): Ground truth depth folder, with a folder of png files
+            per sequence.
+        min_depth (float): Minimum valid depth.
+        max_depth (float): Maximum valid depth.
+        eps (float): Epsilon of the log-depth, as in DepthEvaluator.
+        gt_zip (str, optional): Ground truth zip file the folder was unzipped
+            from. The compiled ground truth is keyed by its central directory,
+            else by the contents of the png files.
+    Returns:
+        DepthGroundTruth: Opened compiled ground truth.
+    """
+    cube_dir = cube_path(depth_dir)
+    seqs = _list_frames(depth_dir)
+    signature = _signature(depth_dir, seqs, gt_zip)
+    cube = _open_if_current(cube_dir, signature, min_depth, max_depth)
+    if cube is None:
+        print(f"Compiling depth ground truth into {cube_dir}...")
+        evaluator = DepthEvaluator(min_depth, max_depth)
+        tmp_dir = tempfile.mkdtemp(prefix=".depth_cube-", dir=os.path.dirname(cube_dir))
+        index = {
+            "version": CUBE_VERSION,
+            "signature": signature,
+            "min_depth": min_depth,
+            "max_depth": max_depth,
+            "eps": eps,
+        }
+        index.update(_write_cube(tmp_dir, depth_dir, seqs, evaluator, eps))
+        with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+        if os.path.exists(cube_dir):
+            shutil.rmtree(cube_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, cube_dir)
+        except OSError:
+            # Another process compiled the same ground truth meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        cube = DepthGroundTruth(cube_dir)
+    DEPTH_GT_CACHE[os.path.normpath(depth_dir)] = cube
+    return cube
+
+
+def _open_if_current(
+    cube_dir: str, signature: str, min_depth: float, max_depth: float
+) -> Optional[DepthGroundTruth]:
+    try:
+        cube = DepthGroundTruth(cube_dir)
+    except (OSError, ValueError, KeyError):
+        return None
+    if (
+        cube.index.get("version") != CUBE_VERSION
+        or cube.index.get("signature") != signature
+        or (cube.min_depth, cube.max_depth) != (min_depth, max_depth)
+    ):
+        return None
+    return cube
+
+
+def _write_cube(
+    cube_dir: str,
+    depth_dir: str,
+    seqs: Dict[str, List[str]],
+    evaluator: DepthEvaluator,
+    eps: float,
+) -> Dict:
+    frames = [
+        (seq_name, frame_name)
+        for seq_name, frame_names in seqs.items()
+        for frame_name in frame_names
+    ]
+    shape = None
+    depth, valid = None, None
+    broken = []
+    for k, (seq_name, frame_name) in enumerate(frames):
+        try:
+            with open(os.path.join(depth_dir, seq_name, frame_name), "rb") as f:
+                target = np.array(Image.open(io.BytesIO(f.read())))
+            target = evaluator.crop(evaluator.preprocess(target))
+        except Exception as e:
+            print(f"Error when compiling {seq_name}/{frame_name}: {e}")
+            broken.append(k)
+            continue
+        if depth is None:
+            shape = (len(frames),) + target.shape
+            depth = np.lib.format.open_memmap(
+                os.path.join(cube_dir, "depth.npy"), "w+", np.float32, shape
+            )
+            valid = np.lib.format.open_memmap(
+                os.path.join(cube_dir, "valid.npy"), "w+", np.bool_, shape
+            )
+        if target.shape != shape[1:]:
+            print(f"Error when compiling {seq_name}/{frame_name}: size mismatch")
+            broken.append(k)
+            continue
+        depth[k] = target
+        valid[k] = (target > evaluator.min_depth) & (target < evaluator.max_depth)
+    if depth is None:
+        shape = (len(frames), 0, 0)
+        depth = np.lib.format.open_memmap(
+            os.path.join(cube_dir, "depth.npy"), "w+", np.float32, shape
+        )
+        valid = np.lib.format.open_memmap(
+            os.path.join(cube_dir, "valid.npy"), "w+", np.bool_, shape
+        )
+
+    # Log-depth of the valid pixels, concatenated in frame order
+    offsets = [0]
+    for k in range(len(frames)):
+        offsets.append(offsets[-1] + int(valid[k].sum()))
+    log_depth = np.lib.format.open_memmap(
+        os.path.join(cube_dir, "log_depth.npy"), "w+", np.float32, (offsets[-1],)
+    )
+    for k in range(len(frames)):
+        log_depth[offsets[k] : offsets[k + 1]] = np.log(depth[k][valid[k]] + eps)
+    for array in (depth, valid, log_depth):
+        array.flush()
+    del depth, valid, log_depth
+
+    seq_index, start = {}, 0
+    for seq_name, frame_names in seqs.items():
+        seq_index[seq_name] = [start, frame_names]
+        start += len(frame_names)
+    return {"seqs": seq_index, "offsets": offsets, "broken": broken}
+
+
+def open_depth_gt(depth_dir: str) -> Optional[DepthGroundTruth]:
+    """Compiled ground truth of a depth folder, if compiled by this process."""
+    return DEPTH_GT_CACHE.get(os.path.normpath(depth_dir))
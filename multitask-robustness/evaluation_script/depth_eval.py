@@ -1,20 +1,48 @@
 """SHIFT depth evaluation."""
 from __future__ import annotations
 
-from typing import Dict
+from typing import Any, Dict, List, NamedTuple
 
 import numpy as np
 
 from .common import Evaluator
 
 
+class DepthTarget(NamedTuple):
+    """Precompiled target of a frame, see depth_cube."""
+
+    depth: np.ndarray  # cropped depth map, in shape (H, W)
+    valid: np.ndarray  # valid depth mask, in shape (H, W)
+    log_depth: np.ndarray  # log(depth + eps) of the valid pixels
+
+
 class DepthEvaluator(Evaluator):
     METRICS = ["abs_err", "silog", "rmse_log"]
+    # Depth in meters, or in 1/256 meters for uint16
+    STACK_DTYPES = ("float16", "float32", "uint16")
+    # Rows kept by crop, the only ones decoded from the png files
+    CROP_ROWS = 740
+    DECODE_ROWS = CROP_ROWS
 
-    def __init__(self, min_depth: float = 1.0, max_depth: float = 80.0) -> None:
-        """Initialize the depth evaluator."""
+    def __init__(
+        self, min_depth: float = 1.0, max_depth: float = 80.0, gt_cube: Any = None
+    ) -> None:
+        """Initialize the depth evaluator.
+
+        Args:
+            min_depth (float): Minimum valid depth.
+            max_depth (float): Maximum valid depth.
+            gt_cube (DepthGroundTruth, optional): Compiled ground truth to read
+                the targets from instead of decoding the png files.
+        """
         self.min_depth = min_depth
         self.max_depth = max_depth
+        if gt_cube is not None:
+            assert (gt_cube.min_depth, gt_cube.max_depth) == (
+                min_depth,
+                max_depth,
+            ), "Ground truth cube was compiled for another depth range"
+        self.gt_cube = gt_cube
         super().__init__()
 
     def mean_absolute_error(self, pred, target):
@@ -55,7 +83,7 @@ class DepthEvaluator(Evaluator):
         return np.sqrt(err.mean())
 
     def crop(self, mask):
-        return mask[:740, :]
+        return mask[: self.CROP_ROWS, :]
 
     def process(self, prediction: np.array, target: np.array) -> None:
         """Process a batch of data.
@@ -64,6 +92,9 @@ class DepthEvaluator(Evaluator):
             target (np.array): Target depth map.
         """
         prediction = self.crop(prediction)
+        if isinstance(target, DepthTarget):
+            self.process_compiled(prediction, target)
+            return
         target = self.crop(target)
         mae = self.mean_absolute_error(prediction, target)
         silog = self.silog(prediction, target)
@@ -72,6 +103,41 @@ class DepthEvaluator(Evaluator):
         self.metrics["silog"].append(silog)
         self.metrics["rmse_log"].append(rmse_log)
 
+    def process_compiled(
+        self, prediction: np.array, target: DepthTarget, eps: float = 1e-6
+    ) -> None:
+        """Process a cropped prediction against a precompiled target.
+
+        Gives the same metrics as process, with the mask and the target
+        log-depth read from the cube.
+
+        Args:
+            prediction (np.array): Cropped prediction depth map.
+            target (DepthTarget): Precompiled target.
+            eps (float, optional): Epsilon. Defaults to 1e-6.
+        """
+        pred = prediction[target.valid]
+        log_pred = np.log(pred + eps)
+        mae = np.mean(np.abs(pred - target.depth[target.valid]))
+        err = log_pred - target.log_depth
+        silog = np.sqrt(np.mean(err**2) - np.mean(err) ** 2) * 100
+        rmse_log = np.sqrt(((target.log_depth - log_pred) ** 2).mean())
+        self.metrics["abs_err"].append(mae)
+        self.metrics["silog"].append(silog)
+        self.metrics["rmse_log"].append(rmse_log)
+
+    def list_targets(self, target_folder_path: str, seq_name: str) -> List[str]:
+        if self.gt_cube is not None:
+            return self.gt_cube.frame_names(seq_name)
+        return super().list_targets(target_folder_path, seq_name)
+
+    def load_target(
+        self, target_folder_path: str, seq_name: str, frame_name: str
+    ) -> Any:
+        if self.gt_cube is not None:
+            return self.gt_cube.target(seq_name, frame_name)
+        return super().load_target(target_folder_path, seq_name, frame_name)
+
     def preprocess(self, data: np.array) -> np.array:
         if len(data.shape) == 3 and data.shape[2] == 3:
             data = data.astype(np.float32)
@@ -82,6 +148,13 @@ class DepthEvaluator(Evaluator):
             data /= 3.1875
         return data
 
+    def preprocess_stack(self, data: np.array) -> np.array:
+        if data.dtype == np.uint16:
+            data = data.astype(np.float32)
+            data /= 256.0
+            return data
+        return np.asarray(data, dtype=np.float32)
+
     def evaluate(self) -> Dict[str, float]:
         """Evaluate all predictions according to given metric.
         Returns:
@@ -1,18 +1,39 @@
 from __future__ import annotations
 
+import multiprocessing
+import os
 from collections import defaultdict
-from typing import Dict, List
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import pyquaternion
 import tqdm
 from nuscenes.eval.common.data_classes import EvalBoxes
-from nuscenes.eval.common.utils import center_distance
+from nuscenes.eval.common.utils import (
+    attr_acc,
+    center_distance,
+    cummean,
+    scale_iou,
+    velocity_l2,
+    yaw_diff,
+)
 from nuscenes.eval.detection.algo import accumulate, calc_ap, calc_tp
-from nuscenes.eval.detection.data_classes import DetectionBox, DetectionMetricDataList
+from nuscenes.eval.detection.data_classes import (
+    DetectionBox,
+    DetectionMetricData,
+    DetectionMetricDataList,
+)
 from scalabel.label.typing import Box3D, Config, Frame
 
+from .frame_index import FrameIndex, frame_keys
+
 TP_METRICS = ["trans_err", "scale_err", "orient_err"]
+# Processes of the per-class accumulation of evaluate_det_3d. Packing the
+# boxes of a class for a worker costs about as much as accumulating them, so
+# the pool is off unless configured, and only used for large submissions.
+NUM_WORKERS = int(os.environ.get("SHIFT_EVAL_DET3D_WORKERS", "1"))
+# Predicted boxes from which evaluate_det_3d uses its pool by default
+POOL_MIN_BOXES = 100_000
 
 
 class DetectionMetrics:
@@ -122,40 +143,21 @@ def cam_to_lidar(box3d: Box3D):
     return (location[0].tolist(), dimension, list(quat))
 
 
-def evaluate_det_3d(
-    gt_frames: List[Frame],
-    pred_frames: List[Frame],
-    config: Config,
-    dist_ths: List[float] = [0.5, 1.0, 2.0],
-    dist_th_tp: float = 1.0,
-):
-    """Evaluate 3D detection using NuScenes detection metrics."""
-    gt_boxes = EvalBoxes()
-    pred_boxes = EvalBoxes()
-    for frame in tqdm.tqdm(gt_frames):
-        boxes = []
-        for label in frame.labels:
-            if label.box3d is not None:
-                location, dimensions, orientation = cam_to_lidar(label.box3d)
-                boxes.append(
-                    DetectionBox(
-                        f"{frame.name}_{frame.videoName}",
-                        location,
-                        dimensions,
-                        orientation,
-                        detection_name=label.category,
-                        detection_score=label.score if label.score is not None else 1.0,
-                    )
-                )
-        gt_boxes.add_boxes(f"{frame.name}_{frame.videoName}", boxes)
-    for frame in tqdm.tqdm(pred_frames):
+def frames_to_boxes(frames: List[Frame], frame_ids: Sequence[int]) -> EvalBoxes:
+    """Convert scalabel frames to nuScenes boxes, keyed by sample token.
+
+    The sample token of a frame is its id in a FrameIndex, as a string.
+    """
+    eval_boxes = EvalBoxes()
+    for frame, frame_id in zip(tqdm.tqdm(frames), frame_ids):
+        sample_token = str(frame_id)
         boxes = []
         for label in frame.labels:
             if label.box3d is not None:
                 location, dimensions, orientation = cam_to_lidar(label.box3d)
                 boxes.append(
                     DetectionBox(
-                        f"{frame.name}_{frame.videoName}",
+                        sample_token,
                         location,
                         dimensions,
                         orientation,
@@ -163,22 +165,29 @@ def evaluate_det_3d(
                         detection_score=label.score if label.score is not None else 1.0,
                     )
                 )
-        pred_boxes.add_boxes(f"{frame.name}_{frame.videoName}", boxes)
+        eval_boxes.add_boxes(sample_token, boxes)
+    return eval_boxes
 
-    # Run evaluation
-    class_names = [category.name for category in config.categories]
-    metric_data_list = DetectionMetricDataList()
-    for class_name in class_names:
-        for dist_th in dist_ths:
-            md = accumulate(
-                gt_boxes,
-                pred_boxes,
-                class_name,
-                center_distance,
-                dist_th,
-            )
-            metric_data_list.set(class_name, dist_th, md)
 
+def _frame_ids(
+    gt_frames: List[Frame],
+    pred_frames: List[Frame],
+    frame_ids: Optional[Tuple[Sequence[int], Sequence[int]]],
+) -> Tuple[Sequence[int], Sequence[int]]:
+    # Ids of an index of the ground truth frames, unless given
+    if frame_ids is None:
+        index = FrameIndex.from_frames(gt_frames)
+        frame_ids = index.frame_ids, index.intern(frame_keys(pred_frames))
+    return frame_ids
+
+
+def summarize_metric_data(
+    metric_data_list: DetectionMetricDataList,
+    class_names: List[str],
+    dist_ths: List[float],
+    dist_th_tp: float,
+):
+    """Compute the AP and TP metrics from the accumulated metric data."""
     metrics = DetectionMetrics(class_names)
     for class_name in class_names:
         # Compute APs.
@@ -195,3 +204,363 @@ def evaluate_det_3d(
 
     metrics = metrics.serialize()
     return metrics
+
+
+def class_table(
+    boxes: EvalBoxes, class_name: str
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Pack the boxes of a class for a worker process.
+
+    Args:
+        boxes (EvalBoxes): Boxes of all classes.
+        class_name (str): Class to pack.
+    Returns:
+        tuple: Sample tokens with boxes of the class, in the order of the
+            boxes, the number of boxes of each of them, and the translation,
+            size, rotation and score of the boxes in shape (N, 11).
+    """
+    tokens, counts, rows = [], [], []
+    for sample_token in boxes.sample_tokens:
+        class_boxes = [
+            box for box in boxes[sample_token] if box.detection_name == class_name
+        ]
+        if class_boxes:
+            tokens.append(sample_token)
+            counts.append(len(class_boxes))
+            rows.extend(
+                [*box.translation, *box.size, *box.rotation, box.detection_score]
+                for box in class_boxes
+            )
+    return tokens, np.array(counts), np.array(rows, dtype=np.float64).reshape(-1, 11)
+
+
+def unpack_table(
+    table: Tuple[List[str], np.ndarray, np.ndarray], class_name: str
+) -> EvalBoxes:
+    """Boxes of a class packed by class_table."""
+    eval_boxes = EvalBoxes()
+    tokens, counts, rows = table
+    rows = iter(rows.tolist())
+    for sample_token, count in zip(tokens, counts):
+        boxes = []
+        for _ in range(count):
+            row = next(rows)
+            boxes.append(
+                DetectionBox(
+                    sample_token,
+                    row[0:3],
+                    row[3:6],
+                    row[6:10],
+                    detection_name=class_name,
+                    detection_score=row[10],
+                )
+            )
+        eval_boxes.add_boxes(sample_token, boxes)
+    return eval_boxes
+
+
+def accumulate_class(
+    gt_boxes: EvalBoxes, pred_boxes: EvalBoxes, class_name: str, dist_ths: List[float]
+) -> Dict[float, DetectionMetricData]:
+    """Metric data of a class at each distance threshold."""
+    return {
+        dist_th: accumulate(gt_boxes, pred_boxes, class_name, center_distance, dist_th)
+        for dist_th in dist_ths
+    }
+
+
+def _accumulate_packed(task: Tuple) -> Dict[float, DetectionMetricData]:
+    # Worker side of evaluate_det_3d, on the boxes of a single class
+    gt_table, pred_table, class_name, dist_ths = task
+    return accumulate_class(
+        unpack_table(gt_table, class_name),
+        unpack_table(pred_table, class_name),
+        class_name,
+        dist_ths,
+    )
+
+
+def pool_size(num_pred_boxes: int, num_classes: Optional[int] = None) -> int:
+    """Number of processes evaluate_det_3d accumulates the classes in by default.
+
+    Args:
+        num_pred_boxes (int): Number of predicted boxes.
+        num_classes (int, optional): Number of classes, if known.
+    Returns:
+        int: NUM_WORKERS, at most one per class, from POOL_MIN_BOXES predicted
+            boxes, and 1 below, i.e. the calling process.
+    """
+    if NUM_WORKERS <= 1 or num_pred_boxes < POOL_MIN_BOXES:
+        return 1
+    return NUM_WORKERS if num_classes is None else max(1, min(NUM_WORKERS, num_classes))
+
+
+def evaluate_det_3d(
+    gt_frames: List[Frame],
+    pred_frames: List[Frame],
+    config: Config,
+    dist_ths: List[float] = [0.5, 1.0, 2.0],
+    dist_th_tp: float = 1.0,
+    nproc: Optional[int] = None,
+    frame_ids: Optional[Tuple[Sequence[int], Sequence[int]]] = None,
+):
+    """Evaluate 3D detection using NuScenes detection metrics.
+
+    The classes are accumulated independently, with nproc > 1 in a pool of
+    forked processes which only receive the boxes of their class. accumulate
+    only compares boxes of the class it evaluates, so the result is the same
+    as in a single process, which is used inside daemonic pool workers. nproc
+    defaults to pool_size.
+
+    frame_ids are the FrameIndex ids of the ground truth and predicted frames,
+    e.g. of the join of the predictions, by default of an index of the ground
+    truth frames.
+    """
+    gt_ids, pred_ids = _frame_ids(gt_frames, pred_frames, frame_ids)
+    gt_boxes = frames_to_boxes(gt_frames, gt_ids)
+    pred_boxes = frames_to_boxes(pred_frames, pred_ids)
+
+    # Run evaluation
+    class_names = [category.name for category in config.categories]
+    if nproc is None:
+        num_pred_boxes = sum(len(boxes) for boxes in pred_boxes.boxes.values())
+        nproc = pool_size(num_pred_boxes, len(class_names))
+    nproc = min(nproc, len(class_names))
+    if nproc > 1 and not multiprocessing.current_process().daemon:
+        tasks = [
+            (
+                class_table(gt_boxes, class_name),
+                class_table(pred_boxes, class_name),
+                class_name,
+                dist_ths,
+            )
+            for class_name in class_names
+        ]
+        with multiprocessing.get_context("fork").Pool(nproc) as pool:
+            class_data = pool.map(_accumulate_packed, tasks)
+    else:
+        class_data = [
+            accumulate_class(gt_boxes, pred_boxes, class_name, dist_ths)
+            for class_name in class_names
+        ]
+    metric_data_list = DetectionMetricDataList()
+    for class_name, data in zip(class_names, class_data):
+        for dist_th in dist_ths:
+            metric_data_list.set(class_name, dist_th, data[dist_th])
+
+    return summarize_metric_data(metric_data_list, class_names, dist_ths, dist_th_tp)
+
+
+def match_sample(
+    gt_boxes: List[DetectionBox],
+    pred_boxes: List[DetectionBox],
+    class_names: List[str],
+    dist_ths: List[float],
+) -> Dict:
+    """Match the predictions of a single sample, like accumulate does.
+
+    accumulate matches the predictions greedily in descending order of score,
+    with ties broken by descending position, but a prediction can only take a
+    ground truth box of its own sample. The matches of a sample thus only
+    depend on the sample itself, and can be computed independently and merged
+    with accumulate_matches.
+
+    Args:
+        gt_boxes (list[DetectionBox]): Ground truth boxes of the sample.
+        pred_boxes (list[DetectionBox]): Predicted boxes of the sample.
+        class_names (list[str]): Classes to evaluate.
+        dist_ths (list[float]): Distance thresholds to evaluate.
+    Returns:
+        dict: "num_gts" by class, and "matches" by (class, threshold), a list
+            of (score, is_match, trans_err, vel_err, scale_err, orient_err,
+            attr_err) per prediction of the class, in the order of the sample.
+    """
+    record = {"num_gts": defaultdict(int), "matches": {}}
+    for gt_box in gt_boxes:
+        record["num_gts"][gt_box.detection_name] += 1
+    record["num_gts"] = dict(record["num_gts"])
+    for class_name in class_names:
+        class_preds = [box for box in pred_boxes if box.detection_name == class_name]
+        pred_confs = [box.detection_score for box in class_preds]
+        sortind = [i for (v, i) in sorted((v, i) for (i, v) in enumerate(pred_confs))][
+            ::-1
+        ]
+        for dist_th in dist_ths:
+            matches = [None] * len(class_preds)
+            taken = set()
+            for ind in sortind:
+                pred_box = class_preds[ind]
+                min_dist = np.inf
+                match_gt_idx = None
+                for gt_idx, gt_box in enumerate(gt_boxes):
+                    if gt_box.detection_name == class_name and gt_idx not in taken:
+                        this_distance = center_distance(gt_box, pred_box)
+                        if this_distance < min_dist:
+                            min_dist = this_distance
+                            match_gt_idx = gt_idx
+
+                if min_dist < dist_th:
+                    taken.add(match_gt_idx)
+                    gt_box_match = gt_boxes[match_gt_idx]
+                    period = np.pi if class_name == "barrier" else 2 * np.pi
+                    matches[ind] = (
+                        pred_box.detection_score,
+                        True,
+                        center_distance(gt_box_match, pred_box),
+                        velocity_l2(gt_box_match, pred_box),
+                        1 - scale_iou(gt_box_match, pred_box),
+                        yaw_diff(gt_box_match, pred_box, period=period),
+                        1 - attr_acc(gt_box_match, pred_box),
+                    )
+                else:
+                    matches[ind] = (pred_box.detection_score, False) + (None,) * 5
+            record["matches"][(class_name, dist_th)] = matches
+    return record
+
+
+def match_det_3d(
+    gt_frames: List[Frame],
+    pred_frames: List[Frame],
+    config: Config,
+    dist_ths: List[float] = [0.5, 1.0, 2.0],
+    frame_ids: Optional[Tuple[Sequence[int], Sequence[int]]] = None,
+) -> Dict[str, Dict]:
+    """Compute the per-sample match records of 3D detection.
+
+    Args:
+        gt_frames (list[Frame]): Ground truth frames.
+        pred_frames (list[Frame]): Predicted frames.
+        config (Config): Dataset config.
+        dist_ths (list[float]): Distance thresholds to evaluate.
+        frame_ids (tuple[list[int], list[int]], optional): FrameIndex ids of
+            the ground truth and predicted frames, by default of an index of
+            the ground truth frames.
+    Returns:
+        dict[str, dict]: Match records of match_sample, by sample token, the
+            frame id as a string.
+    """
+    gt_ids, pred_ids = _frame_ids(gt_frames, pred_frames, frame_ids)
+    gt_boxes = frames_to_boxes(gt_frames, gt_ids)
+    pred_boxes = frames_to_boxes(pred_frames, pred_ids)
+    class_names = [category.name for category in config.categories]
+    return {
+        sample_token: match_sample(
+            gt_boxes[sample_token], pred_boxes[sample_token], class_names, dist_ths
+        )
+        for sample_token in gt_boxes.sample_tokens
+    }
+
+
+def accumulate_matches(
+    records: List[Dict], class_name: str, dist_th: float
+) -> DetectionMetricData:
+    """Accumulate per-sample match records, with the same result as accumulate.
+
+    Args:
+        records (list[dict]): Match records of match_sample, in the order in
+            which the samples appear in the predictions.
+        class_name (str): Class to compute AP on.
+        dist_th (float): Distance threshold for a match.
+    Returns:
+        DetectionMetricData: Raw data for a number of metrics.
+    """
+    npos = sum(record["num_gts"].get(class_name, 0) for record in records)
+    if npos == 0:
+        return DetectionMetricData.no_predictions()
+
+    matches = [
+        match
+        for record in records
+        for match in record["matches"][(class_name, dist_th)]
+    ]
+    pred_confs = [match[0] for match in matches]
+    sortind = [i for (v, i) in sorted((v, i) for (i, v) in enumerate(pred_confs))][::-1]
+
+    tp = []
+    fp = []
+    conf = []
+    match_data = {
+        "trans_err": [],
+        "vel_err": [],
+        "scale_err": [],
+        "orient_err": [],
+        "attr_err": [],
+        "conf": [],
+    }
+    for ind in sortind:
+        score, is_match, trans_err, vel_err, scale_err, orient_err, attr_err = matches[
+            ind
+        ]
+        if is_match:
+            tp.append(1)
+            fp.append(0)
+            conf.append(score)
+            match_data["trans_err"].append(trans_err)
+            match_data["vel_err"].append(vel_err)
+            match_data["scale_err"].append(scale_err)
+            match_data["orient_err"].append(orient_err)
+            match_data["attr_err"].append(attr_err)
+            match_data["conf"].append(score)
+        else:
+            tp.append(0)
+            fp.append(1)
+            conf.append(score)
+
+    if len(match_data["trans_err"]) == 0:
+        return DetectionMetricData.no_predictions()
+
+    # From here on identical to accumulate
+    tp = np.cumsum(tp).astype(float)
+    fp = np.cumsum(fp).astype(float)
+    conf = np.array(conf)
+
+    prec = tp / (fp + tp)
+    rec = tp / float(npos)
+
+    rec_interp = np.linspace(0, 1, DetectionMetricData.nelem)
+    prec = np.interp(rec_interp, rec, prec, right=0)
+    conf = np.interp(rec_interp, rec, conf, right=0)
+    rec = rec_interp
+
+    for key in match_data.keys():
+        if key == "conf":
+            continue
+        tmp = cummean(np.array(match_data[key]))
+        match_data[key] = np.interp(conf[::-1], match_data["conf"][::-1], tmp[::-1])[
+            ::-1
+        ]
+
+    return DetectionMetricData(
+        recall=rec,
+        precision=prec,
+        confidence=conf,
+        trans_err=match_data["trans_err"],
+        vel_err=match_data["vel_err"],
+        scale_err=match_data["scale_err"],
+        orient_err=match_data["orient_err"],
+        attr_err=match_data["attr_err"],
+    )
+
+
+def reduce_det_3d(
+    records: List[Dict],
+    config: Config,
+    dist_ths: List[float] = [0.5, 1.0, 2.0],
+    dist_th_tp: float = 1.0,
+):
+    """Evaluate 3D detection from per-sample match records.
+
+    Args:
+        records (list[dict]): Match records of match_sample, in the order in
+            which the samples appear in the predictions.
+        config (Config): Dataset config.
+    Returns:
+        dict: Same metrics as evaluate_det_3d.
+    """
+    class_names = [category.name for category in config.categories]
+    metric_data_list = DetectionMetricDataList()
+    for class_name in class_names:
+        for dist_th in dist_ths:
+            md = accumulate_matches(records, class_name, dist_th)
+            metric_data_list.set(class_name, dist_th, md)
+    return summarize_metric_data(metric_data_list, class_names, dist_ths, dist_th_tp)
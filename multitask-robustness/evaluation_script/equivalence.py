@@ -0,0 +1,656 @@
+"""Differential check of the fast evaluation paths against the reference.
+
+Every faster path to a leaderboard number must give the same number as the
+reference path it replaces:
+
+ - depth: DepthEvaluator on the png files of the ground truth, decoded with
+   Pillow, against the compiled ground truth (depth_cube.py), the OpenCV
+   decoder (image_decode.py), prediction stacks (stacks.py) and sharded
+   per-sequence states (shard.py),
+ - insseg: scalabel's evaluate_ins_seg against the native evaluate_ins_seg,
+   evaluate_ins_seg_chunked and the sharded match records of match_records.py,
+ - det3d: a copy of the first evaluate_det_3d, with nuScenes' accumulate in
+   a single process, against evaluate_det_3d, its class pool and the sharded
+   per-sample match records of match_det_3d and reduce_det_3d.
+
+Each check runs the reference and all engines on generated cases, random ones
+and adversarial ones: empty frames, frames without valid depth, missing
+predictions, tied scores, more detections than COCOeval keeps per image and
+NaN depth. The results must agree within the
+tolerance of the task in TOLERANCES, and the time of each engine is reported
+relative to the reference:
+
+    python -m evaluation_script.equivalence --tasks depth insseg det3d
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import copy
+import io
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import warnings
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+import numpy as np
+from PIL import Image
+
+from .depth_cube import compile_depth_gt, open_depth_gt
+from .depth_eval import DepthEvaluator
+from .frame_index import frame_keys
+from .image_decode import DECODERS, get_decoder
+
+if TYPE_CHECKING:
+    from scalabel.label.typing import Config, Frame
+
+# Relative and absolute tolerance of each task. The compiled ground truth
+# stores the log-depth in float32 like the reference computes it, and the
+# detection engines reproduce the floating point operations of their
+# reference, so all tasks must agree exactly.
+TOLERANCES = {
+    "depth": (0.0, 0.0),
+    "insseg": (0.0, 0.0),
+    "det3d": (0.0, 0.0),
+}
+TASKS = list(TOLERANCES)
+# Adversarial kinds of the generated cases, one after the other
+DEPTH_KINDS = ["random", "invalid", "missing", "nan", "zero", "exact"]
+DETECTION_KINDS = ["random", "empty", "missing", "ties", "none", "crowded"]
+# Predictions per frame of the crowded kind, most categories of a frame above
+# the 100 detections COCOeval keeps per image
+CROWDED_DETECTIONS = (400, 600)
+
+
+class Case(NamedTuple):
+    """Generated input of a check."""
+
+    name: str  # kind and number of the case
+    data: Any  # input of the reference and of the engines
+
+
+def flatten(result: Any, prefix: str = "") -> Dict[str, float]:
+    """Numbers of a nested result, by "/"-joined key."""
+    if isinstance(result, dict):
+        flat = {}
+        for key, value in result.items():
+            flat.update(flatten(value, f"{prefix}{key}/"))
+        return flat
+    return {prefix.rstrip("/"): float(result)}
+
+
+def compare(
+    expected: Dict[str, float], actual: Dict[str, float], rtol: float, atol: float
+) -> List[str]:
+    """Differences of two flat results beyond a tolerance.
+
+    Args:
+        expected (dict[str, float]): Reference result.
+        actual (dict[str, float]): Result of an engine.
+        rtol (float): Tolerance relative to the reference value.
+        atol (float): Absolute tolerance.
+    Returns:
+        list[str]: Description of each differing or missing value, NaN only
+            agreeing with NaN.
+    """
+    diffs = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual or key not in expected:
+            diffs.append(
+                f"{key} only in {'reference' if key in expected else 'engine'}"
+            )
+            continue
+        a, b = actual[key], expected[key]
+        if a == b or (math.isnan(a) and math.isnan(b)):
+            continue
+        if not (abs(a - b) <= atol + rtol * abs(b)):
+            diffs.append(f"{key}: {a!r} != {b!r}")
+    return diffs
+
+
+def run_check(
+    task: str,
+    cases: Iterator[Case],
+    reference: Callable[[Any], Any],
+    engines: Dict[str, Callable[[Any], Any]],
+) -> Dict[str, Dict[str, float]]:
+    """Run the reference and the engines of a task on cases and compare.
+
+    Args:
+        task (str): Task name, the key of its tolerance in TOLERANCES.
+        cases (Iterator[Case]): Generated cases.
+        reference (Callable): Reference evaluation of the data of a case.
+        engines (dict[str, Callable]): Fast evaluations of the data of a case,
+            by name, returning None if they do not apply to the case.
+    Returns:
+        dict[str, dict[str, float]]: For each engine, the number of "cases"
+            it ran on, the number of "mismatches" and the "speedup", the time
+            of the reference divided by the time of the engine on these cases.
+    """
+    rtol, atol = TOLERANCES[task]
+    stats = {
+        name: {"cases": 0, "mismatches": 0, "ref": 0.0, "time": 0.0} for name in engines
+    }
+    for case in cases:
+        expected, ref_time = _timed(reference, case.data)
+        expected = flatten(expected)
+        for name, engine in engines.items():
+            actual, elapsed = _timed(engine, case.data)
+            if actual is None:
+                continue
+            diffs = compare(expected, flatten(actual), rtol, atol)
+            stat = stats[name]
+            stat["cases"] += 1
+            stat["ref"] += ref_time
+            stat["time"] += elapsed
+            if diffs:
+                stat["mismatches"] += 1
+                print(f"{task}/{name} differs on {case.name}: {'; '.join(diffs[:5])}")
+    return {
+        name: {
+            "cases": stat["cases"],
+            "mismatches": stat["mismatches"],
+            "speedup": stat["ref"] / stat["time"] if stat["time"] > 0 else math.nan,
+        }
+        for name, stat in stats.items()
+    }
+
+
+def _timed(function: Callable[[Any], Any], data: Any) -> tuple:
+    # Result and time of a quiet call, without the progress bars, the logs of
+    # scalabel and the warnings of empty means
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ), warnings.catch_warnings(), np.errstate(all="ignore"):
+        warnings.simplefilter("ignore")
+        logging.disable(logging.CRITICAL)
+        try:
+            # Copies, since the evaluations may change the frames
+            data = copy.deepcopy(data)
+            start = time.perf_counter()
+            result = function(data)
+            elapsed = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+    return result, elapsed
+
+
+def _depth_png(depth: np.ndarray) -> np.ndarray:
+    # 24-bit RGB encoding of a depth map in meters, see DepthEvaluator.preprocess
+    code = np.clip(np.round(depth * 16777.216), 0, (1 << 24) - 1).astype(np.uint32)
+    rgb = np.stack([code & 255, (code >> 8) & 255, code >> 16], axis=-1)
+    return rgb.astype(np.uint8)
+
+
+def depth_cases(root: str, num_cases: int, rng: np.random.Generator) -> Iterator[Case]:
+    """Depth cases, written as ground truth and prediction folders.
+
+    The images are a few rows taller than the crop of the evaluator. The
+    predictions of the "nan" cases have NaN pixels, so they are only written
+    as prediction stacks, the others both as png files and as stacks.
+
+    Args:
+        root (str): Folder to write the cases to.
+        num_cases (int): Number of cases.
+        rng (np.random.Generator): Random generator.
+    Yields:
+        Case: Case with the "gt" depth folder, the "png" prediction folder,
+            None for stack predictions only, and the "stack" one.
+    """
+    evaluator = DepthEvaluator()
+    height, width = DepthEvaluator.CROP_ROWS + 20, 32
+    for k in range(num_cases):
+        kind = DEPTH_KINDS[k % len(DEPTH_KINDS)]
+        case_dir = os.path.join(root, f"depth_{k}")
+        folders = {
+            name: os.path.join(case_dir, name) for name in ("gt", "png", "stack")
+        }
+        num_seqs = int(rng.integers(1, 4))
+        for s in range(num_seqs):
+            seq_name = f"seq{s}"
+            frames, stack = [], []
+            for f in range(int(rng.integers(1, 4))):
+                frame_name = f"{f:08d}_depth_front.png"
+                depth = rng.uniform(0.0, 100.0, (height, width))
+                if kind == "invalid" and s == 0:
+                    # No pixel within the valid depth range
+                    depth = np.where(rng.random(depth.shape) < 0.5, 0.0, 90.0)
+                gt_png = _depth_png(depth)
+                gt_path = os.path.join(folders["gt"], seq_name, frame_name)
+                os.makedirs(os.path.dirname(gt_path), exist_ok=True)
+                Image.fromarray(gt_png).save(gt_path)
+
+                if kind == "missing" and (s == 0 or rng.random() < 0.3):
+                    continue
+                pred_png = gt_png
+                if kind != "exact":
+                    pred = depth * rng.lognormal(0.0, 0.2, depth.shape)
+                    if kind == "zero":
+                        pred[rng.random(pred.shape) < 0.3] = 0.0
+                    pred_png = _depth_png(pred)
+                pred = evaluator.preprocess(pred_png)
+                if kind == "nan":
+                    nan_fraction = 1.0 if f == 0 else 0.1
+                    pred[rng.random(pred.shape) < nan_fraction] = np.nan
+                else:
+                    pred_path = os.path.join(folders["png"], seq_name, frame_name)
+                    os.makedirs(os.path.dirname(pred_path), exist_ok=True)
+                    Image.fromarray(pred_png).save(pred_path)
+                frames.append(frame_name)
+                stack.append(pred)
+            if frames:
+                os.makedirs(folders["stack"], exist_ok=True)
+                np.savez(
+                    os.path.join(folders["stack"], seq_name + ".npz"),
+                    data=np.stack(stack).astype(np.float32),
+                    frames=np.array(frames),
+                )
+        for folder in folders.values():
+            os.makedirs(folder, exist_ok=True)
+        # Compiled once with the ground truth, as for the leaderboard
+        with contextlib.redirect_stdout(io.StringIO()):
+            compile_depth_gt(folders["gt"])
+        if kind == "nan":
+            folders["png"] = None
+        yield Case(f"{kind} #{k}", folders)
+
+
+def depth_metrics(
+    gt_dir: str,
+    pred_dir: str,
+    gt_cube: Any = None,
+    decoder: Optional[str] = None,
+    num_shards: int = 1,
+) -> Dict[str, float]:
+    """Depth metrics of a prediction folder, as evaluated by main.
+
+    Args:
+        gt_dir (str): Ground truth depth folder.
+        pred_dir (str): Prediction folder of png files or stacks.
+        gt_cube (DepthGroundTruth, optional): Compiled ground truth.
+        decoder (str, optional): Image decoder, see get_decoder.
+        num_shards (int): Number of shards evaluating every n-th sequence
+            into per-sequence states, merged as by shard.py.
+    Returns:
+        dict[str, float]: Metrics of DepthEvaluator.evaluate.
+    """
+    seqs = sorted(os.listdir(gt_dir))
+    states: Dict[str, Dict] = {}
+    for shard_index in range(num_shards):
+        evaluator = DepthEvaluator(gt_cube=gt_cube)
+        if decoder is not None:
+            evaluator.decoder = get_decoder(decoder)
+        evaluator.process_from_folder(
+            pred_dir,
+            gt_dir,
+            used_seqs=seqs[shard_index::num_shards] if num_shards > 1 else None,
+            states=states if num_shards > 1 else None,
+        )
+    if num_shards > 1:
+        evaluator.merge_states([states[seq_name] for seq_name in sorted(states)])
+    return evaluator.evaluate()
+
+
+def check_depth(
+    num_cases: int, rng: np.random.Generator
+) -> Dict[str, Dict[str, float]]:
+    """Compare the fast depth paths with the png reference, see run_check."""
+
+    def reference(case: Dict) -> Dict[str, float]:
+        return depth_metrics(case["gt"], case["png"] or case["stack"], decoder="pil")
+
+    def cube(case: Dict) -> Dict[str, float]:
+        gt_cube = open_depth_gt(case["gt"])
+        return depth_metrics(case["gt"], case["png"] or case["stack"], gt_cube, "pil")
+
+    def stack(case: Dict) -> Optional[Dict[str, float]]:
+        # Stack of the png predictions, the reference of the others
+        if case["png"] is None:
+            return None
+        return depth_metrics(case["gt"], case["stack"])
+
+    def shards(case: Dict) -> Dict[str, float]:
+        pred_dir = case["png"] or case["stack"]
+        return depth_metrics(case["gt"], pred_dir, decoder="pil", num_shards=2)
+
+    def cv2(case: Dict) -> Optional[Dict[str, float]]:
+        if case["png"] is None:
+            return None
+        return depth_metrics(case["gt"], case["png"], decoder="cv2")
+
+    engines = {"cube": cube, "stack": stack, "shards": shards}
+    if DECODERS["cv2"].available():
+        engines["cv2"] = cv2
+    with tempfile.TemporaryDirectory(prefix="equivalence-") as root:
+        return run_check("depth", depth_cases(root, num_cases, rng), reference, engines)
+
+
+def _score(rng: np.random.Generator, kind: str) -> float:
+    # Tied scores from a few values, else mostly distinct ones
+    if kind in ("ties", "crowded") or rng.random() < 0.3:
+        return float(rng.integers(1, 4) / 4)
+    return float(rng.random())
+
+
+def _detection_frames(
+    rng: np.random.Generator, kind: str, make_label: Callable
+) -> tuple:
+    # Ground truth and predicted frames of a few sequences, with the same
+    # frame names in all sequences, and the adversarial frames of the kind
+    from scalabel.label.typing import Frame
+
+    gt_frames, pred_frames = [], []
+    for s in range(int(rng.integers(1, 4))):
+        video_name = f"seq{s}"
+        for f in range(int(rng.integers(1, 5))):
+            name = f"{f:08d}_img_front.jpg"
+            empty = kind == "empty" and rng.random() < 0.5
+            gt_labels = (
+                []
+                if empty
+                else [make_label(rng, None) for _ in range(int(rng.integers(0, 6)))]
+            )
+            gt_frames.append(
+                Frame(name=name, videoName=video_name, frameIndex=f, labels=gt_labels)
+            )
+            if kind == "none" or (kind == "missing" and rng.random() < 0.5):
+                continue
+            num_preds = 0 if empty else int(rng.integers(0, 8))
+            if kind == "crowded":
+                num_preds = int(rng.integers(*CROWDED_DETECTIONS))
+            pred_labels = [make_label(rng, _score(rng, kind)) for _ in range(num_preds)]
+            pred_frames.append(
+                Frame(name=name, videoName=video_name, frameIndex=f, labels=pred_labels)
+            )
+    return gt_frames, pred_frames
+
+
+def _shard_seqs(gt_frames: List) -> List[set]:
+    # Sequences of two shards, every other sequence
+    seqs = list(dict.fromkeys(frame.videoName for frame in gt_frames))
+    return [set(seqs[0::2]), set(seqs[1::2])]
+
+
+def insseg_cases(num_cases: int, rng: np.random.Generator) -> Iterator[Case]:
+    """Instance segmentation cases, overlapping masks and crowds included.
+
+    Yields:
+        Case: Case with the ground truth frames, the predicted frames, every
+            label with a score, and the config.
+    """
+    import pycocotools.mask as mask_utils
+    from scalabel.label.typing import RLE, Category, Config, ImageSize, Label
+
+    height, width = 30, 40
+    categories = ["car", "pedestrian", "truck"]
+    config = Config(
+        imageSize=ImageSize(height=height, width=width),
+        categories=[Category(name=name) for name in categories],
+    )
+
+    def make_label(rng: np.random.Generator, score: Optional[float]) -> Label:
+        mask = np.zeros((height, width), dtype=np.uint8)
+        y, x = rng.integers(0, height), rng.integers(0, width)
+        mask[y : y + rng.integers(1, 12), x : x + rng.integers(1, 12)] = 1
+        if rng.random() < 0.3:
+            mask &= (rng.random(mask.shape) < 0.7).astype(np.uint8)
+        rle = mask_utils.encode(np.asfortranarray(mask))
+        return Label(
+            id=str(rng.integers(1 << 30)),
+            category=str(rng.choice(categories + ["bicycle"])),
+            rle=RLE(counts=rle["counts"].decode(), size=rle["size"]),
+            score=score,
+            attributes={"crowd": bool(score is None and rng.random() < 0.1)},
+        )
+
+    for k in range(num_cases):
+        kind = DETECTION_KINDS[k % len(DETECTION_KINDS)]
+        gt_frames, pred_frames = _detection_frames(rng, kind, make_label)
+        yield Case(f"{kind} #{k}", (gt_frames, pred_frames, config))
+
+
+def check_insseg(
+    num_cases: int, rng: np.random.Generator
+) -> Dict[str, Dict[str, float]]:
+    """Compare the native instance segmentation with scalabel's, see run_check."""
+    from scalabel.eval.ins_seg import evaluate_ins_seg as scalabel_ins_seg
+
+    from .insseg_eval import evaluate_ins_seg, evaluate_ins_seg_chunked
+    from .match_records import match_units, reduce_units
+
+    def reference(data: tuple) -> Dict[str, float]:
+        gt_frames, pred_frames, config = data
+        return scalabel_ins_seg(gt_frames, pred_frames, config, nproc=1).summary()
+
+    def native(data: tuple) -> Dict[str, float]:
+        gt_frames, pred_frames, config = data
+        return evaluate_ins_seg(gt_frames, pred_frames, config).summary()
+
+    def chunked(data: tuple) -> Optional[Dict[str, float]]:
+        gt_frames, pred_frames, config = data
+        # Matched by video and name unless the predicted names are unique,
+        # and then chunks need unique ground truth names, see main
+        use_video = len({frame.name for frame in pred_frames}) < len(pred_frames)
+        if not use_video and len({frame.name for frame in gt_frames}) < len(gt_frames):
+            return None
+        seqs = list(dict.fromkeys(frame.videoName for frame in gt_frames))
+        chunks = (
+            (
+                [frame for frame in gt_frames if frame.videoName == seq],
+                [frame for frame in pred_frames if frame.videoName == seq],
+            )
+            for seq in seqs
+        )
+        return evaluate_ins_seg_chunked(
+            frame_keys(gt_frames), chunks, config, use_video=use_video
+        ).summary()
+
+    def shards(data: tuple) -> Dict[str, float]:
+        gt_frames, pred_frames, config = data
+        units = {"all": (list(range(len(gt_frames))), list(range(len(pred_frames))))}
+        states = [
+            match_units(gt_frames, pred_frames, units, seqs, config, iou_type="segm")
+            for seqs in _shard_seqs(gt_frames)
+        ]
+        return reduce_units(states, iou_type="segm")["all"].summary()
+
+    engines = {"native": native, "chunked": chunked, "shards": shards}
+    return run_check("insseg", insseg_cases(num_cases, rng), reference, engines)
+
+
+def det3d_cases(num_cases: int, rng: np.random.Generator) -> Iterator[Case]:
+    """3D detection cases, predictions mostly close to a ground truth box.
+
+    Yields:
+        Case: Case with the ground truth frames, the predicted frames and the
+            config.
+    """
+    from scalabel.label.typing import Box3D, Category, Config, Label
+
+    categories = ["car", "pedestrian", "barrier"]
+    config = Config(categories=[Category(name=name) for name in categories])
+
+    def make_label(rng: np.random.Generator, score: Optional[float]) -> Label:
+        # Boxes on a coarse grid, so that predictions hit ground truth boxes
+        location = rng.integers(-4, 5, 3) * 1.5
+        return Label(
+            id=str(rng.integers(1 << 30)),
+            category=str(rng.choice(categories)),
+            box3d=Box3D(
+                location=tuple((location + rng.normal(0.0, 0.3, 3)).tolist()),
+                dimension=tuple(rng.uniform(0.5, 4.0, 3).tolist()),
+                orientation=(0.0, float(rng.uniform(-np.pi, np.pi)), 0.0),
+                alpha=0.0,
+            ),
+            score=score,
+        )
+
+    for k in range(num_cases):
+        kind = DETECTION_KINDS[k % len(DETECTION_KINDS)]
+        gt_frames, pred_frames = _detection_frames(rng, kind, make_label)
+        yield Case(f"{kind} #{k}", (gt_frames, pred_frames, config))
+
+
+def reference_det_3d(
+    gt_frames: List[Frame],
+    pred_frames: List[Frame],
+    config: Config,
+    dist_ths: List[float] = [0.5, 1.0, 2.0],
+    dist_th_tp: float = 1.0,
+):
+    """Evaluate 3D detection using NuScenes detection metrics."""
+    # The evaluate_det_3d of the first release, copied verbatim below its
+    # imports, so that a change of evaluate_det_3d cannot change the reference.
+    # The helpers of det3d_eval.py it uses are unchanged since.
+    import tqdm
+    from nuscenes.eval.common.data_classes import EvalBoxes
+    from nuscenes.eval.common.utils import center_distance
+    from nuscenes.eval.detection.algo import accumulate, calc_ap, calc_tp
+    from nuscenes.eval.detection.data_classes import (
+        DetectionBox,
+        DetectionMetricDataList,
+    )
+
+    from .det3d_eval import TP_METRICS, DetectionMetrics, cam_to_lidar
+
+    gt_boxes = EvalBoxes()
+    pred_boxes = EvalBoxes()
+    for frame in tqdm.tqdm(gt_frames):
+        boxes = []
+        for label in frame.labels:
+            if label.box3d is not None:
+                location, dimensions, orientation = cam_to_lidar(label.box3d)
+                boxes.append(
+                    DetectionBox(
+                        f"{frame.name}_{frame.videoName}",
+                        location,
+                        dimensions,
+                        orientation,
+                        detection_name=label.category,
+                        detection_score=label.score if label.score is not None else 1.0,
+                    )
+                )
+        gt_boxes.add_boxes(f"{frame.name}_{frame.videoName}", boxes)
+    for frame in tqdm.tqdm(pred_frames):
+        boxes = []
+        for label in frame.labels:
+            if label.box3d is not None:
+                location, dimensions, orientation = cam_to_lidar(label.box3d)
+                boxes.append(
+                    DetectionBox(
+                        f"{frame.name}_{frame.videoName}",
+                        location,
+                        dimensions,
+                        orientation,
+                        detection_name=label.category,
+                        detection_score=label.score if label.score is not None else 1.0,
+                    )
+                )
+        pred_boxes.add_boxes(f"{frame.name}_{frame.videoName}", boxes)
+
+    # Run evaluation
+    class_names = [category.name for category in config.categories]
+    metric_data_list = DetectionMetricDataList()
+    for class_name in class_names:
+        for dist_th in dist_ths:
+            md = accumulate(
+                gt_boxes,
+                pred_boxes,
+                class_name,
+                center_distance,
+                dist_th,
+            )
+            metric_data_list.set(class_name, dist_th, md)
+
+    metrics = DetectionMetrics(class_names)
+    for class_name in class_names:
+        # Compute APs.
+        for dist_th in dist_ths:
+            metric_data = metric_data_list[(class_name, dist_th)]
+            ap = calc_ap(metric_data, min_recall=0.1, min_precision=0.1)
+            metrics.add_label_ap(class_name, dist_th, ap)
+
+        # Compute TP metrics.
+        for metric_name in TP_METRICS:
+            metric_data = metric_data_list[(class_name, dist_th_tp)]
+            tp = calc_tp(metric_data, min_recall=0.1, metric_name=metric_name)
+            metrics.add_label_tp(class_name, metric_name, tp)
+
+    metrics = metrics.serialize()
+    return metrics
+
+
+def check_det3d(
+    num_cases: int, rng: np.random.Generator
+) -> Dict[str, Dict[str, float]]:
+    """Compare the fast 3D detection paths with nuScenes', see run_check."""
+    from .det3d_eval import evaluate_det_3d, reduce_det_3d
+    from .shard import _det3d_state
+
+    def reference(data: tuple) -> Dict:
+        gt_frames, pred_frames, config = data
+        return reference_det_3d(gt_frames, pred_frames, config)
+
+    def native(data: tuple) -> Dict:
+        gt_frames, pred_frames, config = data
+        return evaluate_det_3d(gt_frames, pred_frames, config, nproc=1)
+
+    def pool(data: tuple) -> Dict:
+        gt_frames, pred_frames, config = data
+        return evaluate_det_3d(gt_frames, pred_frames, config, nproc=2)
+
+    def shards(data: tuple) -> Dict:
+        gt_frames, pred_frames, config = data
+        samples = {}
+        for seqs in _shard_seqs(gt_frames):
+            samples.update(
+                _det3d_state(gt_frames, pred_frames, config, seqs)["samples"]
+            )
+        # Samples in the order of the predictions, as in shard.reduce_shards
+        used_samples = sorted(
+            samples.values(), key=lambda sample: (sample[1] is None, sample[1] or 0)
+        )
+        return reduce_det_3d([record for _, _, record in used_samples], config)
+
+    engines = {"native": native, "pool": pool, "shards": shards}
+    return run_check("det3d", det3d_cases(num_cases, rng), reference, engines)
+
+
+CHECKS = {"depth": check_depth, "insseg": check_insseg, "det3d": check_det3d}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the fast evaluation paths with their reference."
+    )
+    parser.add_argument("--tasks", nargs="+", choices=TASKS, default=TASKS)
+    parser.add_argument("--cases", type=int, default=12, help="cases per task")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    same = True
+    for task in args.tasks:
+        results = CHECKS[task](args.cases, rng)
+        rtol, atol = TOLERANCES[task]
+        for name, result in results.items():
+            print(
+                f"{task}/{name}: {result['mismatches']} of {result['cases']} "
+                f"cases differ (rtol {rtol}, atol {atol}), "
+                f"{result['speedup']:.2f}x the speed of the reference"
+            )
+            same &= result["mismatches"] == 0
+    sys.exit(0 if same else 1)
@@ -0,0 +1,235 @@
+"""Instance segmentation evaluation on run-length encodings.
+
+Same result as evaluate_ins_seg of scalabel, with the mask work done by
+mask_iou.py: the masks of all (image, category) pairs are compared in one
+vectorized pass on their runs instead of one pycocotools call per pair, and
+the overlap of the predicted masks of a frame is checked on the runs instead
+of merging the masks label by label.
+
+evaluate_ins_seg_chunked evaluates the frames in chunks, e.g. of a few
+sequences, and keeps only the per-image COCOeval match records of each chunk,
+so that the frames and masks of a chunk are released before the next one is
+loaded.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scalabel.eval.detect import COCOV2, COCOevalV2, DetResult
+from scalabel.eval.utils import reorder_preds
+from scalabel.label.to_coco import scalabel2coco_ins_seg
+from scalabel.label.transforms import get_leaf_categories
+from scalabel.label.typing import Config, Frame
+
+from .mask_iou import mask_iou, mask_runs, overlapping_groups
+from .match_records import (
+    accumulate_records,
+    assign_preds,
+    match_images,
+    top_predictions,
+)
+
+
+def remove_overlaps(frames: Sequence[Frame], config: Config) -> bool:
+    """Drop the labels of frames with overlapping masks, like check_overlap.
+
+    Args:
+        frames (list[Frame]): Predicted frames, changed in place.
+        config (Config): Dataset config.
+    Returns:
+        bool: Whether any frame had overlapping masks.
+    """
+    category_names = {
+        category.name for category in get_leaf_categories(config.categories)
+    }
+    segmentations, groups = [], []
+    for i, frame in enumerate(frames):
+        for label in frame.labels or []:
+            if label.category not in category_names:
+                continue
+            if label.rle is not None:
+                segmentations.append(dict(counts=label.rle.counts, size=label.rle.size))
+                groups.append(i)
+            elif label.poly2d is not None:
+                raise ValueError("Polygons should not be used during evaluation.")
+    overlaps = overlapping_groups(
+        mask_runs(segmentations), np.array(groups), len(frames)
+    )
+    for is_overlap, frame in zip(overlaps, frames):
+        if is_overlap:
+            frame.labels = None
+    return bool(overlaps.any())
+
+
+class MaskCOCOeval(COCOevalV2):  # type: ignore
+    """COCOevalV2 with the mask IoU of all images computed at once."""
+
+    def _prepare(self) -> None:
+        super()._prepare()
+        self.mask_ious = self.compute_mask_ious()
+
+    def compute_mask_ious(self) -> Dict[Tuple[int, int], np.ndarray]:
+        """IoU of the sorted detections and the ground truth of each image.
+
+        Returns:
+            dict: IoU matrix of each (image, category) with detections and
+                ground truth, in shape (detections, ground truth) as computeIoU.
+        """
+        max_dets = self.params.maxDets[-1]
+        keys, dts, gts = [], [], []
+        for key, key_dts in self._dts.items():
+            key_gts = self._gts.get(key, [])
+            if not key_dts or not key_gts:
+                continue
+            order = np.argsort([-dt["score"] for dt in key_dts], kind="mergesort")
+            keys.append(key)
+            dts.append([key_dts[i] for i in order[:max_dets]])
+            gts.append(key_gts)
+        dt_runs = mask_runs([dt["segmentation"] for key_dts in dts for dt in key_dts])
+        gt_runs = mask_runs([gt["segmentation"] for key_gts in gts for gt in key_gts])
+        shapes = [(len(key_dts), len(key_gts)) for key_dts, key_gts in zip(dts, gts)]
+        dt_starts = np.cumsum([0] + [d for d, _ in shapes])
+        gt_starts = np.cumsum([0] + [g for _, g in shapes])
+        empty = [np.zeros(0, dtype=np.int64)]
+        dt_inds = np.concatenate(
+            empty
+            + [np.repeat(np.arange(d) + s, g) for (d, g), s in zip(shapes, dt_starts)]
+        )
+        gt_inds = np.concatenate(
+            empty
+            + [np.tile(np.arange(g) + s, d) for (d, g), s in zip(shapes, gt_starts)]
+        )
+        crowd = np.array(
+            [int(gt["iscrowd"]) for key_gts in gts for gt in key_gts], dtype=bool
+        )
+        ious = mask_iou(dt_runs, gt_runs, dt_inds, gt_inds, crowd[gt_inds])
+        pair_starts = np.cumsum([0] + [d * g for d, g in shapes])
+        return {
+            key: ious[start : start + d * g].reshape(d, g)
+            for key, start, (d, g) in zip(keys, pair_starts, shapes)
+        }
+
+    def computeIoU(
+        self, imgId: int, catId: int
+    ) -> np.ndarray:  # pylint: disable=invalid-name
+        """IoU of an image and category, from compute_mask_ious."""
+        return self.mask_ious.get((imgId, catId), [])
+
+
+def evaluate_ins_seg(
+    ann_frames: List[Frame],
+    pred_frames: List[Frame],
+    config: Config,
+    nproc: int = 1,
+) -> DetResult:
+    """Evaluate instance segmentation with Scalabel format.
+
+    Args:
+        ann_frames (list[Frame]): Ground truth frames.
+        pred_frames (list[Frame]): Predicted frames.
+        config (Config): Dataset config.
+        nproc (int): Number of processes of the matching.
+    Returns:
+        DetResult: Same result as scalabel's evaluate_ins_seg.
+    """
+    ann_frames = sorted(ann_frames, key=lambda frame: frame.name)
+    ann_coco = scalabel2coco_ins_seg(ann_frames, config)
+    ann_coco["annotations"] = [
+        ann for ann in ann_coco["annotations"] if "segmentation" in ann
+    ]
+    coco_gt = COCOV2(None, ann_coco)
+
+    pred_frames = reorder_preds(ann_frames, pred_frames)
+    # Predictions of frames with overlapping masks are removed
+    remove_overlaps(pred_frames, config)
+    # Only the masks that COCOeval can evaluate are converted and decoded
+    pred_frames = top_predictions(pred_frames, "segm")
+    pred_res = scalabel2coco_ins_seg(pred_frames, config)["annotations"]
+    if not pred_res:
+        return DetResult.empty(coco_gt)
+    # Without the bbox, pycocotools computes the area from the mask
+    for ann in pred_res:
+        ann.pop("bbox", None)
+    coco_dt = coco_gt.loadRes(pred_res)
+
+    cat_ids = coco_dt.getCatIds()
+    cat_names = [cat["name"] for cat in coco_dt.loadCats(cat_ids)]
+    coco_eval = MaskCOCOeval(cat_names, coco_gt, coco_dt, "segm", nproc)
+    coco_eval.params.imgIds = sorted(coco_gt.getImgIds())
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    return coco_eval.summarize()
+
+
+def evaluate_ins_seg_chunked(
+    gt_keys: Sequence[Tuple[Optional[str], str]],
+    chunks: Iterable[Tuple[List[Frame], List[Frame]]],
+    config: Config,
+    use_video: Optional[bool] = None,
+) -> DetResult:
+    """Evaluate instance segmentation chunk by chunk, like evaluate_ins_seg.
+
+    The image of a ground truth frame is its position after the stable sort
+    of all frames by name, as in evaluate_ins_seg, so the records of the
+    chunks are accumulated in the same order as in a single evaluation. The
+    predictions are assigned within their chunk, so a chunk must hold whole
+    sequences and the predictions of its frames.
+
+    Args:
+        gt_keys (list[tuple[str | None, str]]): Video name and name of all
+            ground truth frames, in file order.
+        chunks (Iterable[tuple[list[Frame], list[Frame]]]): Ground truth
+            frames of each chunk, in file order, and their predicted frames.
+            A generator only needs to hold one chunk at a time.
+        config (Config): Dataset config.
+        use_video (bool, optional): Whether predictions are matched by video
+            and name, as reorder_preds decides on all predicted frames, None
+            to decide on the predicted frames of each chunk. Matched by name
+            only, a prediction may belong to frames of other chunks, so the
+            ground truth names must then be unique.
+    Returns:
+        DetResult: Same result as evaluate_ins_seg on all frames.
+    """
+    images = [0] * len(gt_keys)
+    for position, i in enumerate(
+        sorted(range(len(gt_keys)), key=lambda i: gt_keys[i][1])
+    ):
+        images[i] = position
+    # Image positions of each frame key, in file order
+    positions: Dict[Tuple[Optional[str], str], List[int]] = {}
+    for key, position in zip(gt_keys, images):
+        positions.setdefault(key, []).append(position)
+    records: List[Optional[Tuple]] = [None] * len(gt_keys)
+    num_preds, gt_cat_ids, state = 0, set(), None
+    for gt_frames, pred_frames in chunks:
+        assigned = assign_preds(gt_frames, pred_frames, use_video)
+        state = match_images(
+            [
+                (frame, pred_frames[j] if j is not None else None)
+                for frame, j in zip(gt_frames, assigned)
+            ],
+            config,
+            "segm",
+            evaluator=MaskCOCOeval,
+        )
+        for frame, record, frame_preds, frame_cat_ids in zip(
+            gt_frames, state["records"], state["num_preds"], state["gt_cat_ids"]
+        ):
+            records[positions[(frame.videoName, frame.name)].pop(0)] = record
+            num_preds += frame_preds
+            gt_cat_ids |= frame_cat_ids
+    if state is None:
+        return evaluate_ins_seg([], [], config)
+    assert all(
+        not remaining for remaining in positions.values()
+    ), "Ground truth frames are missing in the chunks"
+    return accumulate_records(
+        records,
+        num_preds,
+        gt_cat_ids,
+        state["categories"],
+        state["cat_ids"],
+        state["cat_names"],
+        "segm",
+    )
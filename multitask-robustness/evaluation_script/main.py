@@ -2,24 +2,25 @@ from __future__ import annotations
 
 import contextlib
 import copy
-import csv
 import io
 import os
 import time
 import sys
-import zipfile
 from pathlib import Path
-import requests
 
 import numpy as np
-import scalabel
-from scalabel.eval.ins_seg import evaluate_ins_seg
-from scalabel.label.io import load
 
 sys.path.append(str(Path(__file__).parent.absolute()))
 
+from .depth_cube import compile_depth_gt, open_depth_gt
 from .depth_eval import DepthEvaluator
-from .det3d_eval import evaluate_det_3d
+from .frame_index import FrameIndex, frame_keys, join_frames
+from .frame_table import FrameTableWriter, read_sequence_attributes
+from .gt_cache import CompiledAnnotations, annotation_key, load_compiled
+from .manifest import ImageTask, JsonTask, scan_submission, submission_filter
+from .preflight import installed_version
+from .seq_catalog import SequenceCatalog
+from .unzip import unzip_nested
 
 CONDITIONS = [
     "clear",
@@ -39,23 +40,41 @@ SEQ_INFO_PATH_TEST = os.path.join(
 )
 VAL_GT_PATH = os.path.join(str(Path(__file__).parent.absolute()), "val_gt.zip")
 TEST_GT_PATH = os.path.join(str(Path(__file__).parent.absolute()), "test_gt.zip")
+PHASE_SPLITS = {"dev": "val", "test": "test"}
+SUBMISSION_TASKS = [
+    JsonTask("det_insseg_2d.json"),
+    ImageTask(
+        "depth",
+        modes=("RGB", "L", "I", "I;16", "F"),
+        stack_dtypes=DepthEvaluator.STACK_DTYPES,
+    ),
+    JsonTask("det_3d.json"),
+]
 
 SCALABEL_CACHE = {}
+# Unzipped ground truth folders, by ground truth zip file
+GT_CACHE = {}
+GT_JSON_FILES = ["det_insseg_2d.json", "det_3d.json"]
+# Compiled annotation cache keys of the ground truth json files, by file path
+GT_ANNOTATION_KEYS = {}
+# Sequences per chunk of the instance segmentation evaluation, see
+# insseg_eval.evaluate_ins_seg_chunked, 0 to evaluate a condition at once
+INSSEG_CHUNK_SEQS = 8
 
 
 # Load sequence info
-with open(SEQ_INFO_PATH_VAL, "r") as f:
-    reader = csv.DictReader(f)
-    SEQ_INFO_VAL = [
-        (row["video"], row["start_weather_coarse"], row["start_timeofday_coarse"])
-        for row in reader
-    ]
-with open(SEQ_INFO_PATH_TEST, "r") as f:
-    reader = csv.DictReader(f)
-    SEQ_INFO_TEST = [
-        (row["video"], row["start_weather_coarse"], row["start_timeofday_coarse"])
-        for row in reader
-    ]
+SEQ_CATALOG_VAL = SequenceCatalog.from_csv(SEQ_INFO_PATH_VAL)
+SEQ_CATALOG_TEST = SequenceCatalog.from_csv(SEQ_INFO_PATH_TEST)
+SEQ_INFO_VAL, SEQ_INFO_TEST = [
+    list(
+        zip(
+            catalog.videos,
+            catalog.columns["start_weather_coarse"].tolist(),
+            catalog.columns["start_timeofday_coarse"].tolist(),
+        )
+    )
+    for catalog in (SEQ_CATALOG_VAL, SEQ_CATALOG_TEST)
+]
 
 
 def add_score_to_frames(frames):
@@ -67,22 +86,38 @@ def add_score_to_frames(frames):
 
 
 def get_used_seqs(seq_filter, split="val"):
-    SEQ_INFO = SEQ_INFO_VAL if split == "val" else SEQ_INFO_TEST
-    if seq_filter is not None:
-        used_seqs = []
-        for seq in SEQ_INFO:
-            if seq_filter in ["clear", "overcast", "rainy", "foggy", "cloudy"]:
-                if seq[1] == seq_filter:
-                    used_seqs.append(seq[0])
-            elif seq_filter in ["daytime", "dawn/dusk", "night"]:
-                if seq[2] == seq_filter:
-                    used_seqs.append(seq[0])
-    else:
-        used_seqs = [seq[0] for seq in SEQ_INFO]
-    return used_seqs
+    catalog = SEQ_CATALOG_VAL if split == "val" else SEQ_CATALOG_TEST
+    if seq_filter is None:
+        return catalog.videos.copy()
+    if seq_filter in ["clear", "overcast", "rainy", "foggy", "cloudy"]:
+        return catalog.seqs(catalog.equals("start_weather_coarse", seq_filter))
+    if seq_filter in ["daytime", "dawn/dusk", "night"]:
+        return catalog.seqs(catalog.equals("start_timeofday_coarse", seq_filter))
+    return []
+
+
+def load_compiled_scalabel(file_path):
+    """Compiled annotations of a scalabel json file, cached like load_scalabel.
+
+    Ground truth files go through the compiled annotation cache, other files,
+    e.g. predictions, are compiled in memory.
+    """
+    if not isinstance(SCALABEL_CACHE.get(file_path), CompiledAnnotations):
+        SCALABEL_CACHE[file_path] = load_compiled(
+            file_path, GT_ANNOTATION_KEYS.get(file_path)
+        )
+    return SCALABEL_CACHE[file_path]
 
 
 def load_scalabel(file_path, used_seqs=None):
+    if file_path in GT_ANNOTATION_KEYS or isinstance(
+        SCALABEL_CACHE.get(file_path), CompiledAnnotations
+    ):
+        # Compiled annotations, restored for the used sequences only
+        return load_compiled_scalabel(file_path).dataset(used_seqs)
+
+    from scalabel.label.io import load
+
     if file_path in SCALABEL_CACHE:
         data_ = copy.deepcopy(SCALABEL_CACHE[file_path])
     else:
@@ -94,15 +129,80 @@ def load_scalabel(file_path, used_seqs=None):
     return data_
 
 
+def release_scalabel(folder):
+    """Drop cached scalabel files below a folder, e.g. a finished submission."""
+    folder = os.path.join(folder, "")
+    for file_path in list(SCALABEL_CACHE):
+        if file_path.startswith(folder):
+            del SCALABEL_CACHE[file_path]
+
+
+def join_scalabel(pred, index):
+    """Keep the predicted frames of the frames of an index.
+
+    Args:
+        pred (Dataset): Predictions, changed in place.
+        index (FrameIndex): Index of the target frames.
+    Returns:
+        tuple[Dataset, np.ndarray]: Kept predictions and the id of each of
+            their frames.
+    """
+    join = join_frames(index, frame_keys(pred.frames))
+    if len(join.duplicates) > 0:
+        print(f">> {len(join.duplicates)} frames are predicted more than once")
+    pred.frames = [pred.frames[i] for i in join.kept]
+    return pred, join.pred_ids
+
+
 def filter_scalabel(pred, target):
-    used_frames = []
-    for frame in target.frames:
-        used_frames.append(frame.videoName + frame.name)
-    used_frames = set(used_frames)
-    pred.frames = [
-        frame for frame in pred.frames if frame.videoName + frame.name in used_frames
+    return join_scalabel(pred, FrameIndex.from_frames(target.frames))[0]
+
+
+def iter_insseg_chunks(gt_path, pred_path, used_seqs, chunk_seqs):
+    """Ground truth and scored predicted frames of chunks of sequences.
+
+    Both json files are compiled once, and only the frames of one chunk are
+    restored at a time.
+
+    Args:
+        gt_path (str): Path to the ground truth json file.
+        pred_path (str): Path to the predicted json file.
+        used_seqs (list[str]): Evaluated sequences.
+        chunk_seqs (int): Number of sequences per chunk.
+    Yields:
+        tuple[list[Frame], list[Frame]]: Ground truth frames of a chunk and
+            their predicted frames, as load_scalabel and filter_scalabel.
+    """
+    for start in range(0, len(used_seqs), chunk_seqs):
+        seqs = used_seqs[start : start + chunk_seqs]
+        target = load_compiled_scalabel(gt_path).dataset(seqs)
+        pred = filter_scalabel(load_compiled_scalabel(pred_path).dataset(seqs), target)
+        yield target.frames, add_score_to_frames(pred.frames)
+
+
+def insseg_chunk_matching(gt_path, pred_path, used_seqs):
+    """How reorder_preds matches the kept predicted frames, if chunks can.
+
+    Predictions are matched by video and name if the names of the kept
+    predicted frames are not unique, else by name only, and then a prediction
+    can match frames of other sequences with the same name, which a chunk of
+    sequences cannot reproduce.
+
+    Returns:
+        bool | None: Whether to match by video and name, None if chunks of
+            sequences would not match as reorder_preds.
+    """
+    gt_keys = load_compiled_scalabel(gt_path).frame_keys(used_seqs)
+    pred_keys = load_compiled_scalabel(pred_path).frame_keys(used_seqs)
+    pred_names = [
+        pred_keys[i][1] for i in join_frames(FrameIndex(gt_keys), pred_keys).kept
     ]
-    return pred
+    if len(pred_names) != len(set(pred_names)):
+        return True
+    gt_names = [name for _, name in gt_keys]
+    if len(gt_names) != len(set(gt_names)):
+        return None
+    return False
 
 
 def evaluate_shift_multitask(
@@ -111,57 +211,120 @@ def evaluate_shift_multitask(
     seq_filter=None,
     max_num_seqs=-1,
     phase="val",
+    seq_subset=None,
+):
+    result_dict = {}
+    for _, task_result in iter_shift_multitask(
+        test_annotation_dir,
+        user_submission_dir,
+        seq_filter,
+        max_num_seqs,
+        phase,
+        seq_subset,
+    ):
+        result_dict.update(task_result)
+    add_multitask_metrics(result_dict)
+    return result_dict
+
+
+def iter_shift_multitask(
+    test_annotation_dir,
+    user_submission_dir,
+    seq_filter=None,
+    max_num_seqs=-1,
+    phase="val",
+    seq_subset=None,
+    frame_table=None,
 ):
+    """Evaluate the submitted tasks one after the other.
+
+    Args:
+        test_annotation_dir (str): Path to the unzipped ground truth.
+        user_submission_dir (str): Path to the unzipped submission.
+        seq_filter (str, optional): Condition of the evaluated sequences.
+        max_num_seqs (int): Maximum number of sequences, all if -1.
+        phase (str): val or test.
+        seq_subset (set[str], optional): If given, only the sequences in it
+            are evaluated.
+        frame_table (FrameTableWriter, optional): If given, the per-frame
+            depth results are appended to it, with the condition.
+    Yields:
+        tuple[str, dict[str, float]]: Name of a task and its final metrics,
+            as soon as the task is evaluated.
+    """
     if seq_filter is not None:
         assert seq_filter in CONDITIONS, (
             "seq_filter must be one of clear, overcast, rainy, foggy, cloudy, daytime, dawn/dusk, night, or None, "
             "but got {}".format(seq_filter)
         )
     used_seqs = get_used_seqs(seq_filter, split=phase)
+    if seq_subset is not None:
+        used_seqs = [seq for seq in used_seqs if seq in seq_subset]
     if max_num_seqs > 0 and max_num_seqs < len(used_seqs):
         used_seqs = used_seqs[:max_num_seqs]
 
-    result_dict = {}
-
     # Instance segmentation
     if os.path.exists(os.path.join(user_submission_dir, "det_insseg_2d.json")):
+        from .insseg_eval import evaluate_ins_seg, evaluate_ins_seg_chunked
+
         print(">> Evaluating instance segmentation...")
-        ins_seg_pred = load_scalabel(
-            os.path.join(user_submission_dir, "det_insseg_2d.json"), used_seqs
-        )
-        ins_seg_target = load_scalabel(
-            os.path.join(test_annotation_dir, "det_insseg_2d.json"), used_seqs
-        )
-        ins_seg_pred = filter_scalabel(ins_seg_pred, ins_seg_target)
-        print(len(ins_seg_pred.frames), len(ins_seg_target.frames))
-        with contextlib.redirect_stdout(io.StringIO()):
-            ins_seg_result = evaluate_ins_seg(
-                ins_seg_target.frames,
-                add_score_to_frames(ins_seg_pred.frames),
-                ins_seg_target.config,
-                nproc=1,
-            )
+        pred_path = os.path.join(user_submission_dir, "det_insseg_2d.json")
+        gt_path = os.path.join(test_annotation_dir, "det_insseg_2d.json")
+        use_video = insseg_chunk_matching(gt_path, pred_path, used_seqs)
+        if INSSEG_CHUNK_SEQS > 0 and use_video is not None:
+            # Bounded memory: only the match records of past chunks are kept
+            gt_data = load_compiled_scalabel(gt_path)
+            with contextlib.redirect_stdout(io.StringIO()):
+                ins_seg_result = evaluate_ins_seg_chunked(
+                    gt_data.frame_keys(used_seqs),
+                    iter_insseg_chunks(
+                        gt_path, pred_path, used_seqs, INSSEG_CHUNK_SEQS
+                    ),
+                    gt_data.dataset([]).config,
+                    use_video=use_video,
+                )
+        else:
+            ins_seg_pred = load_scalabel(pred_path, used_seqs)
+            ins_seg_target = load_scalabel(gt_path, used_seqs)
+            ins_seg_pred = filter_scalabel(ins_seg_pred, ins_seg_target)
+            print(len(ins_seg_pred.frames), len(ins_seg_target.frames))
+            with contextlib.redirect_stdout(io.StringIO()):
+                ins_seg_result = evaluate_ins_seg(
+                    ins_seg_target.frames,
+                    add_score_to_frames(ins_seg_pred.frames),
+                    ins_seg_target.config,
+                    nproc=1,
+                )
         ins_seg_result = ins_seg_result.summary()
-        result_dict["insseg/mAP"] = ins_seg_result["AP"]
         print(">> Instance segmentation results:\n", ins_seg_result)
+        yield "insseg", {"insseg/mAP": ins_seg_result["AP"]}
 
     # Depth estimation
     if os.path.exists(os.path.join(user_submission_dir, "depth")):
         print(">> Evaluating depth estimation...")
-        depth_eval = DepthEvaluator()
+        depth_eval = DepthEvaluator(
+            gt_cube=open_depth_gt(os.path.join(test_annotation_dir, "depth"))
+        )
+        if frame_table is not None:
+            frame_table.constants["condition"] = seq_filter
         depth_eval.process_from_folder(
             os.path.join(user_submission_dir, "depth"),
             os.path.join(test_annotation_dir, "depth"),
             max_num_seqs=max_num_seqs,
             used_seqs=used_seqs,
+            table=frame_table,
         )
         depth_result = depth_eval.evaluate()
-        # result_dict["depth/AbsErr"] = depth_result["mae"]
-        result_dict["depth/SILog"] = depth_result["silog"]
         print(">> Depth estimation results:\n", depth_result)
+        yield "depth", {
+            # "depth/AbsErr": depth_result["mae"],
+            "depth/SILog": depth_result["silog"],
+        }
 
     # 3D detection
     if os.path.exists(os.path.join(user_submission_dir, "det_3d.json")):
+        from .det3d_eval import evaluate_det_3d
+
         print(">> Evaluating 3D detection...")
         det_3d_pred = load_scalabel(
             os.path.join(user_submission_dir, "det_3d.json"), used_seqs
@@ -169,49 +332,155 @@ def evaluate_shift_multitask(
         det_3d_target = load_scalabel(
             os.path.join(test_annotation_dir, "det_3d.json"), used_seqs
         )
-        det_3d_pred = filter_scalabel(det_3d_pred, det_3d_target)
+        det_3d_index = FrameIndex.from_frames(det_3d_target.frames)
+        det_3d_pred, pred_ids = join_scalabel(det_3d_pred, det_3d_index)
         with contextlib.redirect_stdout(io.StringIO()):
             det_3d_result = evaluate_det_3d(
                 det_3d_target.frames,
                 det_3d_pred.frames,
                 det_3d_target.config,
+                frame_ids=(det_3d_index.frame_ids, pred_ids),
             )
-        result_dict["det3d/mAP"] = det_3d_result["mean_ap"] * 100
-        result_dict["det3d/mTPS"] = (
-            (
-                det_3d_result["tp_scores"]["trans_err"]
-                + det_3d_result["tp_scores"]["orient_err"]
-                + det_3d_result["tp_scores"]["scale_err"]
-            )
-            * 100
-            / 3
-        )
         print(">> 3D detection results:\n", det_3d_result)
+        det_3d_metrics = {}
+        add_det3d_metrics(det_3d_metrics, det_3d_result)
+        yield "det3d", det_3d_metrics
+
+
+def add_det3d_metrics(result_dict, det_3d_result):
+    result_dict["det3d/mAP"] = det_3d_result["mean_ap"] * 100
+    result_dict["det3d/mTPS"] = (
+        (
+            det_3d_result["tp_scores"]["trans_err"]
+            + det_3d_result["tp_scores"]["orient_err"]
+            + det_3d_result["tp_scores"]["scale_err"]
+        )
+        * 100
+        / 3
+    )
+
 
-    # Multitask metrics
+def add_multitask_metrics(result_dict):
     if "insseg/mAP" in result_dict and "depth/SILog" in result_dict:
         result_dict["overall"] = (
             result_dict["insseg/mAP"]
             + (result_dict["det3d/mAP"] + result_dict["det3d/mTPS"]) / 2.0
             + np.clip(50 - result_dict["depth/SILog"], 0, 50) * 2.0
         ) / 3.0
-    return result_dict
 
 
-def evaluate_shift(test_annotation_dir, user_submission_dir, phase="val"):
+def evaluate_shift(
+    test_annotation_dir,
+    user_submission_dir,
+    phase="val",
+    seq_subset=None,
+    on_progress=None,
+    frame_table=None,
+):
+    """Evaluate a submission on all conditions and average the results.
+
+    Args:
+        test_annotation_dir (str): Path to the unzipped ground truth.
+        user_submission_dir (str): Path to the unzipped submission.
+        phase (str): val or test.
+        seq_subset (set[str], optional): If given, only the sequences in it
+            are evaluated.
+        on_progress (Callable[[dict], None], optional): Called with every
+            event of iter_evaluate_shift. An exception raised by it aborts the
+            evaluation.
+        frame_table (str, optional): Folder of a per-frame results table to
+            write, see iter_evaluate_shift.
+    Returns:
+        dict[str, float]: Metrics averaged over the conditions.
+    """
     result_dict = {}
-    for seq_filter in CONDITIONS:
-        print("> Evaluating for condition: {}".format(seq_filter))
-        result_dict[seq_filter] = evaluate_shift_multitask(
-            test_annotation_dir,
-            user_submission_dir,
-            seq_filter,
-            phase=phase,
-        )
+    for event in iter_evaluate_shift(
+        test_annotation_dir, user_submission_dir, phase, seq_subset, frame_table
+    ):
+        if on_progress is not None:
+            on_progress(event)
+        result_dict = event["estimate"]
+    return result_dict
+
 
+def iter_evaluate_shift(
+    test_annotation_dir,
+    user_submission_dir,
+    phase="val",
+    seq_subset=None,
+    frame_table=None,
+):
+    """Evaluate a submission on all conditions, streaming the results.
+
+    An event is yielded when a task is evaluated on a condition, then when the
+    condition is finished, with its multitask metrics. The estimate of the
+    last event is the output of evaluate_shift. Closing the generator aborts
+    the evaluation.
+
+    Args:
+        test_annotation_dir (str): Path to the unzipped ground truth.
+        user_submission_dir (str): Path to the unzipped submission.
+        phase (str): val or test.
+        seq_subset (set[str], optional): If given, only the sequences in it
+            are evaluated.
+        frame_table (str, optional): If given, a table of the depth results
+            of each frame and condition, with the sequence attributes, is
+            written to this folder when the evaluation finishes, see
+            frame_table.py.
+    Yields:
+        dict: Event with the keys "condition", "task" (None when the
+            condition is finished), "result", the final metrics of the task or
+            the condition, and "estimate", the metrics averaged over the
+            results so far. The overall score is estimated from the finished
+            conditions.
+    """
+    result_dict = {}
+    if frame_table is not None:
+        seq_info_path = SEQ_INFO_PATH_VAL if phase == "val" else SEQ_INFO_PATH_TEST
+        writer = FrameTableWriter(frame_table, read_sequence_attributes(seq_info_path))
+    else:
+        writer = contextlib.nullcontext()
+    # The table is written when all conditions are evaluated, and dropped if
+    # the evaluation fails or is aborted
+    with writer as table:
+        for seq_filter in CONDITIONS:
+            if seq_subset is not None and not any(
+                seq in seq_subset for seq in get_used_seqs(seq_filter, split=phase)
+            ):
+                # No sequence of the condition in the subset, e.g. for a preview
+                continue
+            print("> Evaluating for condition: {}".format(seq_filter))
+            condition_dict = {}
+            for task, task_result in iter_shift_multitask(
+                test_annotation_dir,
+                user_submission_dir,
+                seq_filter,
+                phase=phase,
+                seq_subset=seq_subset,
+                frame_table=table,
+            ):
+                condition_dict.update(task_result)
+                partial_dict = {**result_dict, seq_filter: condition_dict}
+                yield {
+                    "condition": seq_filter,
+                    "task": task,
+                    "result": task_result,
+                    "estimate": average_conditions(partial_dict),
+                }
+            add_multitask_metrics(condition_dict)
+            result_dict[seq_filter] = condition_dict
+            yield {
+                "condition": seq_filter,
+                "task": None,
+                "result": condition_dict,
+                "estimate": average_conditions(result_dict),
+            }
+
+
+def average_conditions(result_dict):
     # Overall metrics
     overall_dict = {}
-    for seq_filter in CONDITIONS:
+    for seq_filter in result_dict:
         for metric in result_dict[seq_filter]:
             if metric not in overall_dict:
                 overall_dict[metric] = []
@@ -229,18 +498,43 @@ def evaluate_shift(test_annotation_dir, user_submission_dir, phase="val"):
     return overall_dict
 
 
-def unzip_nested(file_path):
-    assert file_path.endswith(".zip")
-    output_path = file_path[:-4]
-    with zipfile.ZipFile(file_path, "r") as zip_ref:
-        zip_ref.extractall(output_path)
-    # for nested zip files
-    for file in os.listdir(output_path):
-        if file.endswith(".zip"):
-            unzip_nested(os.path.join(output_path, file))
+def prepare_ground_truth(test_annotation_file, preload=False):
+    """Unzip and compile the ground truth once per process.
+
+    The depth maps are compiled into a memory-mapped cube, which is reused
+    across processes as long as the depth maps in the zip file are unchanged,
+    and the json annotations are loaded from the compiled annotation cache.
+
+    Args:
+        test_annotation_file (str): Path to the ground truth zip file.
+        preload (bool): Also parse the ground truth json files into the
+            scalabel cache, for long-lived processes.
+    Returns:
+        str: Path to the unzipped ground truth folder.
+    """
+    if test_annotation_file not in GT_CACHE:
+        print("> ", test_annotation_file)
+        unzip_nested(test_annotation_file)
+        GT_CACHE[test_annotation_file] = test_annotation_file[:-4]
+        key = annotation_key(test_annotation_file)
+        for filename in GT_JSON_FILES:
+            file_path = os.path.join(GT_CACHE[test_annotation_file], filename)
+            GT_ANNOTATION_KEYS[file_path] = key
+        depth_dir = os.path.join(GT_CACHE[test_annotation_file], "depth")
+        if os.path.isdir(depth_dir):
+            compile_depth_gt(depth_dir, gt_zip=test_annotation_file)
+    test_annotation_dir = GT_CACHE[test_annotation_file]
+    if preload:
+        for filename in GT_JSON_FILES:
+            file_path = os.path.join(test_annotation_dir, filename)
+            if os.path.exists(file_path) and file_path not in SCALABEL_CACHE:
+                load_scalabel(file_path)
+    return test_annotation_dir
 
 
 def download(phase, filename):
+    import requests
+
     if phase == "dev":
         url = "https://dl.cv.ethz.ch/shift/challenge2023/multitask_robustness/SHIFT_challenge2023_multitask_minival_gt.zip"
 
@@ -264,7 +558,10 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
         `**kwargs`: keyword arguments that contains additional submission
         metadata that challenge hosts can use to send slack notification.
         You can access the submission metadata
-        with kwargs['submission_metadata']
+        with kwargs['submission_metadata']. A callable in kwargs['on_progress']
+        receives the partial results as they are final, see iter_evaluate_shift.
+        A folder in kwargs['frame_table'] receives a table of the per-frame
+        results, see frame_table.py.
 
         Example: A sample submission metadata can be accessed like this:
         >>> print(kwargs['submission_metadata'])
@@ -293,7 +590,7 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
     print("\nEvaluation environments:")
     print(" - Python version:", sys.version.split(" ")[0])
     print(" - NumPy version:", np.__version__)
-    print(" - Scalabel version:", scalabel.__version__)
+    print(" - Scalabel version:", installed_version("scalabel"))
 
     assert (
         test_annotation_file[-4:] == ".zip"
@@ -302,21 +599,39 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
         user_submission_file[-4:] == ".zip"
     ), "User submission file should be a zip file"
 
+    # Reject obviously broken submissions before unzipping and evaluation
+    keep = None
+    if phase_codename in PHASE_SPLITS:
+        print("\nScanning submission...")
+        used_seqs = get_used_seqs(None, split=PHASE_SPLITS[phase_codename])
+        report = scan_submission(
+            user_submission_file, test_annotation_file, SUBMISSION_TASKS, used_seqs
+        )
+        print(report)
+        assert report.ok, "Submission rejected: {}".format(
+            "; ".join(report.fatal_errors)
+        )
+
+        # Only the files of the used sequences are extracted
+        keep = submission_filter(SUBMISSION_TASKS, used_seqs)
+
     # Unzip the annotation files
     print("\nStart unzipping...")
     user_submission_dir = user_submission_file[:-4]
-    test_annotation_dir = test_annotation_file[:-4]
     print("> ", user_submission_file)
-    unzip_nested(user_submission_file)
-    print("> ", test_annotation_file)
-    unzip_nested(test_annotation_file)
+    unzip_nested(user_submission_file, keep)
+    test_annotation_dir = prepare_ground_truth(test_annotation_file)
     print("Unzipping completed.")
 
     output = {}
     if phase_codename == "dev":
         print("Evaluation phase: Dev")
         result_dict = evaluate_shift(
-            test_annotation_dir, user_submission_dir, phase="val"
+            test_annotation_dir,
+            user_submission_dir,
+            phase="val",
+            on_progress=kwargs.get("on_progress"),
+            frame_table=kwargs.get("frame_table"),
         )
         output["result"] = [{"val_split": result_dict}]
         # To display the results in the result file
@@ -326,13 +641,18 @@ def evaluate(test_annotation_file, user_submission_file, phase_codename, **kwarg
     elif phase_codename == "test":
         print("Evaluation phase: Test")
         result_dict = evaluate_shift(
-            test_annotation_dir, user_submission_dir, phase="test"
+            test_annotation_dir,
+            user_submission_dir,
+            phase="test",
+            on_progress=kwargs.get("on_progress"),
+            frame_table=kwargs.get("frame_table"),
         )
         output["result"] = [{"test_split": result_dict}]
         # To display the results in the result file
         output["submission_result"] = output["result"][0]["test_split"]
         print("Completed evaluation for Test Phase")
         print(result_dict)
+    release_scalabel(user_submission_dir)
     return output
 
 
@@ -0,0 +1,262 @@
+"""Mask IoU on run-length encodings, without dense decoding.
+
+COCO RLE masks are column-major runs of alternating zeros and ones. The
+compressed count strings of all masks are decoded at once into the intervals
+of their ones, and the intersection of two masks is read from the covered
+length of the intervals of one mask at the interval bounds of the other, with
+searchsorted. Every mask has its own lane of pixel indices, so one call covers
+all pairs of a batch of images, and memory grows with the number of runs, not
+of pixels.
+
+The results are those of pycocotools: pairs whose RLE bounding boxes do not
+overlap are skipped with an IoU of 0, pairs of masks of different sizes get
+-1, and the union of a crowd ground truth mask is the area of the detection.
+"""
+from __future__ import annotations
+
+from typing import Dict, NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+
+# Detection intervals per batch of mask_iou
+BATCH_SIZE = 1 << 22
+
+
+class MaskRuns(NamedTuple):
+    """Intervals of the ones of several masks, in column-major pixel indices."""
+
+    starts: np.ndarray  # first pixel of each interval, in shape (N,)
+    ends: np.ndarray  # pixel after each interval, in shape (N,)
+    offsets: np.ndarray  # first interval of each mask, in shape (M + 1,)
+    areas: np.ndarray  # number of ones of each mask, in shape (M,)
+    bboxes: np.ndarray  # x, y, width, height as rleToBbox, in shape (M, 4)
+    sizes: np.ndarray  # height and width of each mask, in shape (M, 2)
+
+    def __len__(self) -> int:
+        return len(self.areas)
+
+
+def _segment_starts(lengths: np.ndarray) -> np.ndarray:
+    # Index of the first element of each segment, given the segment lengths
+    return (np.cumsum(lengths) - lengths).astype(np.int64)
+
+
+def _segment_cumsum(values: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # Inclusive cumulative sum restarted at every segment
+    total = np.cumsum(values)
+    before = total - values
+    return total - np.repeat(
+        before[_segment_starts(lengths)[lengths > 0]], lengths[lengths > 0]
+    )
+
+
+def decode_counts(counts: Sequence[Union[str, bytes]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode compressed COCO RLE count strings, like rleFrString.
+
+    Args:
+        counts (list[str | bytes]): Compressed count strings of the masks.
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Run lengths of all masks, concatenated,
+            and the number of runs of each mask.
+    """
+    strings = [c.encode("ascii") if isinstance(c, str) else bytes(c) for c in counts]
+    chars = np.frombuffer(b"".join(strings), dtype=np.uint8).astype(np.int64) - 48
+    # Each value is a little-endian sequence of 5-bit groups, all but the
+    # last one flagged with 0x20, and the last one signed by its 0x10 bit
+    last = (chars & 0x20) == 0
+    value_starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    value_starts = value_starts[value_starts < len(chars)]
+    group = np.arange(len(chars)) - np.repeat(
+        value_starts, np.diff(np.concatenate([value_starts, [len(chars)]]))
+    )
+    values = np.zeros(len(value_starts), dtype=np.int64)
+    if len(chars):
+        values = np.add.reduceat((chars & 0x1F) << (5 * group), value_starts)
+        negative = (chars[last] & 0x10) != 0
+        values[negative] |= -1 << (5 * (group[last][negative] + 1))
+    string_ends = np.cumsum([len(s) for s in strings], dtype=np.int64)
+    num_values = np.concatenate([[0], np.cumsum(last)])[string_ends]
+    lengths = np.diff(np.concatenate([[0], num_values])).astype(np.int64)
+
+    # From the fourth value on, a value is the difference to the run two
+    # before, so the odd runs and the even runs after the first are chained
+    local = np.arange(len(values)) - np.repeat(_segment_starts(lengths), lengths)
+    chain = np.repeat(np.arange(len(lengths)) * 3, lengths)
+    chain += np.where(local == 0, 0, np.where(local % 2 == 1, 1, 2))
+    order = np.argsort(chain, kind="stable")
+    runs = np.empty_like(values)
+    runs[order] = _segment_cumsum(
+        values[order], np.bincount(chain, minlength=3 * len(lengths))
+    )
+    return runs, lengths
+
+
+def mask_runs(segmentations: Sequence[Dict]) -> MaskRuns:
+    """Intervals, areas and bounding boxes of COCO RLE masks.
+
+    Args:
+        segmentations (list[dict]): Compressed RLE masks, with "size" as
+            height and width and "counts".
+    Returns:
+        MaskRuns: Intervals of the ones of the masks.
+    """
+    runs, lengths = decode_counts([seg["counts"] for seg in segmentations])
+    sizes = np.array([seg["size"] for seg in segmentations], dtype=np.int64).reshape(
+        -1, 2
+    )
+    num_masks = len(lengths)
+    masks = np.repeat(np.arange(num_masks), lengths)
+    local = np.arange(len(runs)) - np.repeat(_segment_starts(lengths), lengths)
+    ends = _segment_cumsum(runs, lengths)
+    ones = local % 2 == 1
+    offsets = np.concatenate([[0], np.cumsum(lengths // 2)]).astype(np.int64)
+    areas = np.bincount(masks[ones], weights=runs[ones], minlength=num_masks)
+
+    # rleToBbox on the runs of an even count: the first pixel of each run of
+    # ones and the last of it, and the full height if a run spans columns
+    bboxes = np.zeros((num_masks, 4))
+    kept = local < np.repeat(lengths // 2 * 2, lengths)
+    heights = np.maximum(sizes[:, 0], 1)[masks[kept]]
+    t = ends[kept] - local[kept] % 2
+    y, x = t % heights, t // heights
+    boxed = lengths >= 2
+    starts = _segment_starts(lengths // 2 * 2)[boxed]
+    if len(starts):
+        xs = np.minimum.reduceat(x, starts)
+        xe = np.maximum.reduceat(x, starts)
+        ys = np.minimum.reduceat(y, starts)
+        ye = np.maximum.reduceat(y, starts)
+        odd = local[kept] % 2 == 1
+        spans = np.zeros(len(x), dtype=bool)
+        spans[1:] = odd[1:] & (x[1:] > x[:-1])
+        spanned = np.logical_or.reduceat(spans, starts)
+        ys = np.where(spanned, 0, ys)
+        ye = np.where(spanned, sizes[boxed, 0] - 1, ye)
+        bboxes[boxed] = np.stack([xs, ys, xe - xs + 1, ye - ys + 1], axis=1)
+    return MaskRuns(
+        starts=(ends - runs)[ones],
+        ends=ends[ones],
+        offsets=offsets,
+        areas=areas.astype(np.int64),
+        bboxes=bboxes,
+        sizes=sizes,
+    )
+
+
+def _lane_width(*masks: MaskRuns) -> int:
+    # Pixel indices of a mask lie in [0, height * width]
+    return max([int(m.sizes.prod(axis=1).max(initial=0)) for m in masks]) + 1
+
+
+def mask_iou(
+    dts: MaskRuns,
+    gts: MaskRuns,
+    dt_inds: np.ndarray,
+    gt_inds: np.ndarray,
+    crowd: np.ndarray,
+) -> np.ndarray:
+    """IoU of pairs of masks, like pycocotools.mask.iou.
+
+    Args:
+        dts (MaskRuns): Detection masks.
+        gts (MaskRuns): Ground truth masks.
+        dt_inds (np.ndarray): Detection mask of each pair.
+        gt_inds (np.ndarray): Ground truth mask of each pair.
+        crowd (np.ndarray): Whether the ground truth of each pair is a crowd.
+    Returns:
+        np.ndarray: IoU of each pair.
+    """
+    dt_inds = np.asarray(dt_inds, dtype=np.int64)
+    gt_inds = np.asarray(gt_inds, dtype=np.int64)
+    crowd = np.asarray(crowd, dtype=bool)
+    ious = np.zeros(len(dt_inds))
+    if len(ious) == 0:
+        return ious
+    # bbIou of the RLE boxes, only pairs with overlapping boxes are compared
+    db, gb = dts.bboxes[dt_inds], gts.bboxes[gt_inds]
+    w = np.fmin(db[:, 2] + db[:, 0], gb[:, 2] + gb[:, 0]) - np.fmax(db[:, 0], gb[:, 0])
+    h = np.fmin(db[:, 3] + db[:, 1], gb[:, 3] + gb[:, 1]) - np.fmax(db[:, 1], gb[:, 1])
+    candidates = (w > 0) & (h > 0)
+    same_size = np.all(dts.sizes[dt_inds] == gts.sizes[gt_inds], axis=1)
+    ious[candidates & ~same_size] = -1
+    todo = np.flatnonzero(candidates & same_size)
+    if len(todo) == 0:
+        return ious
+
+    # Covered length of the ground truth masks, each in its own lane, below a
+    # pixel index: the intersection with [s, e) is cover(e) - cover(s)
+    lane = _lane_width(dts, gts)
+    gt_lanes = np.repeat(np.arange(len(gts)), np.diff(gts.offsets)) * lane
+    lane_starts = np.concatenate([[-1], gts.starts + gt_lanes])
+    lane_ends = np.concatenate([[-1], gts.ends + gt_lanes])
+    covered = np.concatenate([[0], np.cumsum(lane_ends - lane_starts)[:-1]])
+
+    def cover(x: np.ndarray) -> np.ndarray:
+        k = np.searchsorted(lane_starts, x, side="right") - 1
+        return covered[k] + np.minimum(x, lane_ends[k]) - lane_starts[k]
+
+    num_intervals = np.diff(dts.offsets)[dt_inds[todo]]
+    batch_ends = np.cumsum(num_intervals)
+    start = 0
+    while start < len(todo):
+        stop = max(
+            start + 1,
+            int(
+                np.searchsorted(
+                    batch_ends,
+                    batch_ends[start] - num_intervals[start] + BATCH_SIZE,
+                    side="right",
+                )
+            ),
+        )
+        pairs = todo[start:stop]
+        counts = num_intervals[start:stop]
+        intervals = np.repeat(
+            dts.offsets[dt_inds[pairs]] - _segment_starts(counts), counts
+        )
+        intervals += np.arange(len(intervals))
+        shift = np.repeat(gt_inds[pairs] * lane, counts)
+        inter = cover(dts.ends[intervals] + shift) - cover(
+            dts.starts[intervals] + shift
+        )
+        i = np.bincount(
+            np.repeat(np.arange(len(pairs)), counts),
+            weights=inter,
+            minlength=len(pairs),
+        )
+        area_d = dts.areas[dt_inds[pairs]]
+        u = np.where(crowd[pairs], area_d, area_d + gts.areas[gt_inds[pairs]] - i)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ious[pairs] = np.where(i == 0, 0.0, i / u)
+        start = stop
+    return ious
+
+
+def overlapping_groups(
+    runs: MaskRuns, groups: np.ndarray, num_groups: int
+) -> np.ndarray:
+    """Whether any two masks of a group overlap, like check_overlap_frame.
+
+    Args:
+        runs (MaskRuns): Masks of all groups.
+        groups (np.ndarray): Group of each mask.
+        num_groups (int): Number of groups.
+    Returns:
+        np.ndarray: Whether each group has overlapping masks.
+    """
+    overlaps = np.zeros(num_groups, dtype=bool)
+    interval_groups = np.repeat(
+        np.asarray(groups, dtype=np.int64), np.diff(runs.offsets)
+    )
+    nonempty = runs.ends > runs.starts
+    lane = _lane_width(runs)
+    starts = (runs.starts + interval_groups * lane)[nonempty]
+    ends = (runs.ends + interval_groups * lane)[nonempty]
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    # The intervals of a mask are disjoint, so an interval starting before
+    # the end of an earlier one of its lane overlaps another mask
+    reach = np.maximum.accumulate(ends)
+    hits = np.flatnonzero(starts[1:] < reach[:-1]) + 1
+    overlaps[starts[hits] // lane] = True
+    return overlaps
@@ -0,0 +1,147 @@
+"""Environment preflight for the evaluation workers.
+
+The required packages are checked against the installed distributions once and
+the outcome is cached in a marker file, so a warm worker neither calls pip nor
+inspects the environment again when the package is imported.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata as metadata
+
+try:
+    from packaging.specifiers import InvalidSpecifier, SpecifierSet
+    from packaging.version import InvalidVersion, Version
+except ImportError:  # packaging is only vendored by pip
+    try:
+        from pip._vendor.packaging.specifiers import InvalidSpecifier, SpecifierSet
+        from pip._vendor.packaging.version import InvalidVersion, Version
+    except ImportError:
+        SpecifierSet = None
+
+# (distribution name, version specifier or None for any, pip requirement)
+REQUIREMENTS = [
+    ("tqdm", None, "tqdm"),
+    ("numpy", "==1.21", "numpy==1.21"),
+    ("nuscenes-devkit", "==1.1.10", "nuscenes-devkit==1.1.10"),
+    ("pyquaternion", "==0.9.9", "pyquaternion==0.9.9"),
+    ("scalabel", None, "git+https://github.com/scalabel/scalabel.git@scalabel-evalAPI"),
+    # ("matplotlib", "==3.5.2", "matplotlib==3.5.2"),
+    # ("Pillow", "==6.2.0", "Pillow==6.2.0"),
+]
+CACHE_DIR = os.environ.get(
+    "SHIFT_EVAL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "shift-eval")
+)
+
+
+def install(package):
+    # Install a pip python package
+
+    # Args:
+    #     package ([str]): Package name with version
+
+    subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+
+
+def install_local_package(folder_name):
+    # Install a local python package
+
+    # Args:
+    #     folder_name ([str]): name of the folder placed in evaluation_script/
+
+    subprocess.check_output(
+        [
+            sys.executable,
+            "-m",
+            "pip",
+            "install",
+            os.path.join(str(Path(__file__).parent.absolute()) + folder_name),
+        ]
+    )
+
+
+def installed_version(distribution):
+    """Return the installed version of a distribution, or None if missing."""
+    try:
+        return metadata.version(distribution)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def is_satisfied(distribution, specifier=None):
+    """Check whether a distribution is installed in the required version.
+
+    The installed version is matched against the specifier of the pip
+    requirement with PEP 440 semantics, as pip would: "==1.21" is satisfied by
+    1.21 and 1.21.0 but not by 1.21.6. Without the packaging library the
+    requirement is left to pip.
+    """
+    installed = installed_version(distribution)
+    if installed is None:
+        return False
+    if specifier is None:
+        return True
+    if SpecifierSet is None:
+        return False
+    try:
+        return SpecifierSet(specifier).contains(Version(installed), prereleases=True)
+    except (InvalidSpecifier, InvalidVersion):
+        return False
+
+
+def marker_path():
+    """Path of the marker file caching a successful preflight.
+
+    The marker is keyed by the interpreter and the requirement list, so a
+    different virtualenv or a changed pin triggers a new check.
+    """
+    key = json.dumps([sys.executable, sys.version, REQUIREMENTS])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"preflight-{digest}.json")
+
+
+def preflight(force=False):
+    """Make sure the required packages are installed.
+
+    Args:
+        force (bool): Check the environment even if a marker file exists.
+    """
+    marker = marker_path()
+    if not force and os.path.exists(marker):
+        return
+
+    missing = [
+        requirement
+        for distribution, specifier, requirement in REQUIREMENTS
+        if not is_satisfied(distribution, specifier)
+    ]
+    for requirement in missing:
+        install(requirement)
+    if missing:
+        print("============")
+        print("Install done")
+        print("============")
+
+    # show the version of the required packages
+    versions = {
+        distribution: installed_version(distribution)
+        for distribution, _, _ in REQUIREMENTS
+    }
+    for distribution, version in versions.items():
+        print(f" - {distribution}: {version}")
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(marker, "w") as f:
+            json.dump(versions, f)
+    except OSError as e:
+        print(f"Could not write preflight marker {marker}: {e}")
@@ -0,0 +1,193 @@
+"""Quick preview score on a stratified subset of sequences.
+
+A fixed fraction of the sequences of the phase is drawn, allocated to the
+strata of start weather and time of day from the sequence csv files in
+proportion to their size, and dealt into a few disjoint groups. Each group is
+evaluated like the full phase, and the preview reports the mean of the group
+scores with a 95% confidence band from their spread (random group method). The
+draw only depends on the sequence names, so every submission of a phase is
+previewed on the same sequences.
+"""
+from __future__ import annotations
+
+import hashlib
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from .main import (
+    PHASE_SPLITS,
+    SEQ_INFO_TEST,
+    SEQ_INFO_VAL,
+    SUBMISSION_TASKS,
+    evaluate_shift,
+    prepare_ground_truth,
+    unzip_nested,
+)
+from .manifest import scan_submission, submission_filter
+
+# Fraction of the sequences of the phase in the preview
+PREVIEW_FRACTION = 0.1
+# Number of disjoint groups the preview sequences are dealt into
+PREVIEW_GROUPS = 4
+# Two-sided 95% quantiles of Student's t distribution, by degrees of freedom
+T_QUANTILES = {
+    1: 12.706,
+    2: 4.303,
+    3: 3.182,
+    4: 2.776,
+    5: 2.571,
+    6: 2.447,
+    7: 2.365,
+    8: 2.306,
+    9: 2.262,
+    10: 2.228,
+}
+
+
+def stratified_groups(
+    seq_info: Sequence[tuple],
+    num_groups: int = PREVIEW_GROUPS,
+    fraction: float = PREVIEW_FRACTION,
+) -> List[List[str]]:
+    """Draw disjoint, stratified groups of sequences.
+
+    The budget of sequences is allocated to the strata in proportion to their
+    size by systematic sampling, so each stratum gets its share rounded up or
+    down at random and small strata may get no sequence at all.
+
+    Args:
+        seq_info (list[tuple]): Rows of the sequence csv file, with the video
+            name first and the stratification attributes after it.
+        num_groups (int): Number of groups.
+        fraction (float): Fraction of the sequences drawn, at least one
+            sequence.
+    Returns:
+        list[list[str]]: Video names of each non-empty group.
+    """
+    if not seq_info:
+        return []
+
+    # Deterministic shuffle within the strata, by the hash of the video names
+    def seq_hash(seq: str) -> str:
+        return hashlib.sha1(seq.encode()).hexdigest()
+
+    seqs = [
+        row[0]
+        for row in sorted(seq_info, key=lambda row: (tuple(row[1:]), seq_hash(row[0])))
+    ]
+    num_seqs = min(len(seqs), max(1, int(round(fraction * len(seqs)))))
+    # Every step-th sequence from a deterministic random start
+    step = len(seqs) / num_seqs
+    start = int(seq_hash(",".join(seqs))[:8], 16) / 16**8
+    drawn = [seqs[int((i + start) * step)] for i in range(num_seqs)]
+    groups = [drawn[i::num_groups] for i in range(num_groups)]
+    return [group for group in groups if group]
+
+
+def confidence_band(values: Sequence[float]) -> float:
+    """Half width of the 95% confidence interval of the mean of the values."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        return float("nan")
+    t = T_QUANTILES.get(len(values) - 1, 1.96)
+    return float(t * values.std(ddof=1) / np.sqrt(len(values)))
+
+
+def preview_shift(
+    test_annotation_dir: str,
+    user_submission_dir: str,
+    phase: str = "val",
+    num_groups: int = PREVIEW_GROUPS,
+    fraction: float = PREVIEW_FRACTION,
+) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """Estimate the scores of evaluate_shift on stratified groups.
+
+    Args:
+        test_annotation_dir (str): Path to the unzipped ground truth.
+        user_submission_dir (str): Path to the unzipped submission.
+        phase (str): val or test.
+        num_groups (int): Number of groups.
+        fraction (float): Fraction of the sequences evaluated, see
+            stratified_groups.
+    Returns:
+        tuple[dict[str, float], dict[str, float]]: Estimated scores, and the
+            half width of their 95% confidence band.
+    """
+    seq_info = SEQ_INFO_VAL if phase == "val" else SEQ_INFO_TEST
+    group_results = [
+        evaluate_shift(
+            test_annotation_dir, user_submission_dir, phase, seq_subset=set(group)
+        )
+        for group in stratified_groups(seq_info, num_groups, fraction)
+    ]
+    metrics = [
+        metric
+        for metric in group_results[0]
+        if all(metric in result for result in group_results)
+    ]
+    estimate = {
+        metric: float(np.mean([result[metric] for result in group_results]))
+        for metric in metrics
+    }
+    band = {
+        metric: confidence_band([result[metric] for result in group_results])
+        for metric in metrics
+    }
+    return estimate, band
+
+
+def evaluate_preview(
+    test_annotation_file: str,
+    user_submission_file: str,
+    phase_codename: str,
+    num_groups: int = PREVIEW_GROUPS,
+    fraction: float = PREVIEW_FRACTION,
+) -> dict:
+    """Preview the score of a submission, like evaluate() on fewer sequences.
+
+    Only the files of the preview sequences are extracted, so a full
+    evaluation of the same submission afterwards reuses them.
+
+    Args:
+        test_annotation_file (str): Path to the ground truth zip file.
+        user_submission_file (str): Path to the submission zip file.
+        phase_codename (str): Phase to which the submission is made.
+        num_groups (int): Number of groups.
+        fraction (float): Fraction of the sequences evaluated.
+    Returns:
+        dict: Output dict in the format of evaluate(), with the confidence band,
+            the number of sequences evaluated and of sequences in the phase
+            under "preview".
+    """
+    assert phase_codename in PHASE_SPLITS, f"Unknown phase {phase_codename}"
+    phase = PHASE_SPLITS[phase_codename]
+    seq_info = SEQ_INFO_VAL if phase == "val" else SEQ_INFO_TEST
+    groups = stratified_groups(seq_info, num_groups, fraction)
+    seqs = [seq for group in groups for seq in group]
+    print(
+        f"Previewing {len(seqs)} of {len(seq_info)} sequences "
+        f"in {len(groups)} groups"
+    )
+
+    report = scan_submission(
+        user_submission_file, test_annotation_file, SUBMISSION_TASKS, seqs
+    )
+    assert report.ok, "Submission rejected: {}".format("; ".join(report.fatal_errors))
+    unzip_nested(user_submission_file, submission_filter(SUBMISSION_TASKS, seqs))
+    test_annotation_dir = prepare_ground_truth(test_annotation_file)
+
+    estimate, band = preview_shift(
+        test_annotation_dir, user_submission_file[:-4], phase, num_groups, fraction
+    )
+    split_name = "val_split" if phase == "val" else "test_split"
+    return {
+        "result": [{split_name: estimate}],
+        "submission_result": estimate,
+        "preview": {
+            "band": band,
+            "num_seqs": len(seqs),
+            "num_phase_seqs": len(seq_info),
+            "num_groups": len(groups),
+        },
+    }
@@ -0,0 +1,155 @@
+"""Catalog of the sequence attributes of the sequence csv files.
+
+All columns of a *_front_images_seq.csv file are loaded once into typed
+arrays, float for the numeric columns and str for the others. Slices of the
+sequences are boolean masks: equality queries on a text column read a mask
+precomputed per value, range queries on a numeric column take a slice of its
+precomputed sort order, and masks combine with &, | and ~.
+
+Example:
+    catalog = SequenceCatalog.from_csv("val_front_images_seq.csv")
+    seqs = catalog.seqs(catalog.select("start_fog_density>50,town=05"))
+"""
+from __future__ import annotations
+
+import csv
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Clause of a query: column, operator and value
+_CLAUSE = re.compile(r"^\s*(\w+)\s*(>=|<=|!=|==|=|>|<)\s*(.*?)\s*$")
+
+
+class SequenceCatalog:
+    """Typed attribute columns of sequences, with precomputed query masks."""
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+        self.videos: List[str] = columns["video"].tolist()
+        # Mask of each value of each text column
+        self._masks: Dict[str, Dict[str, np.ndarray]] = {}
+        # Sort order and sorted values of each numeric column, nan last
+        self._sorted: Dict[str, tuple] = {}
+        for name, values in columns.items():
+            if values.dtype.kind == "f":
+                order = np.argsort(values, kind="stable")
+                self._sorted[name] = (order, values[order])
+            else:
+                uniques, inverse = np.unique(values, return_inverse=True)
+                self._masks[name] = {
+                    value: inverse == k for k, value in enumerate(uniques.tolist())
+                }
+
+    @classmethod
+    def from_csv(cls, path: str) -> SequenceCatalog:
+        """Catalog of a sequence csv file, numeric columns parsed as float."""
+        with open(path, "r") as f:
+            rows = list(csv.DictReader(f))
+            names = list(rows[0]) if rows else ["video"]
+        columns = {}
+        for name in names:
+            values = [row[name] for row in rows]
+            try:
+                columns[name] = np.array(values, dtype=np.float64)
+            except ValueError:
+                columns[name] = np.array(values, dtype=str)
+        if "video" in columns and columns["video"].dtype.kind == "f":
+            columns["video"] = np.array([row["video"] for row in rows], dtype=str)
+        return cls(columns)
+
+    def __len__(self) -> int:
+        return len(self.videos)
+
+    def _column(self, column: str) -> np.ndarray:
+        if column not in self.columns:
+            raise KeyError(f"Unknown sequence attribute {column}")
+        return self.columns[column]
+
+    def all(self) -> np.ndarray:
+        """Mask of all sequences."""
+        return np.ones(len(self), dtype=bool)
+
+    def equals(self, column: str, value) -> np.ndarray:
+        """Mask of the sequences with a value of an attribute.
+
+        Args:
+            column (str): Attribute name, e.g. "town".
+            value: Attribute value, parsed as float for a numeric column.
+        Returns:
+            np.ndarray: Mask of the sequences.
+        """
+        values = self._column(column)
+        if column in self._sorted:
+            return values == float(value)
+        mask = self._masks[column].get(str(value))
+        return mask.copy() if mask is not None else np.zeros(len(self), dtype=bool)
+
+    def between(
+        self,
+        column: str,
+        low: Optional[float] = None,
+        high: Optional[float] = None,
+        include_low: bool = True,
+        include_high: bool = True,
+    ) -> np.ndarray:
+        """Mask of the sequences with a numeric attribute in a range.
+
+        Args:
+            column (str): Numeric attribute name, e.g. "start_fog_density".
+            low (float, optional): Lower bound, None for no bound.
+            high (float, optional): Upper bound, None for no bound.
+            include_low (bool): Whether the lower bound is in the range.
+            include_high (bool): Whether the upper bound is in the range.
+        Returns:
+            np.ndarray: Mask of the sequences, never with a nan attribute.
+        """
+        self._column(column)
+        if column not in self._sorted:
+            raise ValueError(f"Sequence attribute {column} is not numeric")
+        order, values = self._sorted[column]
+        start, stop = 0, int(np.count_nonzero(~np.isnan(values)))
+        if low is not None:
+            side = "left" if include_low else "right"
+            start = int(np.searchsorted(values[:stop], low, side=side))
+        if high is not None:
+            side = "right" if include_high else "left"
+            stop = int(np.searchsorted(values[:stop], high, side=side))
+        mask = np.zeros(len(self), dtype=bool)
+        mask[order[start:stop]] = True
+        return mask
+
+    def select(self, query: str) -> np.ndarray:
+        """Mask of the sequences matching all clauses of a query.
+
+        Args:
+            query (str): Comma separated clauses "<attribute><op><value>",
+                with op one of =, ==, !=, <, <=, >, >=, e.g.
+                "start_fog_density>50,town=05". An empty query selects all.
+        Returns:
+            np.ndarray: Mask of the sequences.
+        """
+        mask = self.all()
+        for clause in query.split(","):
+            if not clause.strip():
+                continue
+            match = _CLAUSE.match(clause)
+            if match is None:
+                raise ValueError(f"Invalid sequence query clause {clause!r}")
+            column, op, value = match.groups()
+            if op in ("=", "=="):
+                mask &= self.equals(column, value)
+            elif op == "!=":
+                mask &= ~self.equals(column, value)
+            else:
+                bound = float(value)
+                if op[0] == ">":
+                    mask &= self.between(column, low=bound, include_low=op == ">=")
+                else:
+                    mask &= self.between(column, high=bound, include_high=op == "<=")
+        return mask
+
+    def seqs(self, mask: np.ndarray) -> List[str]:
+        """Sequences of a mask, in file order."""
+        return [self.videos[i] for i in np.flatnonzero(mask)]
@@ -0,0 +1,428 @@
+"""Sharded evaluation with mergeable partial states.
+
+A large submission can be evaluated by several workers sharing a filesystem.
+Each worker evaluates every n-th sequence of the phase ("map") and writes the
+partial state of its sequences:
+
+ - depth: per-frame metrics of each sequence,
+ - instance segmentation: COCOeval per-image match records,
+ - 3D detection: nuScenes per-sample match records.
+
+The reducer merges the states of all shards, in any order, into the same
+output dict as evaluate() on a single node. The same states also give the
+metrics of any slice of the sequences by their attributes in the sequence csv
+file, e.g. fog density above 50 in town 05, without a new evaluation.
+
+Example:
+    python -m evaluation_script.shard map --gt val_gt.zip --submission sub.zip \
+        --phase dev --num-shards 8 --shard-index 0 --output-dir /shared/sub
+    python -m evaluation_script.shard reduce --output-dir /shared/sub
+    python -m evaluation_script.shard slices --output-dir /shared/sub \
+        --slice "fog_05=start_fog_density>50,town=05"
+"""
+
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import pickle
+import tempfile
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .depth_eval import DepthEvaluator
+from .frame_index import FrameIndex, frame_keys, join_frames
+from .main import (
+    CONDITIONS,
+    PHASE_SPLITS,
+    SEQ_CATALOG_TEST,
+    SEQ_CATALOG_VAL,
+    SUBMISSION_TASKS,
+    add_det3d_metrics,
+    add_multitask_metrics,
+    add_score_to_frames,
+    average_conditions,
+    get_used_seqs,
+    load_scalabel,
+    unzip_nested,
+)
+from .manifest import submission_filter
+
+SHARD_STATE_VERSION = 3
+# Unit of all frames of the phase, for slices of any sequences
+ALL_UNIT = "all"
+
+
+def shard_seqs(seqs: List[str], num_shards: int, shard_index: int) -> List[str]:
+    """Sequences evaluated by a shard."""
+    assert 0 <= shard_index < num_shards, "shard_index must be below num_shards"
+    return seqs[shard_index::num_shards]
+
+
+def _condition_units(gt_frames, pred_frames, phase):
+    # Ground truth and prediction indices of each condition, like
+    # load_scalabel with the condition's sequences and filter_scalabel
+    index = FrameIndex.from_frames(gt_frames)
+    join = join_frames(index, frame_keys(pred_frames))
+    gt_videos = np.array([frame.videoName or "" for frame in gt_frames], dtype=str)
+    units = {}
+    for seq_filter in CONDITIONS + [ALL_UNIT]:
+        used_seqs = get_used_seqs(
+            None if seq_filter == ALL_UNIT else seq_filter, split=phase
+        )
+        used = np.isin(gt_videos, np.array(used_seqs, dtype=str))
+        used_ids = np.zeros(len(index), dtype=bool)
+        used_ids[index.frame_ids[used]] = True
+        units[seq_filter] = (
+            np.flatnonzero(used).tolist(),
+            join.kept[used_ids[join.pred_ids]].tolist(),
+        )
+    return units
+
+
+def _det3d_state(gt_frames, pred_frames, config, seqs):
+    from .det3d_eval import match_det_3d
+
+    gt_frames = [frame for frame in gt_frames if frame.videoName in seqs]
+    index = FrameIndex.from_frames(gt_frames)
+    join = join_frames(index, frame_keys(pred_frames))
+    records = match_det_3d(
+        gt_frames,
+        [pred_frames[i] for i in join.kept],
+        config,
+        frame_ids=(index.frame_ids, join.pred_ids),
+    )
+    # First prediction of each frame, as the samples appear in accumulate
+    first_pred = {}
+    for i, frame_id in zip(join.kept.tolist(), join.pred_ids.tolist()):
+        first_pred.setdefault(frame_id, i)
+    return {
+        "config": config,
+        "samples": {
+            (frame.videoName, frame.name): (
+                frame.videoName,
+                first_pred.get(frame_id),
+                records[str(frame_id)],
+            )
+            for frame, frame_id in zip(gt_frames, index.frame_ids.tolist())
+        },
+    }
+
+
+def evaluate_shard(
+    test_annotation_dir: str,
+    user_submission_dir: str,
+    phase: str = "val",
+    num_shards: int = 1,
+    shard_index: int = 0,
+) -> Dict:
+    """Evaluate the sequences of one shard into a partial state.
+
+    Args:
+        test_annotation_dir (str): Unzipped ground truth folder.
+        user_submission_dir (str): Unzipped submission folder.
+        phase (str): "val" or "test".
+        num_shards (int): Total number of shards.
+        shard_index (int): Index of this shard.
+    Returns:
+        dict: Partial state of the shard, to be merged with reduce_shards.
+    """
+    from .match_records import match_units
+
+    all_seqs = get_used_seqs(None, split=phase)
+    seqs = set(shard_seqs(all_seqs, num_shards, shard_index))
+    state = {
+        "version": SHARD_STATE_VERSION,
+        "phase": phase,
+        "num_shards": num_shards,
+        "shard_index": shard_index,
+        "seqs": sorted(seqs),
+        "tasks": {},
+    }
+
+    # Instance segmentation
+    if os.path.exists(os.path.join(user_submission_dir, "det_insseg_2d.json")):
+        print(">> Matching instance segmentation...")
+        target = load_scalabel(
+            os.path.join(test_annotation_dir, "det_insseg_2d.json"), all_seqs
+        )
+        pred = load_scalabel(
+            os.path.join(user_submission_dir, "det_insseg_2d.json"), all_seqs
+        )
+        add_score_to_frames(pred.frames)
+        state["tasks"]["insseg"] = match_units(
+            target.frames,
+            pred.frames,
+            _condition_units(target.frames, pred.frames, phase),
+            seqs,
+            target.config,
+            iou_type="segm",
+        )
+
+    # Depth estimation
+    if os.path.exists(os.path.join(user_submission_dir, "depth")):
+        print(">> Evaluating depth estimation...")
+        depth_states = {}
+        DepthEvaluator().process_from_folder(
+            os.path.join(user_submission_dir, "depth"),
+            os.path.join(test_annotation_dir, "depth"),
+            used_seqs=seqs,
+            states=depth_states,
+        )
+        state["tasks"]["depth"] = depth_states
+
+    # 3D detection
+    if os.path.exists(os.path.join(user_submission_dir, "det_3d.json")):
+        print(">> Matching 3D detection...")
+        target = load_scalabel(
+            os.path.join(test_annotation_dir, "det_3d.json"), all_seqs
+        )
+        pred = load_scalabel(os.path.join(user_submission_dir, "det_3d.json"), all_seqs)
+        state["tasks"]["det3d"] = _det3d_state(
+            target.frames, pred.frames, target.config, seqs
+        )
+    return state
+
+
+def _check_states(states: List[Dict]) -> Tuple[str, set]:
+    # Phase and tasks of the states of all shards, which must be compatible
+    phase = states[0]["phase"]
+    num_shards = states[0]["num_shards"]
+    tasks = set(states[0]["tasks"])
+    for state in states:
+        assert state["version"] == SHARD_STATE_VERSION, "Incompatible shard state"
+        assert state["phase"] == phase and state["num_shards"] == num_shards
+        assert set(state["tasks"]) == tasks, "Shards evaluated different tasks"
+    shard_indices = sorted(state["shard_index"] for state in states)
+    assert shard_indices == list(
+        range(num_shards)
+    ), f"Expected {num_shards} shards, got {shard_indices}"
+    return phase, tasks
+
+
+def _merge_sequences(states: List[Dict], tasks: set) -> Tuple[Dict, Dict]:
+    # Depth states by sequence and 3D detection samples of all shards
+    depth_states, samples = {}, {}
+    for state in states:
+        if "depth" in tasks:
+            depth_states.update(state["tasks"]["depth"])
+        if "det3d" in tasks:
+            samples.update(state["tasks"]["det3d"]["samples"])
+    return depth_states, samples
+
+
+def _sequence_metrics(
+    result_dict: Dict, states: List[Dict], tasks: set, merged: Tuple, used_seqs: set
+) -> None:
+    # Depth and 3D detection metrics of some sequences, aggregated from the
+    # per-sequence depth states and the per-sample 3D detection records
+    from .det3d_eval import reduce_det_3d
+
+    depth_states, samples = merged
+    if "depth" in tasks:
+        depth_eval = DepthEvaluator()
+        depth_eval.merge_states(
+            [
+                depth_states[seq_name]
+                for seq_name in sorted(depth_states)
+                if seq_name in used_seqs
+            ]
+        )
+        result_dict["depth/SILog"] = depth_eval.evaluate()["silog"]
+
+    if "det3d" in tasks:
+        config = states[0]["tasks"]["det3d"]["config"]
+        used_samples = [sample for sample in samples.values() if sample[0] in used_seqs]
+        # Samples in the order of the predictions, as in accumulate
+        used_samples.sort(key=lambda sample: (sample[1] is None, sample[1] or 0))
+        det_3d_result = reduce_det_3d([record for _, _, record in used_samples], config)
+        add_det3d_metrics(result_dict, det_3d_result)
+
+
+def reduce_shards(states: List[Dict]) -> Dict:
+    """Merge the partial states of all shards into the output of evaluate().
+
+    Args:
+        states (list[dict]): Partial states of all shards, in any order.
+    Returns:
+        dict: Same output dict as evaluate().
+    """
+    from .match_records import reduce_units
+
+    phase, tasks = _check_states(states)
+    result_dict = {seq_filter: {} for seq_filter in CONDITIONS}
+    if "insseg" in tasks:
+        ins_seg_results = reduce_units(
+            [state["tasks"]["insseg"] for state in states], iou_type="segm"
+        )
+        for seq_filter in CONDITIONS:
+            ins_seg_result = ins_seg_results[seq_filter].summary()
+            result_dict[seq_filter]["insseg/mAP"] = ins_seg_result["AP"]
+
+    merged = _merge_sequences(states, tasks)
+    for seq_filter in CONDITIONS:
+        used_seqs = set(get_used_seqs(seq_filter, split=phase))
+        _sequence_metrics(result_dict[seq_filter], states, tasks, merged, used_seqs)
+
+    for seq_filter in CONDITIONS:
+        add_multitask_metrics(result_dict[seq_filter])
+    result_dict = average_conditions(result_dict)
+
+    split = "val_split" if phase == "val" else "test_split"
+    output = {"result": [{split: result_dict}]}
+    output["submission_result"] = output["result"][0][split]
+    return output
+
+
+def reduce_slices(states: List[Dict], queries: Dict[str, str]) -> Dict[str, Dict]:
+    """Metrics of slices of the sequences, aggregated from the shard states.
+
+    A slice is any set of sequences, selected by a query on the attributes of
+    the sequence csv file, see SequenceCatalog.select. Its metrics come from
+    the per-image, per-sequence and per-sample states of the shards, without
+    evaluating the submission again, and are those of a single evaluation of
+    the frames of its sequences, as for a condition.
+
+    Args:
+        states (list[dict]): Partial states of all shards, in any order.
+        queries (dict[str, str]): Query of each slice, by slice name, e.g.
+            {"fog": "start_fog_density>50,town=05"}.
+    Returns:
+        dict[str, dict]: Metrics and number of sequences of each slice.
+    """
+    from .match_records import reduce_slice
+
+    phase, tasks = _check_states(states)
+    catalog = SEQ_CATALOG_VAL if phase == "val" else SEQ_CATALOG_TEST
+    merged = _merge_sequences(states, tasks)
+    results = {}
+    for name, query in queries.items():
+        used_seqs = set(catalog.seqs(catalog.select(query)))
+        result_dict = {"num_seqs": len(used_seqs)}
+        if "insseg" in tasks:
+            ins_seg_result = reduce_slice(
+                [state["tasks"]["insseg"] for state in states],
+                ALL_UNIT,
+                used_seqs,
+                iou_type="segm",
+            ).summary()
+            result_dict["insseg/mAP"] = ins_seg_result["AP"]
+        _sequence_metrics(result_dict, states, tasks, merged, used_seqs)
+        add_multitask_metrics(result_dict)
+        results[name] = result_dict
+    return results
+
+
+def state_path(output_dir: str, num_shards: int, shard_index: int) -> str:
+    """Path of the state file of a shard."""
+    return os.path.join(output_dir, f"shard-{shard_index:05d}-of-{num_shards:05d}.pkl")
+
+
+def write_state(state: Dict, output_dir: str) -> str:
+    """Write the state of a shard atomically, for readers on other nodes."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = state_path(output_dir, state["num_shards"], state["shard_index"])
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=output_dir, suffix=".tmp", delete=False
+    ) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, path)
+    return path
+
+
+def read_states(output_dir: str) -> List[Dict]:
+    """Read the states of all shards in a folder."""
+    states = []
+    for path in sorted(glob.glob(os.path.join(output_dir, "shard-*-of-*.pkl"))):
+        with open(path, "rb") as f:
+            states.append(pickle.load(f))
+    assert states, f"No shard state found in {output_dir}"
+    return states
+
+
+def extract(zip_path: str, work_dir: str, keep=None) -> str:
+    """Unzip a zip file into a worker-local folder and return its path.
+
+    Args:
+        zip_path (str): Path to the zip file.
+        work_dir (str): Worker-local folder.
+        keep (Callable[[str], bool], optional): Filter of the extracted files,
+            see unzip_nested.
+    Returns:
+        str: Path to the unzipped folder.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    link_path = os.path.join(work_dir, os.path.basename(zip_path))
+    if not os.path.exists(link_path):
+        os.symlink(os.path.abspath(zip_path), link_path)
+    unzip_nested(link_path, keep)
+    return link_path[:-4]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="step", required=True)
+    map_parser = subparsers.add_parser("map", help="evaluate one shard")
+    map_parser.add_argument("--gt", required=True, help="ground truth zip file")
+    map_parser.add_argument("--submission", required=True, help="submission zip file")
+    map_parser.add_argument("--phase", required=True, choices=sorted(PHASE_SPLITS))
+    map_parser.add_argument("--num-shards", type=int, required=True)
+    map_parser.add_argument("--shard-index", type=int, required=True)
+    map_parser.add_argument("--output-dir", required=True, help="shared state folder")
+    map_parser.add_argument(
+        "--work-dir", help="worker-local folder to unzip into, default a temp folder"
+    )
+    reduce_parser = subparsers.add_parser("reduce", help="merge all shards")
+    reduce_parser.add_argument(
+        "--output-dir", required=True, help="shared state folder"
+    )
+    reduce_parser.add_argument("--output", help="json file for the output dict")
+    slices_parser = subparsers.add_parser("slices", help="metrics of slices")
+    slices_parser.add_argument(
+        "--output-dir", required=True, help="shared state folder"
+    )
+    slices_parser.add_argument(
+        "--slice",
+        action="append",
+        required=True,
+        help="slice as name=query, e.g. fog=start_fog_density>50,town=05",
+    )
+    slices_parser.add_argument("--output", help="json file for the slice metrics")
+    args = parser.parse_args()
+
+    if args.step == "map":
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix="shift-shard-")
+        # Only the submission files of the sequences of the shard are extracted
+        seqs = shard_seqs(
+            get_used_seqs(None, split=PHASE_SPLITS[args.phase]),
+            args.num_shards,
+            args.shard_index,
+        )
+        state = evaluate_shard(
+            extract(args.gt, os.path.join(work_dir, "gt")),
+            extract(
+                args.submission,
+                os.path.join(work_dir, "submission"),
+                submission_filter(SUBMISSION_TASKS, seqs),
+            ),
+            phase=PHASE_SPLITS[args.phase],
+            num_shards=args.num_shards,
+            shard_index=args.shard_index,
+        )
+        print("Wrote", write_state(state, args.output_dir))
+    elif args.step == "slices":
+        queries = dict(spec.split("=", 1) for spec in args.slice)
+        output = reduce_slices(read_states(args.output_dir), queries)
+        print(json.dumps(output, indent=2, default=float))
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(output, f, default=float)
+    else:
+        output = reduce_shards(read_states(args.output_dir))
+        print(output["submission_result"])
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(output, f, default=float)